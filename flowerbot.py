@@ -8,7 +8,32 @@ import csv
 import random
 import operator
 import math
+import re
+import threading
+import time
+import collections
+import sqlite3
+import bisect
+import queue
+import asyncio
+import functools
+import struct
+import array
+import json
+import http.server
+import traceback
+import heapq
+import concurrent.futures
 from playsound import playsound
+try:
+    import MySQLdb
+except ImportError:
+    MySQLdb = None
+try:
+    import numpy
+    NUMPY_RANDOM = numpy.random.default_rng()
+except ImportError:
+    numpy = None
 from datetime import datetime, date
 
 # ---------------------------------------------------------------------------------------------
@@ -16,11 +41,6 @@ from datetime import datetime, date
 OUTPUT_FILE = sys.stdout
 ERROR_FILE = sys.stderr
 
-AUTOBOT_RESPONSES = {}
-APPROVED_AUTO_SHOUTOUT_USERS = {}
-CUSTOM_USER_SHOUTOUTS = {}
-USERS_CHECKED = set()
-
 # SYSTEM GLOBALS
 CURRENT_DIR = os.getcwd()
 RESOURCES_DIR = os.path.join(CURRENT_DIR, 'resources')
@@ -35,6 +55,7 @@ CLIENT_ID = 'client_id'
 CLIENT_SECRETS = 'client_secrets'
 IRC_CHAT_SERVER_PORT = 'server.port'
 IRC_CHAT_SERVER = 'server.url'
+CHANNELS_PER_CONNECTION = 'server.channels_per_connection'
 CHANNEL_TRUSTED_USERS_LIST = 'channel.trusted_users_list'
 AUTO_SHOUTOUT_USERS_FILE = 'auto_shoutout_users_file'
 CUSTOM_SHOUTOUTS_FILE = 'custom_shoutouts_file'
@@ -42,6 +63,34 @@ CUSTOM_USER_SHOUTOUT_MESSAGE_TEMPLATE = 'custom.user_shoutout_message'
 IGNORED_USERS_LIST = 'ignored_users_list'
 AUTOBOT_RESPONSES_FILE = 'auto_bot_responses_file'
 SFX_DIRECTORY = 'sfx.directory'
+SFX_MAPPINGS_FILE = 'sfx.mappings_file'
+SFX_OVERLAP_POLICY = 'sfx.overlap_policy'
+SFX_QUEUE_SIZE = 'sfx.queue_size'
+DATA_FILES_HOT_RELOAD = 'data_files.hot_reload'
+SNAPSHOT_ENABLED = 'snapshot.enabled'
+SNAPSHOT_FILENAME = 'snapshot.filename'
+HELIX_URL = 'helix.url'
+HELIX_CACHE_TTL_PROPERTY = 'helix.cache_ttl'
+SHOUTOUT_TEAM_NAME = 'shoutout.team_name'
+METRICS_PORT = 'metrics.port'
+METRICS_LOG_INTERVAL = 'metrics.log_interval'
+WATCHDOG_STALL_THRESHOLD = 'watchdog.stall_threshold'
+WORKERS_THREADS = 'workers.threads'
+WORKERS_PROCESSES = 'workers.processes'
+WORKERS_MAX_PENDING = 'workers.max_pending'
+WORKERS_TIMEOUT = 'workers.timeout'
+PRESENCE_MAX_USERS = 'presence.max_users'
+PRESENCE_TTL = 'presence.ttl'
+PRESENCE_SESSION_GAP = 'presence.session_gap'
+BURST_MESSAGES_PER_SECOND = 'burst.messages_per_second'
+BURST_CATCH_WINDOW = 'burst.catch_window'
+QUEUE_NAMES_LIST = 'queue_names_list'
+COOLDOWN_USER_MESSAGES = 'cooldown.user_messages'
+COOLDOWN_USER_WINDOW = 'cooldown.user_window'
+COOLDOWN_COMMAND_USES = 'cooldown.command_uses'
+COOLDOWN_COMMAND_WINDOW = 'cooldown.command_window'
+COOLDOWN_COMMANDS = 'cooldown.commands'
+QUEUE_SCORES_FILE = 'queue.scores_file'
 
 # flowermons properties
 FLOWERMONS_ENABLED = 'flowermons.enabled'
@@ -50,6 +99,19 @@ FLOWERMONS_USER_DATA_FILENAME = 'flowermons.user_data_filename'
 FLOWERMONS_SUBS_ONLY_MODE = 'flowermons.subs_only_mode'
 FLOWERMONS_DEFAULT_POKEBALL_LIMIT = 'flowermons.default_pokeball_limit'
 FLOWERMONS_SUBSCRIBERS_POKEBALL_LIMIT = 'flowermons.subs_pokeball_limit'
+FLOWERMONS_COMPACTION_INTERVAL = 'flowermons.compaction_interval'
+FLOWERMONS_STORAGE = 'flowermons.storage'
+FLOWERMONS_SQLITE_FILENAME = 'flowermons.sqlite_filename'
+FLOWERMONS_BOOSTS = 'flowermons.boosts'
+FLOWERMONS_BOOST_DAYS = 'flowermons.boost_days'
+
+# database properties
+DB_HOST = 'db.host'
+DB_NAME = 'db.db_name'
+DB_USER = 'db.user'
+DB_PASSWORD = 'db.password'
+DB_PORT = 'db.port'
+DB_POOL_SIZE = 'db.pool_size'
 
 MSG_USERNAME_REPLACE_STRING = '${username}'
 MSG_LAST_GAME_PLAYED_REPLACE_STRING = '${lastgameplayed}'
@@ -57,22 +119,129 @@ MSG_TWITCH_PAGE_URL_REPLACE_STRING = '${usertwitchpage}'
 DEFAULT_USER_SHOUTOUT_MESSAGE_TEMPLATE = '@${username} is also a streamer! Check them out some time at https://www.twitch.tv/${username}'
 
 # FLOWERMONS
-FLOWERMONS_POKEDEX = set()
-FLOWERMONS_USER_POKEDEX = {}
-FLOWERMONS_USER_POKEBALLS = {}
 FLOWERMONS_SUB_SHINY_DENOM = 256
+FLOWERMONS_MULTI_CATCH_NAMES_LIMIT = 10 # new species named in the !catch N summary
+FLOWERMONS_LEADERS_LIMIT = 5
+FLOWERMONS_DEFAULT_COMPACTION_INTERVAL = 300
+
+# flowermons rarity tiers: relative catch weights for species tagged with a tier in the flowermons file
+FLOWERMONS_RARITY_WEIGHTS = collections.OrderedDict([('common', 100.0), ('uncommon', 50.0), ('rare', 20.0), ('legendary', 5.0)])
+FLOWERMONS_DEFAULT_RARITY = 'common'
+FLOWERMONS_WEEKDAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# flowermons storage backends
+FLOWERMONS_STORAGE_FILE = 'file'
+FLOWERMONS_STORAGE_SQLITE = 'sqlite'
+FLOWERMONS_STORAGE_MYSQL = 'mysql'
+DEFAULT_FLOWERMONS_SQLITE_FILENAME = 'flowermons.sqlite'
+DEFAULT_DB_POOL_SIZE = 3
+STORAGE_BATCH_SIZE = 500
+STORAGE_WRITE_RETRIES = 3
+STORAGE_RETRY_INTERVAL = 30 # seconds before a batch that failed every retry is tried again if no new records arrive
+
+# flowermons journal record types
+JOURNAL_CATCH_RECORD = 'CATCH'
+JOURNAL_POKEBALLS_RECORD = 'BALLS'
+
+KEYWORD_TOKEN_PATTERN = re.compile(r"!?[\w']+")
+
+# outbound message priorities (lower value is sent first)
+PRIORITY_MODERATION = 0
+PRIORITY_COMMAND = 1
+PRIORITY_AUTO_RESPONSE = 2
+
+# twitch chat limits: messages per 30 seconds for regular users vs mods/broadcaster
+TWITCH_MESSAGE_WINDOW = 30.0
+TWITCH_USER_MESSAGE_LIMIT = 20
+TWITCH_MOD_MESSAGE_LIMIT = 100
+TWITCH_USER_MESSAGE_INTERVAL = 1.0
+TWITCH_MAX_MESSAGE_LENGTH = 500
+OUTBOUND_DRAIN_INTERVAL = 0.1 # shortest wait between drains of a rate-limited queue
+OUTBOUND_MAX_QUEUE_DEPTH = 50
+
+# asyncio core: twitch allows 20 JOINs per 10 seconds for regular bot accounts
+TWITCH_JOIN_LIMIT = 20
+TWITCH_JOIN_WINDOW = 10.0
+TWITCH_SSL_PORT = 6697
+DEFAULT_CHANNELS_PER_CONNECTION = 100
+ASYNC_READ_TIMEOUT = 360
+RECONNECT_MIN_DELAY = 1
+RECONNECT_MAX_DELAY = 120
+IRC_TAG_ESCAPES = {':': ';', 's': ' ', '\\': '\\', 'r': '\r', 'n': '\n'}
+
+# command permission levels (ordered so higher levels include lower ones)
+PERMISSION_EVERYONE = 0
+PERMISSION_MOD = 1
+PERMISSION_BROADCASTER = 2
+
+DEFAULT_SFX_MAPPINGS_FILE = 'sfx_mappings.txt'
+SFX_SHINY_KEY = 'shiny'
+
+# binary snapshot of loaded data (bump the version whenever the layout changes)
+SNAPSHOT_MAGIC = b'FLWRSNAP'
+SNAPSHOT_VERSION = 2
+SNAPSHOT_STRING_SEPARATOR = '\x00'
+DEFAULT_SNAPSHOT_FILENAME_TEMPLATE = '%s.snapshot'
+SNAPSHOT_AUTO_SHOUTOUT_USERS = 'auto_shoutout_users'
+SNAPSHOT_CUSTOM_SHOUTOUTS = 'custom_shoutouts'
+SNAPSHOT_AUTOBOT_RESPONSES = 'autobot_responses'
+SNAPSHOT_FLOWERMONS = 'flowermons'
+
+# twitch helix api (shoutout enrichment)
+HELIX_API_URL = 'https://api.twitch.tv/helix'
+HELIX_MAX_BATCH_SIZE = 100 # logins/ids helix accepts per users or channels request
+HELIX_BATCH_WINDOW = 0.05 # seconds a lookup waits for others to batch with
+HELIX_CACHE_TTL = 3600
+HELIX_CACHE_SIZE = 10000
+HELIX_POOL_SIZE = 4
+HELIX_REQUEST_TIMEOUT = 10
+HELIX_MAX_RETRIES = 5
+HELIX_BACKOFF_MIN_DELAY = 1
+HELIX_BACKOFF_MAX_DELAY = 60
+TEAM_MEMBER_SHOUTOUT_PREFIX = 'Is that a %s team member I see?! xcornfPOG '
 
-# valid commands
-VALID_COMMANDS = ['game', 'title', 'so', 'death', 'print',
-    'score', 'streameraddnew', 'deathadd', 'deathreset',
-    'deathinit', 'shoutout', 'flowerdex', 'catch', 'flowermons', 'addballs']
+# metrics (histogram bucket upper bounds are in seconds)
+METRICS_BIND_ADDRESS = '127.0.0.1'
+# background worker pool for blocking work submitted from chat handlers
+WORKERS_DEFAULT_THREADS = 4
+WORKERS_DEFAULT_MAX_PENDING = 100 # queued and running tasks; submit() refuses more
+WORKERS_DEFAULT_TIMEOUT = 30.0
+WORKERS_CLOSE_TIMEOUT = 10.0 # seconds to wait for pending tasks (i.e., file writes) at shutdown
 
-## TODO: move mappings to data file :)
-SFX_MAPPINGS = {
-    'shiny' : 'shiny_sfx.mp3',
-    'rafakp' : 'emf_sample_audio_trimmed.mp3',
-    'sin_elite': 'twilightzone_cut.mp3'
-}
+WATCHDOG_MIN_CHECK_INTERVAL = 0.01 # the watchdog checks for stalls 4 times per threshold, but not more often than this
+METRICS_LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# presence tracking: users remembered per channel, and how long a quiet channel takes to count as a new stream
+PRESENCE_DEFAULT_MAX_USERS = 10000
+PRESENCE_DEFAULT_SESSION_GAP = 3 * 60 * 60
+
+# burst (raid) mode: chat rate that turns it on, and how catches are batched while it is on
+BURST_DEFAULT_MESSAGES_PER_SECOND = 8
+BURST_RATE_WINDOW = 5 # seconds the message rate is averaged over
+BURST_CALM_PERIOD = 15 # seconds the rate must stay under half the threshold before burst mode ends
+BURST_RAID_HOLD = 60 # seconds burst mode stays on after a raid USERNOTICE
+BURST_DEFAULT_CATCH_WINDOW = 3.0
+BURST_CATCH_SUMMARY_LIMIT = 25 # catches listed per summary message
+
+# cooldowns: per-user flood limit, per-user limit for each command (or auto response trigger; off unless configured)
+COOLDOWN_DEFAULT_USER_MESSAGES = 8
+COOLDOWN_DEFAULT_USER_WINDOW = 10.0
+COOLDOWN_DEFAULT_COMMAND_USES = 0
+COOLDOWN_DEFAULT_COMMAND_WINDOW = 30.0
+COOLDOWN_MAX_USERS = 10000 # users idle longer than both windows are forgotten sooner
+
+# custom queues
+DEFAULT_QUEUE_SCORES_FILENAME_TEMPLATE = '%s.queue_scores.txt'
+QUEUE_PAGE_SUFFIX_LENGTH = 40 # room left on each !print page for the "(page x/y ...)" hint
+
+# how often (seconds) the data file watcher checks data files for changes
+DATA_FILE_POLL_INTERVAL = 2.0
+
+# what to do with a sound effect requested while another one is playing or queued
+SFX_POLICY_QUEUE = 'queue' # play it after the queued clips (dropped if the queue is full)
+SFX_POLICY_MERGE = 'merge' # queue it unless the same clip is already waiting to play
+SFX_POLICY_DROP = 'drop' # only play it if nothing else is playing or waiting
+SFX_DEFAULT_QUEUE_SIZE = 5
 
 # ---------------------------------------------------------------------------------------------
 # db functions
@@ -102,26 +271,2486 @@ def parse_properties(properties_filename):
         print('Missing one or more required properties, please check property file for the following: %s' % (', '.join(missing)), file = ERROR_FILE)
         sys.exit(2)
 
-    # add broadcaster to list of users with mod permsissions
-    trusted_users_list = set(map(str.strip, properties.get(CHANNEL_TRUSTED_USERS_LIST, '').split(',')))
-    trusted_users_list.add(properties[CHANNEL])
-    properties[CHANNEL_TRUSTED_USERS_LIST] = list(trusted_users_list)
-    return properties
+    # add broadcaster to list of users with mod permsissions
+    trusted_users_list = set(map(str.strip, properties.get(CHANNEL_TRUSTED_USERS_LIST, '').split(',')))
+    trusted_users_list.add(properties[CHANNEL])
+    properties[CHANNEL_TRUSTED_USERS_LIST] = list(trusted_users_list)
+    return properties
+
+def encode_ascii_string(value):
+    return value.encode('ascii', 'ignore').decode('utf-8')
+
+class FlowerDexLeaderboard(object):
+    '''
+        Leaderboard index maintained incrementally as users catch new flowermons.
+
+        Users are grouped into tie buckets keyed by score (i.e., number of unique mons caught),
+        the distinct scores are kept sorted, and a Fenwick tree over scores counts users per
+        score. An update is O(log U) and top-K / rank queries never scan every user.
+    '''
+    def __init__(self):
+        self.scores = {}
+        self.buckets = {}
+        self.sorted_scores = []
+        self.tree = [0] * 65
+
+    def tree_add(self, score, delta):
+        index = score + 1
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def grow_tree(self):
+        ''' Doubles the Fenwick tree size. '''
+        self.build_tree(2 * len(self.tree))
+
+    def build_tree(self, tree_size):
+        ''' Rebuilds the Fenwick tree from the tie buckets. '''
+        self.tree = [0] * tree_size
+        for score, users in self.buckets.items():
+            index = score + 1
+            while index < len(self.tree):
+                self.tree[index] += len(users)
+                index += index & -index
+
+    def count_at_most(self, score):
+        ''' Number of ranked users with a score less than or equal to score. '''
+        index = min(score + 1, len(self.tree) - 1)
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def update(self, user, score):
+        ''' Sets user's score; as in rebuild(), users with a score of 0 are not ranked. '''
+        old_score = self.scores.get(user)
+        if old_score == score or (old_score is None and score <= 0):
+            return
+        while score + 1 >= len(self.tree):
+            self.grow_tree()
+        if old_score is not None:
+            bucket = self.buckets[old_score]
+            bucket.discard(user)
+            if len(bucket) == 0:
+                del self.buckets[old_score]
+                del self.sorted_scores[bisect.bisect_left(self.sorted_scores, old_score)]
+            self.tree_add(old_score, -1)
+        if score <= 0:
+            del self.scores[user]
+            return
+        self.scores[user] = score
+        if score not in self.buckets:
+            self.buckets[score] = set()
+            bisect.insort(self.sorted_scores, score)
+        self.buckets[score].add(user)
+        self.tree_add(score, 1)
+
+    def clear(self):
+        self.__init__()
+
+    def rebuild(self, scores):
+        ''' Bulk-builds the index from a user -> score dict (i.e., after loading user data). '''
+        self.clear()
+        for user, score in scores.items():
+            if score > 0:
+                self.scores[user] = score
+                self.buckets.setdefault(score, set()).add(user)
+        self.sorted_scores = sorted(self.buckets.keys())
+        tree_size = len(self.tree)
+        while self.sorted_scores and self.sorted_scores[-1] + 1 >= tree_size:
+            tree_size *= 2
+        self.build_tree(tree_size)
+
+    def top(self, limit = FLOWERMONS_LEADERS_LIMIT):
+        ''' Returns up to limit (score, tied users) groups, highest score first. '''
+        return [(score, sorted(self.buckets[score])) for score in self.sorted_scores[:-limit - 1:-1]]
+
+    def rank(self, user):
+        ''' Returns (rank, score, number of users tied at that score) for user, or None if unranked. '''
+        score = self.scores.get(user)
+        if score is None:
+            return None
+        return (len(self.scores) - self.count_at_most(score) + 1, score, len(self.buckets[score]))
+
+    def __len__(self):
+        return len(self.scores)
+
+if hasattr(int, 'bit_count'):
+    popcount = int.bit_count
+else:
+    def popcount(value):
+        return bin(value).count('1')
+
+class AliasTable(object):
+    '''
+        Walker/Vose alias table for drawing indexes 0..n-1 with probability proportional to weights.
+
+        Building it is O(n); each draw is then O(1) (one column pick and one biased coin flip)
+        no matter how many species there are or how skewed the weights are. If every weight is
+        zero the draws are uniform.
+    '''
+    def __init__(self, weights):
+        size = len(weights)
+        total = float(sum(weights))
+        if total <= 0:
+            weights = [1.0] * size
+            total = float(size)
+        scaled = [weight * size / total for weight in weights]
+        self.size = size
+        self.probabilities = [1.0] * size
+        self.aliases = list(range(size))
+        small = [index for index, value in enumerate(scaled) if value < 1.0]
+        large = [index for index, value in enumerate(scaled) if value >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large[-1]
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= (1.0 - scaled[less])
+            if scaled[more] < 1.0:
+                small.append(large.pop())
+        # whatever is left over (rounding error) keeps its whole column
+        self.arrays = None
+
+    def sample(self):
+        column = int(random.random() * self.size)
+        return (column if random.random() < self.probabilities[column] else self.aliases[column])
+
+    def sample_array(self, count):
+        ''' Draws count indexes in one step (a numpy array if numpy is installed, otherwise a list). '''
+        if numpy is None:
+            return [self.sample() for index in range(count)]
+        if self.arrays is None:
+            self.arrays = (numpy.asarray(self.probabilities), numpy.asarray(self.aliases))
+        probabilities, aliases = self.arrays
+        columns = NUMPY_RANDOM.integers(0, self.size, count)
+        return numpy.where(NUMPY_RANDOM.random(count) < probabilities[columns], columns, aliases[columns])
+
+    def __len__(self):
+        return self.size
+
+def parse_flowermons_species(line):
+    '''
+        Parses a flowermons file line: "name", "name<tab>rarity" (i.e., "mewtwo\tlegendary") or
+        "name<tab>weight". Returns (name, rarity, weight), or None for a blank line. Species with
+        an explicit weight have no rarity tier.
+    '''
+    name, _, rarity = line.rstrip('\r\n').partition('\t')
+    name = name.strip().lower()
+    if not name:
+        return None
+    rarity = rarity.strip().lower() or FLOWERMONS_DEFAULT_RARITY
+    if rarity in FLOWERMONS_RARITY_WEIGHTS:
+        return (name, rarity, FLOWERMONS_RARITY_WEIGHTS[rarity])
+    try:
+        weight = float(rarity)
+    except ValueError:
+        raise ValueError('Flowermons file has an unknown rarity "%s" for %s (expected one of %s or a weight)' % (rarity, name, ', '.join(FLOWERMONS_RARITY_WEIGHTS)))
+    if not weight >= 0 or math.isinf(weight):
+        raise ValueError('Flowermons file has an invalid weight "%s" for %s' % (rarity, name))
+    return (name, '', weight)
+
+def parse_flowermons_boosts(value):
+    ''' Parses "target:multiplier" pairs, where target is a rarity tier or species (i.e., "legendary:3,mewtwo:2"), into a dict. '''
+    boosts = {}
+    for pair in value.split(','):
+        target, _, multiplier = pair.rpartition(':')
+        if target.strip() and multiplier.strip():
+            boosts[target.strip().lower()] = float(multiplier)
+    return boosts
+
+def parse_weekdays(value):
+    ''' Parses a comma delimited list of weekdays (i.e., "sat,sun") into a set of date.weekday() numbers. '''
+    weekdays = set()
+    for day in value.split(','):
+        day = day.strip().lower()[:3]
+        if day:
+            if day not in FLOWERMONS_WEEKDAYS:
+                raise ValueError('Unknown weekday "%s" (expected one of %s)' % (day, ', '.join(FLOWERMONS_WEEKDAYS)))
+            weekdays.add(FLOWERMONS_WEEKDAYS.index(day))
+    return weekdays
+
+class FlowermonsPokedex(object):
+    '''
+        Ordered species table loaded from the flowermons file.
+
+        Each species name gets a stable integer id (its position in the table) so per-user
+        FlowerDex data can be stored as bitsets. Names found in user data that are no longer
+        in the flowermons file keep an id but are not catchable and do not count towards
+        FlowerDex completion.
+
+        Catchable species are drawn in proportion to their weight (from their rarity tier) times
+        any active boosts for their tier or name. The alias table used for the draws is rebuilt
+        lazily, only after a weight, boost or the set of catchable species changed.
+    '''
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+        self.weights = []
+        self.rarities = []
+        self.catchable_ids = []
+        self.catchable_mask = 0
+        self.boosts = {}
+        self.alias_table = None
+
+    def add(self, name, catchable = True, weight = FLOWERMONS_RARITY_WEIGHTS[FLOWERMONS_DEFAULT_RARITY], rarity = FLOWERMONS_DEFAULT_RARITY):
+        ''' Returns id for species name, adding it to the table if needed. Catchable adds also set its weight and rarity. '''
+        species_id = self.ids.get(name)
+        if species_id is None:
+            species_id = len(self.names)
+            self.names.append(name)
+            self.ids[name] = species_id
+            self.weights.append(weight)
+            self.rarities.append(rarity)
+        if catchable:
+            if not (self.catchable_mask >> species_id) & 1:
+                self.catchable_ids.append(species_id)
+                self.catchable_mask |= (1 << species_id)
+                self.alias_table = None
+            if self.weights[species_id] != weight or self.rarities[species_id] != rarity:
+                self.weights[species_id] = weight
+                self.rarities[species_id] = rarity
+                self.alias_table = None
+        return species_id
+
+    def species_id(self, name):
+        species_id = self.ids.get(name)
+        if species_id is None:
+            species_id = self.add(name, catchable = False)
+        return species_id
+
+    def species_weight(self, species_id):
+        ''' Catch weight for species_id including the active boosts. '''
+        boosts = self.boosts
+        weight = self.weights[species_id]
+        if boosts:
+            weight *= boosts.get(self.names[species_id], 1.0) * boosts.get(self.rarities[species_id], 1.0)
+        return weight
+
+    def set_boosts(self, boosts):
+        ''' Sets the active boosts ({tier or name: multiplier}); the alias table is only rebuilt if they changed. '''
+        if boosts != self.boosts:
+            self.boosts = dict(boosts)
+            self.alias_table = None
+
+    def sampler(self):
+        ''' Returns the alias table over catchable_ids, building it if the weights changed since the last draw. '''
+        alias_table = self.alias_table
+        if alias_table is None:
+            alias_table = self.alias_table = AliasTable([self.species_weight(species_id) for species_id in self.catchable_ids])
+        return alias_table
+
+    def random_species(self):
+        return self.names[self.catchable_ids[self.sampler().sample()]]
+
+    def random_species_ids(self, count):
+        ''' Draws count catchable species ids (with replacement) in one step. '''
+        indexes = self.sampler().sample_array(count)
+        if numpy is not None:
+            return numpy.asarray(self.catchable_ids)[indexes].tolist()
+        catchable_ids = self.catchable_ids
+        return [catchable_ids[index] for index in indexes]
+
+    def names_for_bits(self, bits):
+        ''' Yields species names for each bit set in bits. '''
+        names = self.names
+        while bits:
+            low_bit = bits & -bits
+            yield names[low_bit.bit_length() - 1]
+            bits ^= low_bit
+
+    def completion_count(self, bits):
+        ''' Number of catchable species set in bits. '''
+        return popcount(bits & self.catchable_mask)
+
+    def reloaded(self, species):
+        '''
+            Returns a copy of the table where exactly species ((name, rarity, weight) tuples) are
+            catchable. Existing species keep their ids so FlowerDex bitsets stay valid, and the
+            active boosts carry over.
+        '''
+        pokedex = FlowermonsPokedex()
+        for name in self.names:
+            pokedex.add(name, catchable = False)
+        for name, rarity, weight in species:
+            pokedex.add(name, weight = weight, rarity = rarity)
+        pokedex.boosts = dict(self.boosts)
+        return pokedex
+
+    def __len__(self):
+        return len(self.catchable_ids)
+
+class FlowerDexEntry(object):
+    ''' Per-user FlowerDex data: caught and shiny species as bitsets indexed by species id. '''
+    __slots__ = ('caught', 'shiny')
+
+    def __init__(self):
+        self.caught = 0
+        self.shiny = 0
+
+class FlowermonsState(object):
+    '''
+        Flowermons data for one channel: the species table, per-user FlowerDex entries,
+        pokeball balances and both leaderboards.
+    '''
+    def __init__(self):
+        self.pokedex = FlowermonsPokedex()
+        self.user_pokedex = {}
+        self.user_pokeballs = {}
+        self.leaderboard = FlowerDexLeaderboard()
+        self.shiny_leaderboard = FlowerDexLeaderboard()
+
+    def rebuild_leaderboards(self):
+        ''' Rebuilds both leaderboards from user_pokedex in one pass. '''
+        self.leaderboard.rebuild(dict((user, self.pokedex.completion_count(entry.caught)) for user, entry in self.user_pokedex.items()))
+        self.shiny_leaderboard.rebuild(dict((user, popcount(entry.shiny)) for user, entry in self.user_pokedex.items()))
+
+    def update_leaderboards(self, usernames):
+        ''' Brings the leaderboards up to date for usernames after catches added with update_leaderboards = False. '''
+        for username in usernames:
+            user_pokedex_entry = self.user_pokedex[username]
+            self.leaderboard.update(username, self.pokedex.completion_count(user_pokedex_entry.caught))
+            self.shiny_leaderboard.update(username, popcount(user_pokedex_entry.shiny))
+
+    def add_pokemon_to_user_pokedex(self, username, pokemon, shiny_status, update_leaderboards = True):
+        '''
+            Adds pokemon (and shiny status) to the in-memory FlowerDex for user and updates the leaderboards.
+            Bulk loaders pass update_leaderboards = False and call rebuild_leaderboards() once at the end.
+        '''
+        user_pokedex_entry = self.user_pokedex.get(username)
+        if user_pokedex_entry is None:
+            user_pokedex_entry = self.user_pokedex[username] = FlowerDexEntry()
+        species_bit = 1 << self.pokedex.species_id(pokemon)
+
+        if not user_pokedex_entry.caught & species_bit:
+            user_pokedex_entry.caught |= species_bit
+            if update_leaderboards:
+                self.leaderboard.update(username, self.pokedex.completion_count(user_pokedex_entry.caught))
+        if shiny_status and not user_pokedex_entry.shiny & species_bit:
+            user_pokedex_entry.shiny |= species_bit
+            if update_leaderboards:
+                self.shiny_leaderboard.update(username, popcount(user_pokedex_entry.shiny))
+
+def replace_file_atomically(filename, lines, binary = False):
+    '''
+        Writes lines to a temp file and renames it over filename so readers never see a partial file.
+        The temp file and the directory entry are both fsynced, so the new contents survive a power loss.
+    '''
+    tmp_filename = filename + '.tmp'
+    with (open(tmp_filename, 'wb') if binary else open(tmp_filename, 'w', encoding = "utf8")) as tmp_file:
+        tmp_file.writelines(lines)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    os.replace(tmp_filename, filename)
+    fsync_directory(os.path.dirname(os.path.abspath(filename)))
+
+def fsync_directory(directory):
+    ''' Flushes a rename in directory to disk (not possible on Windows, where the rename is durable once it returns). '''
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    directory_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(directory_fd)
+    finally:
+        os.close(directory_fd)
+
+class FlowermonsStorage(object):
+    '''
+        Persistence interface for Flowermons user data (catches, shinies and pokeball balances).
+
+        load() fills the user_pokedex and user_pokeballs of the channel's FlowermonsState at startup. The
+        record_* methods are called from the chat loop for every change and must not block on I/O.
+    '''
+    def load(self):
+        raise NotImplementedError
+
+    def open(self):
+        pass
+
+    def record_catch(self, username, pokemon, shiny_status):
+        raise NotImplementedError
+
+    def record_pokeballs(self, username, num_balls):
+        raise NotImplementedError
+
+    def record_catches(self, catches, pokeballs):
+        '''
+            Persists a batch: catches is a list of (username, pokemon, shiny_status) and pokeballs
+            a list of (username, num_balls). Backends that can write a batch at once override this.
+        '''
+        for username, pokemon, shiny_status in catches:
+            self.record_catch(username, pokemon, shiny_status)
+        for username, num_balls in pokeballs:
+            self.record_pokeballs(username, num_balls)
+
+    def close(self):
+        pass
+
+class FlowermonsJournal(FlowermonsStorage):
+    '''
+        Append-only journal for Flowermons user data.
+
+        Every catch and pokeball balance change is appended to <user data file>.journal
+        so the cost of a catch does not depend on how large the user data file is.
+        A background thread periodically folds the journal into the snapshot files
+        (the user data file itself plus <user data file>.pokeballs).
+
+        Records are idempotent (catches are set additions and pokeball records hold the
+        absolute balance) so replaying a journal over a newer snapshot is always safe.
+
+        Durability: each record is flushed to the OS as soon as it is written, so it survives
+        the bot crashing or being killed, but not an OS crash or power loss until it is
+        compacted. Compaction fsyncs the snapshot files, the rewritten journal and their
+        directory before the compacted records are dropped from the journal.
+    '''
+    def __init__(self, flowermons, snapshot_filename, compaction_interval = FLOWERMONS_DEFAULT_COMPACTION_INTERVAL):
+        self.flowermons = flowermons
+        self.snapshot_filename = snapshot_filename
+        self.journal_filename = snapshot_filename + '.journal'
+        self.pokeballs_filename = snapshot_filename + '.pokeballs'
+        self.compaction_interval = compaction_interval
+        self.lock = threading.Lock()
+        self.journal_file = None
+        self.pending_records = 0
+        self.stopped = threading.Event()
+        self.compaction_thread = None
+        self.on_compacted = None # called with (pokedex, user_pokedex_items, user_pokeballs_items) after each compaction
+
+    def load(self):
+        '''
+            Loads the Flowermons user data snapshot and replays any journal records
+            written since the last compaction (i.e., after a crash or restart).
+        '''
+        self.load_user_data_snapshot()
+        self.load_pokeballs_snapshot()
+        self.load_journal()
+
+    def load_user_data_snapshot(self):
+        ''' Loads catches from the user data snapshot file. '''
+        if not os.path.exists(self.snapshot_filename):
+            return
+        with open(self.snapshot_filename, 'r', encoding = "utf8") as flowermons_user_data_file:
+            for line in flowermons_user_data_file.readlines():
+                data = list(map(lambda x: x.strip().lower(), line.split('\t')))
+                self.flowermons.add_pokemon_to_user_pokedex(data[0], data[1], ('SHINY' in line), update_leaderboards = False)
+
+    def load_journal(self):
+        ''' Replays journal records on top of the snapshot files (or state decoded from a binary snapshot of them). '''
+        replayed = self.replay()
+        if replayed > 0:
+            print('Recovered %s Flowermons journal record(s)' % (replayed), file = OUTPUT_FILE)
+
+    def load_pokeballs_snapshot(self):
+        ''' Loads pokeball balances from the pokeballs snapshot file. '''
+        if not os.path.exists(self.pokeballs_filename):
+            return
+        with open(self.pokeballs_filename, 'r', encoding = "utf8") as pokeballs_file:
+            for line in pokeballs_file:
+                data = line.rstrip('\n').split('\t')
+                if len(data) == 2:
+                    self.flowermons.user_pokeballs[data[0]] = int(data[1])
+
+    def replay(self):
+        '''
+            Replays journal records on top of the loaded snapshot.
+            A torn final record (i.e., crash mid-write) has no trailing newline and is discarded.
+        '''
+        if not os.path.exists(self.journal_filename):
+            return 0
+        replayed = 0
+        valid_length = 0
+        with open(self.journal_filename, 'rb') as journal_file:
+            for raw_line in journal_file:
+                if not raw_line.endswith(b'\n'):
+                    print('Discarding incomplete Flowermons journal record: %s' % (raw_line), file = ERROR_FILE)
+                    break
+                valid_length += len(raw_line)
+                self.apply_record(raw_line.decode('utf-8').rstrip('\n').split('\t'))
+                replayed += 1
+        if valid_length != os.path.getsize(self.journal_filename):
+            with open(self.journal_filename, 'r+b') as journal_file:
+                journal_file.truncate(valid_length)
+        return replayed
+
+    def apply_record(self, record):
+        if record[0] == JOURNAL_CATCH_RECORD and len(record) >= 3:
+            self.flowermons.add_pokemon_to_user_pokedex(record[1], record[2], (len(record) > 3 and record[3] == 'SHINY'), update_leaderboards = False)
+        elif record[0] == JOURNAL_POKEBALLS_RECORD and len(record) == 3:
+            self.flowermons.user_pokeballs[record[1]] = int(record[2])
+
+    def open(self):
+        ''' Opens the journal for appending and starts the background compaction thread. '''
+        self.journal_file = open(self.journal_filename, 'ab')
+        self.compaction_thread = threading.Thread(target = self.run_compaction_loop, name = 'flowermons-compaction')
+        self.compaction_thread.daemon = True
+        self.compaction_thread.start()
+
+    def append(self, *fields):
+        ''' Appends a single record to the journal. Cost is constant regardless of snapshot size. '''
+        with self.lock:
+            self.journal_file.write(('\t'.join(map(str, fields)) + '\n').encode('utf-8'))
+            self.journal_file.flush()
+            self.pending_records += 1
+
+    def append_records(self, records):
+        ''' Appends several records with a single write and flush. '''
+        data = ''.join('\t'.join(map(str, fields)) + '\n' for fields in records).encode('utf-8')
+        with self.lock:
+            self.journal_file.write(data)
+            self.journal_file.flush()
+            self.pending_records += len(records)
+
+    def record_catch(self, username, pokemon, shiny_status):
+        self.append(JOURNAL_CATCH_RECORD, username, pokemon, ('SHINY' if shiny_status else ''))
+
+    def record_catches(self, catches, pokeballs):
+        records = [(JOURNAL_CATCH_RECORD, username, pokemon, ('SHINY' if shiny_status else '')) for username, pokemon, shiny_status in catches]
+        records.extend((JOURNAL_POKEBALLS_RECORD, username, num_balls) for username, num_balls in pokeballs)
+        if records:
+            self.append_records(records)
+
+    def record_pokeballs(self, username, num_balls):
+        self.append(JOURNAL_POKEBALLS_RECORD, username, num_balls)
+
+    def run_compaction_loop(self):
+        while not self.stopped.wait(self.compaction_interval):
+            try:
+                self.compact()
+            except Exception as e:
+                print('Flowermons journal compaction failed: %s' % (e), file = ERROR_FILE)
+
+    def compact(self):
+        '''
+            Folds the journal into the snapshot files.
+            The journal offset is taken before the in-memory state is copied, so every record
+            dropped from the journal is guaranteed to be part of the snapshot written.
+        '''
+        with self.lock:
+            if self.journal_file is None or self.pending_records == 0:
+                return
+            self.journal_file.flush()
+            compacted_offset = self.journal_file.tell()
+            compacted_records = self.pending_records
+
+        # list() over dict items runs without releasing the GIL and each entry is a pair of ints,
+        # so the copy is consistent per user
+        user_pokedex_items = [(user, entry.caught, entry.shiny) for user, entry in list(self.flowermons.user_pokedex.items())]
+        user_pokeballs_items = list(self.flowermons.user_pokeballs.items())
+        pokedex = self.flowermons.pokedex
+        snapshot_lines = []
+        for user, caught, shiny in user_pokedex_items:
+            for pokemon in pokedex.names_for_bits(caught & ~shiny):
+                snapshot_lines.append('%s\t%s\t\n' % (user, pokemon))
+            for pokemon in pokedex.names_for_bits(shiny):
+                snapshot_lines.append('%s\t%s\tSHINY\n' % (user, pokemon))
+        replace_file_atomically(self.snapshot_filename, snapshot_lines)
+        replace_file_atomically(self.pokeballs_filename, ['%s\t%s\n' % (user, num_balls) for user, num_balls in user_pokeballs_items])
+
+        # keep only the records appended while the snapshot was being written
+        with self.lock:
+            self.journal_file.flush()
+            with open(self.journal_filename, 'rb') as journal_file:
+                journal_file.seek(compacted_offset)
+                remaining_records = journal_file.read().decode('utf-8')
+            self.journal_file.close()
+            replace_file_atomically(self.journal_filename, [remaining_records])
+            self.journal_file = open(self.journal_filename, 'ab')
+            # records appended while the snapshot was written are still in the journal and still pending
+            self.pending_records -= compacted_records
+        if self.on_compacted is not None:
+            self.on_compacted(pokedex, user_pokedex_items, user_pokeballs_items)
+
+    def close(self):
+        ''' Stops the compaction thread and folds any outstanding records into the snapshot. '''
+        self.stopped.set()
+        if self.compaction_thread is not None:
+            self.compaction_thread.join()
+        self.compact()
+        with self.lock:
+            if self.journal_file is not None:
+                self.journal_file.close()
+                self.journal_file = None
+
+class SqlFlowermonsStorage(FlowermonsStorage):
+    '''
+        Base for database-backed Flowermons storage.
+
+        Changes are queued by the chat loop and written by a single writer thread in batched
+        transactions, so a slow database never blocks chat. Within a batch only the latest
+        pokeball balance per user is written and catches are upserted (shiny status never
+        goes back to false). A batch that still fails after its retries is kept and written
+        together with the next one; only records that cannot be written by shutdown are lost
+        (and logged). Subclasses provide connections and dialect-specific SQL.
+    '''
+    param = '?'
+    create_statements = []
+    upsert_catch_statement = None
+    upsert_pokeballs_statement = None
+    retry_delay = 1 # seconds before the first retry of a failed write, doubling after each attempt
+
+    def __init__(self, flowermons, legacy_user_data_filename = None):
+        self.flowermons = flowermons
+        self.legacy_user_data_filename = legacy_user_data_filename
+        self.records = queue.Queue()
+        self.writer = None
+
+    def acquire_connection(self):
+        raise NotImplementedError
+
+    def release_connection(self, connection):
+        pass
+
+    def load(self):
+        connection = self.acquire_connection()
+        try:
+            cursor = connection.cursor()
+            for statement in self.create_statements:
+                cursor.execute(statement)
+            connection.commit()
+            cursor.execute('SELECT username, pokemon, shiny FROM flowermons_catches')
+            catches = cursor.fetchall()
+            cursor.execute('SELECT username, balance FROM flowermons_pokeballs')
+            pokeballs = cursor.fetchall()
+        finally:
+            self.release_connection(connection)
+
+        if len(catches) == 0 and len(pokeballs) == 0 and self.legacy_user_data_filename and os.path.exists(self.legacy_user_data_filename):
+            self.import_legacy_user_data()
+            return
+        for username, pokemon, shiny in catches:
+            self.flowermons.add_pokemon_to_user_pokedex(username, pokemon, bool(shiny), update_leaderboards = False)
+        for username, balance in pokeballs:
+            self.flowermons.user_pokeballs[username] = int(balance)
+
+    def import_legacy_user_data(self):
+        ''' One-time import of the file-based user data (snapshot plus journal) into an empty database. '''
+        FlowermonsJournal(self.flowermons, self.legacy_user_data_filename).load()
+        pokedex = self.flowermons.pokedex
+        for user, entry in self.flowermons.user_pokedex.items():
+            for pokemon in pokedex.names_for_bits(entry.caught):
+                self.records.put((JOURNAL_CATCH_RECORD, user, pokemon, bool(entry.shiny & (1 << pokedex.species_id(pokemon)))))
+        for user, num_balls in self.flowermons.user_pokeballs.items():
+            self.records.put((JOURNAL_POKEBALLS_RECORD, user, num_balls))
+        print('Importing %s Flowermons record(s) from %s' % (self.records.qsize(), self.legacy_user_data_filename), file = OUTPUT_FILE)
+
+    def open(self):
+        self.writer = threading.Thread(target = self.run_writer, name = 'flowermons-storage')
+        self.writer.daemon = True
+        self.writer.start()
+
+    def record_catch(self, username, pokemon, shiny_status):
+        self.records.put((JOURNAL_CATCH_RECORD, username, pokemon, shiny_status))
+
+    def record_pokeballs(self, username, num_balls):
+        self.records.put((JOURNAL_POKEBALLS_RECORD, username, num_balls))
+
+    def run_writer(self):
+        stopping = False
+        unwritten = []
+        while not stopping:
+            try:
+                batch = [self.records.get(timeout = (STORAGE_RETRY_INTERVAL if unwritten else None))]
+            except queue.Empty:
+                batch = []
+            while len(batch) < STORAGE_BATCH_SIZE:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            if None in batch:
+                stopping = True
+                batch = [record for record in batch if record is not None]
+            batch = unwritten + batch
+            if batch:
+                unwritten = ([] if self.write_batch(batch) else batch)
+        # one more round of retries at shutdown, even if the failed batch arrived together with the stop request
+        if unwritten and not self.write_batch(unwritten):
+            print('Lost %s Flowermons record(s) that could not be written before shutdown' % (len(unwritten)), file = ERROR_FILE)
+
+    def write_batch(self, batch):
+        ''' Writes batch in a single transaction, retrying with backoff. Returns False if every attempt failed. '''
+        catches = {}
+        pokeballs = {}
+        for record in batch:
+            if record[0] == JOURNAL_CATCH_RECORD:
+                key = (record[1], record[2])
+                catches[key] = int(catches.get(key, 0) or record[3])
+            else:
+                pokeballs[record[1]] = record[2]
+
+        for attempt in range(STORAGE_WRITE_RETRIES):
+            connection = None
+            try:
+                connection = self.acquire_connection()
+                cursor = connection.cursor()
+                if catches:
+                    cursor.executemany(self.upsert_catch_statement, [(username, pokemon, shiny) for (username, pokemon), shiny in catches.items()])
+                if pokeballs:
+                    cursor.executemany(self.upsert_pokeballs_statement, list(pokeballs.items()))
+                connection.commit()
+                return True
+            except Exception as e:
+                print('Failed to write %s Flowermons record(s) (attempt %s): %s' % (len(batch), attempt + 1, e), file = ERROR_FILE)
+                if connection is not None:
+                    try:
+                        connection.rollback()
+                    except Exception:
+                        pass
+                time.sleep(self.retry_delay * 2 ** attempt)
+            finally:
+                if connection is not None:
+                    self.release_connection(connection)
+        print('Keeping %s Flowermons record(s) to retry after %s failed attempts' % (len(batch), STORAGE_WRITE_RETRIES), file = ERROR_FILE)
+        return False
+
+    def close(self):
+        ''' Flushes queued records and stops the writer thread. '''
+        if self.writer is not None:
+            self.records.put(None)
+            self.writer.join()
+            self.writer = None
+
+class SqliteFlowermonsStorage(SqlFlowermonsStorage):
+    ''' Embedded SQLite storage in WAL mode, so reads never wait on the writer thread. '''
+    create_statements = [
+        'CREATE TABLE IF NOT EXISTS flowermons_catches (username TEXT NOT NULL, pokemon TEXT NOT NULL, shiny INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (username, pokemon))',
+        'CREATE TABLE IF NOT EXISTS flowermons_pokeballs (username TEXT NOT NULL PRIMARY KEY, balance INTEGER NOT NULL)'
+    ]
+    upsert_catch_statement = 'INSERT INTO flowermons_catches (username, pokemon, shiny) VALUES (?, ?, ?) ON CONFLICT (username, pokemon) DO UPDATE SET shiny = MAX(shiny, excluded.shiny)'
+    upsert_pokeballs_statement = 'INSERT INTO flowermons_pokeballs (username, balance) VALUES (?, ?) ON CONFLICT (username) DO UPDATE SET balance = excluded.balance'
+
+    def __init__(self, flowermons, sqlite_filename, legacy_user_data_filename = None):
+        SqlFlowermonsStorage.__init__(self, flowermons, legacy_user_data_filename)
+        self.sqlite_filename = sqlite_filename
+        self.connection = None
+
+    def acquire_connection(self):
+        # a single connection is shared by load() and then the writer thread, never both at once
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.sqlite_filename, check_same_thread = False)
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+        return self.connection
+
+    def close(self):
+        SqlFlowermonsStorage.close(self)
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+class MySQLConnectionPool(object):
+    ''' Small pool of MySQL connections; dead connections are replaced on checkout. '''
+    def __init__(self, connect_args, size = DEFAULT_DB_POOL_SIZE):
+        self.connect_args = connect_args
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.lock = threading.Lock()
+        self.created = 0
+
+    def acquire(self, timeout = 30):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                create = (self.created < self.size)
+                if create:
+                    self.created += 1
+            if create:
+                try:
+                    return MySQLdb.connect(**self.connect_args)
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            connection = self.idle.get(timeout = timeout)
+        try:
+            connection.ping()
+        except Exception:
+            connection = MySQLdb.connect(**self.connect_args)
+        return connection
+
+    def release(self, connection):
+        self.idle.put(connection)
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                break
+
+class MySQLFlowermonsStorage(SqlFlowermonsStorage):
+    ''' MySQL storage using the db.* properties and a small connection pool. '''
+    create_statements = [
+        'CREATE TABLE IF NOT EXISTS flowermons_catches (username VARCHAR(64) NOT NULL, pokemon VARCHAR(64) NOT NULL, shiny TINYINT NOT NULL DEFAULT 0, PRIMARY KEY (username, pokemon))',
+        'CREATE TABLE IF NOT EXISTS flowermons_pokeballs (username VARCHAR(64) NOT NULL PRIMARY KEY, balance INT NOT NULL)'
+    ]
+    upsert_catch_statement = 'INSERT INTO flowermons_catches (username, pokemon, shiny) VALUES (%s, %s, %s) ON DUPLICATE KEY UPDATE shiny = GREATEST(shiny, VALUES(shiny))'
+    upsert_pokeballs_statement = 'INSERT INTO flowermons_pokeballs (username, balance) VALUES (%s, %s) ON DUPLICATE KEY UPDATE balance = VALUES(balance)'
+
+    def __init__(self, flowermons, properties, legacy_user_data_filename = None):
+        SqlFlowermonsStorage.__init__(self, flowermons, legacy_user_data_filename)
+        if MySQLdb is None:
+            print('MySQLdb is required for flowermons.storage=mysql, please install mysqlclient', file = ERROR_FILE)
+            sys.exit(2)
+        connect_args = {
+            'host': properties.get(DB_HOST, 'localhost'),
+            'db': properties.get(DB_NAME, ''),
+            'user': properties.get(DB_USER, ''),
+            'passwd': properties.get(DB_PASSWORD, ''),
+            'port': int(properties.get(DB_PORT) or 3306),
+            'charset': 'utf8mb4'
+        }
+        self.pool = MySQLConnectionPool(connect_args, int(properties.get(DB_POOL_SIZE) or DEFAULT_DB_POOL_SIZE))
+
+    def acquire_connection(self):
+        return self.pool.acquire()
+
+    def release_connection(self, connection):
+        self.pool.release(connection)
+
+    def close(self):
+        SqlFlowermonsStorage.close(self)
+        self.pool.close()
+
+def normalize_message_text(value):
+    ''' Normalizes chat text for keyword matching (ascii only, lowercase, single spaces). '''
+    return ' '.join(encode_ascii_string(value).lower().split())
+
+def tokenize_message_text(value):
+    ''' Splits normalized chat text into word tokens (a leading '!' is kept so "!discord" stays one token). '''
+    return KEYWORD_TOKEN_PATTERN.findall(value)
+
+class KeywordMatcher(object):
+    '''
+        Word-level Aho-Corasick automaton over the auto bot response triggers.
+
+        The automaton is compiled once from the auto bot responses file and finds every
+        trigger phrase in a message in a single pass over its words, regardless of how many
+        triggers there are. Transitions are keyed by whole words, so matches always start
+        and end on a word boundary ("hi" does not match inside "this").
+    '''
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.outputs = [[]]
+        for phrase in phrases:
+            self.add_phrase(phrase)
+        self.build_failure_links()
+
+    def add_phrase(self, phrase):
+        tokens = tokenize_message_text(phrase)
+        if not tokens:
+            return
+        state = 0
+        for token in tokens:
+            next_state = self.goto[state].get(token)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][token] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.outputs.append([])
+            state = next_state
+        if phrase not in self.outputs[state]:
+            self.outputs[state].append(phrase)
+
+    def build_failure_links(self):
+        ''' Breadth-first pass linking each state to its longest proper suffix state. '''
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for token, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and token not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(token, 0)
+                self.outputs[next_state] = self.outputs[next_state] + self.outputs[self.fail[next_state]]
+
+    def find_all(self, text):
+        ''' Returns unique trigger phrases found in (already normalized) text, in order of appearance. '''
+        goto = self.goto
+        fail = self.fail
+        outputs = self.outputs
+        matches = []
+        state = 0
+        for token in tokenize_message_text(text):
+            while state and token not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(token, 0)
+            for phrase in outputs[state]:
+                if phrase not in matches:
+                    matches.append(phrase)
+        return matches
+
+def event_tags(e):
+    ''' Returns the IRCv3 tags of an irc library event as a dict. '''
+    return dict((d['key'], d['value']) for d in (e.tags or ()))
+
+class AutoBotResponses(object):
+    '''
+        Auto bot responses keyed by normalized trigger message, plus the keyword matcher
+        compiled over those triggers. Never modified once built, so a reload swaps in a
+        new instance and handlers always see a matching dict and matcher.
+    '''
+    __slots__ = ('responses', 'matcher')
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.matcher = KeywordMatcher(responses.keys())
+
+def file_signature(filename):
+    ''' Returns (mtime, size) for filename, or None if it does not exist. '''
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size)
+
+class DataFileWatcher(object):
+    '''
+        Polls data files for changes on a background thread (mtime and size, so no extra
+        dependency is needed for inotify/kqueue). When a file changes every reload function
+        registered for it is called with the file's modification time, from the watcher thread.
+        A failed reload is reported and the previous data stays in use.
+    '''
+    def __init__(self, interval = DATA_FILE_POLL_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.watched = {}
+        self.worker = None
+
+    def watch(self, filename, reload):
+        with self.lock:
+            if filename not in self.watched:
+                self.watched[filename] = [file_signature(filename), []]
+            self.watched[filename][1].append(reload)
+            if self.worker is None:
+                self.worker = threading.Thread(target = self.run, name = 'flowerbot-data-files')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.check()
+
+    def check(self):
+        with self.lock:
+            watched = list(self.watched.items())
+        for filename, entry in watched:
+            signature = file_signature(filename)
+            if signature is None or signature == entry[0]:
+                continue
+            entry[0] = signature
+            for reload in list(entry[1]):
+                try:
+                    reload(signature[0] / 1e9)
+                except Exception as e:
+                    print('Failed to reload %s, keeping the previous data: %s' % (filename, e), file = ERROR_FILE)
+
+DATA_FILE_WATCHER = DataFileWatcher()
+
+def data_file_sources(*filenames):
+    ''' Returns (filename, mtime, size) for each file; missing files are recorded with -1s. '''
+    return [(filename,) + (file_signature(filename) or (-1, -1)) for filename in filenames]
+
+def pack_fields(fields):
+    ''' Packs byte strings into one buffer as length-prefixed fields. '''
+    return b''.join(struct.pack('<Q', len(field)) + bytes(field) for field in fields)
+
+def unpack_fields(buffer):
+    ''' Splits a buffer written by pack_fields() back into fields (memoryview slices, no copies). '''
+    buffer = memoryview(buffer)
+    fields = []
+    offset = 0
+    while offset < len(buffer):
+        (length,) = struct.unpack_from('<Q', buffer, offset)
+        offset += 8
+        if offset + length > len(buffer):
+            raise ValueError('truncated snapshot field')
+        fields.append(buffer[offset:offset + length])
+        offset += length
+    return fields
+
+def pack_strings(strings):
+    return SNAPSHOT_STRING_SEPARATOR.join(strings).encode('utf-8')
+
+def unpack_strings(field):
+    return str(field, 'utf-8').split(SNAPSHOT_STRING_SEPARATOR) if len(field) else []
+
+def pack_int_array(typecode, values):
+    values = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+def unpack_int_array(typecode, field):
+    values = array.array(typecode)
+    values.frombytes(field)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+def encode_auto_shoutout_users(approved_auto_shoutout_users):
+    return pack_strings(list(approved_auto_shoutout_users.keys()))
+
+def decode_auto_shoutout_users(payload):
+    return dict.fromkeys(unpack_strings(payload), False)
+
+def encode_custom_shoutouts(custom_user_shoutouts):
+    items = list(custom_user_shoutouts.items())
+    return pack_fields([pack_strings([user for user, message in items]), pack_strings([message for user, message in items])])
+
+def decode_custom_shoutouts(payload):
+    users, messages = unpack_fields(payload)
+    return dict(zip(unpack_strings(users), unpack_strings(messages)))
+
+def encode_autobot_responses(autobot_responses):
+    items = list(autobot_responses.responses.items())
+    return pack_fields([
+        pack_strings([message for message, bot_responses in items]),
+        pack_int_array('I', [len(bot_responses) for message, bot_responses in items]),
+        pack_strings([response for message, bot_responses in items for response in bot_responses])
+    ])
+
+def decode_autobot_responses(payload):
+    messages, counts, bot_responses = unpack_fields(payload)
+    bot_responses = unpack_strings(bot_responses)
+    responses = {}
+    offset = 0
+    for message, count in zip(unpack_strings(messages), unpack_int_array('I', counts)):
+        responses[message] = bot_responses[offset:offset + count]
+        offset += count
+    return AutoBotResponses(responses)
+
+def encode_flowermons_state(pokedex, user_pokedex_items, user_pokeballs_items):
+    '''
+        Species table, FlowerDex bitsets (user, caught, shiny) and pokeball balances (user, balls).
+        Bitsets are stored as fixed-width little-endian blocks, so decoding is one slice per
+        user, not one dict lookup per catch.
+    '''
+    names = list(pokedex.names)
+    width = (len(names) + 7) // 8
+    return pack_fields([
+        pack_strings(names),
+        pack_int_array('d', pokedex.weights),
+        pack_strings(pokedex.rarities),
+        pack_int_array('I', pokedex.catchable_ids),
+        pack_strings([user for user, caught, shiny in user_pokedex_items]),
+        struct.pack('<I', width),
+        b''.join(caught.to_bytes(width, 'little') for user, caught, shiny in user_pokedex_items),
+        b''.join(shiny.to_bytes(width, 'little') for user, caught, shiny in user_pokedex_items),
+        pack_strings([user for user, num_balls in user_pokeballs_items]),
+        pack_int_array('q', [num_balls for user, num_balls in user_pokeballs_items])
+    ])
+
+def decode_flowermons_state(payload):
+    ''' Returns a FlowermonsState (leaderboards not built) from encode_flowermons_state() output. '''
+    names, weights, rarities, catchable_ids, users, width, caught, shiny, pokeball_users, balances = unpack_fields(payload)
+    flowermons = FlowermonsState()
+    pokedex = flowermons.pokedex
+    pokedex.names = unpack_strings(names)
+    pokedex.ids = dict(zip(pokedex.names, range(len(pokedex.names))))
+    pokedex.weights = unpack_int_array('d', weights).tolist()
+    pokedex.rarities = unpack_strings(rarities) or [''] * len(pokedex.names) # a lone species with an explicit weight packs to nothing
+    if len(pokedex.weights) != len(pokedex.names) or len(pokedex.rarities) != len(pokedex.names):
+        raise ValueError('Flowermons species weights do not match the species list')
+    for species_id in unpack_int_array('I', catchable_ids):
+        pokedex.catchable_ids.append(species_id)
+        pokedex.catchable_mask |= (1 << species_id)
+
+    (width,) = struct.unpack('<I', width)
+    from_bytes = int.from_bytes
+    user_pokedex = flowermons.user_pokedex
+    offset = 0
+    for user in unpack_strings(users):
+        user_pokedex_entry = user_pokedex[user] = FlowerDexEntry()
+        user_pokedex_entry.caught = from_bytes(caught[offset:offset + width], 'little')
+        user_pokedex_entry.shiny = from_bytes(shiny[offset:offset + width], 'little')
+        offset += width
+    if offset != len(caught) or offset != len(shiny):
+        raise ValueError('FlowerDex bitsets do not match the user list')
+    flowermons.user_pokeballs = dict(zip(unpack_strings(pokeball_users), unpack_int_array('q', balances)))
+    return flowermons
+
+class ChannelSnapshot(object):
+    '''
+        Versioned binary snapshot of a channel's loaded data, so startup does not have to
+        re-parse every text data file.
+
+        The text files stay the source of truth. Each section records the (mtime, size) of
+        the files it was built from and is only used while all of them are unchanged; a
+        snapshot written by a different format version is ignored entirely. The file is read
+        with a single bulk read and sections are decoded from slices of that buffer.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.sections = {}
+
+    def load(self):
+        ''' Reads the snapshot file. Returns False if it is missing, from another version or unreadable. '''
+        try:
+            with open(self.filename, 'rb') as snapshot_file:
+                buffer = memoryview(snapshot_file.read())
+        except OSError:
+            return False
+        try:
+            if bytes(buffer[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+                raise ValueError('not a flowerbot snapshot')
+            version, num_sections = struct.unpack_from('<HI', buffer, len(SNAPSHOT_MAGIC))
+            if version != SNAPSHOT_VERSION:
+                print('Snapshot %s is format version %s (expected %s), rebuilding it' % (self.filename, version, SNAPSHOT_VERSION), file = OUTPUT_FILE)
+                return False
+            fields = unpack_fields(buffer[len(SNAPSHOT_MAGIC) + struct.calcsize('<HI'):])
+            if len(fields) != 3 * num_sections:
+                raise ValueError('expected %s sections' % (num_sections))
+            sections = {}
+            for index in range(0, len(fields), 3):
+                filenames, signatures = unpack_fields(fields[index + 1])
+                signatures = unpack_int_array('q', signatures)
+                sources = [(filename, signatures[2 * n], signatures[2 * n + 1]) for n, filename in enumerate(unpack_strings(filenames))]
+                sections[str(fields[index], 'utf-8')] = (sources, fields[index + 2])
+        except (ValueError, IndexError, struct.error, UnicodeDecodeError) as e:
+            print('Ignoring unreadable snapshot %s: %s' % (self.filename, e), file = ERROR_FILE)
+            return False
+        with self.lock:
+            self.sections = sections
+        return True
+
+    def get(self, name, sources):
+        ''' Returns the payload of section name if it was built from exactly sources, otherwise None. '''
+        with self.lock:
+            section = self.sections.get(name)
+        if section is None or section[0] != sources:
+            return None
+        return section[1]
+
+    def put(self, name, sources, payload):
+        with self.lock:
+            self.sections[name] = (sources, payload)
+
+    def save(self):
+        ''' Writes every section to disk; the lock is held throughout so concurrent saves never share the temp file. '''
+        with self.lock:
+            fields = []
+            for name, (sources, payload) in sorted(self.sections.items()):
+                fields.append(name.encode('utf-8'))
+                fields.append(pack_fields([pack_strings([source[0] for source in sources]), pack_int_array('q', [value for source in sources for value in source[1:]])]))
+                fields.append(payload)
+            header = SNAPSHOT_MAGIC + struct.pack('<HI', SNAPSHOT_VERSION, len(self.sections))
+            replace_file_atomically(self.filename, [header, pack_fields(fields)], binary = True)
+
+class TTLCache(object):
+    '''
+        Thread-safe LRU cache whose entries also expire ttl seconds after they were stored.
+        The least recently used entry is evicted once max_size is reached.
+    '''
+    def __init__(self, max_size, ttl, clock = time.monotonic):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            if entry[0] <= self.clock():
+                del self.entries[key]
+                return default
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (self.clock() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last = False)
+
+    def __len__(self):
+        return len(self.entries)
+
+class HelixChannelInfo(object):
+    ''' What shoutouts need to know about a twitch user; user_id is None if the user does not exist. '''
+    __slots__ = ('login', 'user_id', 'game', 'teams')
+
+    def __init__(self, login, user_id = None, game = None, teams = ()):
+        self.login = login
+        self.user_id = user_id
+        self.game = game
+        self.teams = teams
+
+class HelixClient(object):
+    '''
+        Twitch Helix API client for shoutout enrichment (user id, last game played and teams).
+
+        Lookups never block the caller: lookup() answers from the TTL/LRU cache or queues
+        the login for a background thread, which collects whatever else is queued (up to the
+        100 logins Helix allows per request), resolves them with one batched users call and
+        one batched channels call over a pooled session, and then runs the callbacks on its
+        own thread. Rate limited (429) and server error responses are retried with backoff,
+        honoring the Ratelimit-Reset and Retry-After headers. If a batch fails for any reason
+        its callbacks get None and the thread carries on with the next batch.
+    '''
+    def __init__(self, client_id, token, url = HELIX_API_URL, fetch_teams = False, cache_ttl = HELIX_CACHE_TTL, cache_size = HELIX_CACHE_SIZE, session = None):
+        self.url = url.rstrip('/')
+        self.fetch_teams = fetch_teams
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.session = session or requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, pool_maxsize = HELIX_POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Client-Id': client_id, 'Authorization': 'Bearer ' + token.replace('oauth:', '', 1)})
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.logins = queue.Queue()
+        self.worker = None
+        self.rate_limited_until = 0
+
+    def lookup(self, login, callback = None):
+        '''
+            Calls callback(HelixChannelInfo, or None if the lookup failed) right away when login
+            is cached, otherwise later from the lookup thread. Without a callback it is a prefetch.
+        '''
+        login = login.lower()
+        channel_info = self.cache.get(login)
+        if channel_info is not None:
+            if callback is not None:
+                callback(channel_info)
+            return
+        with self.lock:
+            callbacks = self.pending.get(login)
+            if callbacks is None:
+                callbacks = self.pending[login] = []
+                self.logins.put(login)
+            if callback is not None:
+                callbacks.append(callback)
+            if self.worker is None:
+                self.worker = threading.Thread(target = self.run, name = 'helix-lookups')
+                self.worker.daemon = True
+                self.worker.start()
+
+    def run(self):
+        while True:
+            batch = [self.logins.get()]
+            # give logins queued by the same burst of chat a moment to join this batch
+            deadline = time.monotonic() + HELIX_BATCH_WINDOW
+            while len(batch) < HELIX_MAX_BATCH_SIZE:
+                try:
+                    batch.append(self.logins.get(timeout = max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                channel_infos = self.fetch_channel_infos(batch)
+            except Exception as e:
+                print('Helix lookup failed for %s: %s' % (', '.join(batch), e), file = ERROR_FILE)
+                channel_infos = {}
+            for login in batch:
+                channel_info = channel_infos.get(login)
+                if channel_info is not None:
+                    self.cache.put(login, channel_info)
+                with self.lock:
+                    callbacks = self.pending.pop(login, [])
+                for callback in callbacks:
+                    try:
+                        callback(channel_info)
+                    except Exception as e:
+                        print('Helix lookup callback for %s failed: %s' % (login, e), file = ERROR_FILE)
+
+    def fetch_channel_infos(self, logins):
+        ''' Returns login -> HelixChannelInfo for up to HELIX_MAX_BATCH_SIZE logins. '''
+        channel_infos = dict((login, HelixChannelInfo(login)) for login in logins)
+        for user in self.get('users', [('login', login) for login in logins]):
+            if user['login'] in channel_infos:
+                channel_infos[user['login']].user_id = user['id']
+        user_ids = dict((channel_info.user_id, channel_info) for channel_info in channel_infos.values() if channel_info.user_id is not None)
+        if user_ids:
+            for channel in self.get('channels', [('broadcaster_id', user_id) for user_id in user_ids]):
+                if channel['broadcaster_id'] in user_ids:
+                    user_ids[channel['broadcaster_id']].game = channel.get('game_name') or None
+        if self.fetch_teams:
+            # helix has no batched teams endpoint
+            for user_id, channel_info in user_ids.items():
+                channel_info.teams = tuple(team['team_name'].lower() for team in self.get('teams/channel', [('broadcaster_id', user_id)]))
+        return channel_infos
+
+    def get(self, path, params):
+        ''' GETs a Helix endpoint and returns its data list, retrying rate limited and failed requests. '''
+        for attempt in range(HELIX_MAX_RETRIES + 1):
+            wait = self.rate_limited_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            response = self.session.get('%s/%s' % (self.url, path), params = params, timeout = HELIX_REQUEST_TIMEOUT)
+            reset = response.headers.get('Ratelimit-Reset')
+            if reset is not None and response.headers.get('Ratelimit-Remaining') == '0':
+                self.rate_limited_until = float(reset)
+            if response.status_code == 429 or response.status_code >= 500:
+                backoff = min(HELIX_BACKOFF_MIN_DELAY * 2 ** attempt, HELIX_BACKOFF_MAX_DELAY)
+                retry_after = response.headers.get('Retry-After')
+                if response.status_code == 429 and (reset is not None or retry_after is not None):
+                    self.rate_limited_until = max(self.rate_limited_until, float(reset or 0), time.time() + float(retry_after or 0), time.time() + backoff)
+                else:
+                    time.sleep(backoff)
+                print('Helix %s returned %s, retrying' % (path, response.status_code), file = ERROR_FILE)
+                continue
+            response.raise_for_status()
+            return response.json().get('data') or []
+        response.raise_for_status()
+
+HELIX_CLIENTS = {}
+HELIX_CLIENTS_LOCK = threading.Lock()
+
+def helix_client(client_id, token, url, fetch_teams, cache_ttl):
+    ''' Returns the HelixClient shared by every channel using the same credentials, so lookups batch and cache across channels. '''
+    key = (client_id, token, url, fetch_teams, cache_ttl)
+    with HELIX_CLIENTS_LOCK:
+        client = HELIX_CLIENTS.get(key)
+        if client is None:
+            client = HELIX_CLIENTS[key] = HelixClient(client_id, token, url, fetch_teams, cache_ttl)
+        return client
+
+def format_metric_labels(label_names, labels):
+    ''' Returns the Prometheus label set for labels, i.e., {channel="#xcornflowerx"}. '''
+    if not label_names:
+        return ''
+    escaped = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels]
+    return '{%s}' % (','.join('%s="%s"' % (name, value) for name, value in zip(label_names, escaped)))
+
+class Counter(object):
+    '''
+        Monotonic counter per label set (a tuple of label values, in label_names order).
+        Updates are a dict lookup and an add with no lock: they happen on the chat thread,
+        and a rare lost update from another thread is an acceptable price for the speed.
+    '''
+    metric_type = 'counter'
+
+    def __init__(self, name, help, label_names = ()):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.values = {}
+
+    def inc(self, labels = (), amount = 1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def samples(self):
+        return [(self.name, labels, value) for labels, value in list(self.values.items())]
+
+    def summary(self):
+        return dict((','.join(labels), value) for labels, value in list(self.values.items()))
+
+class CallbackMetric(object):
+    ''' Gauge (or counter kept elsewhere, i.e., by the outbound scheduler) read from a function when collected. '''
+    def __init__(self, name, help, label_names = (), metric_type = 'gauge'):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.metric_type = metric_type
+        self.functions = {}
+
+    def track(self, labels, function):
+        self.functions[labels] = function
+
+    def samples(self):
+        return [(self.name, labels, function()) for labels, function in list(self.functions.items())]
+
+    def summary(self):
+        return dict((','.join(labels), function()) for labels, function in list(self.functions.items()))
+
+class Histogram(object):
+    ''' Latency histogram (seconds) per label set with fixed Prometheus-style buckets. '''
+    metric_type = 'histogram'
+
+    def __init__(self, name, help, label_names = (), buckets = METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        samples = []
+        for labels, (counts, total) in list(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', labels + (('+Inf' if bound == float('inf') else repr(bound)),), cumulative))
+            samples.append((self.name + '_count', labels, cumulative))
+            samples.append((self.name + '_sum', labels, total))
+        return samples
+
+    def quantile(self, counts, fraction):
+        ''' Upper bound of the bucket holding the given quantile. '''
+        target = fraction * sum(counts)
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            if cumulative >= target:
+                return bound
+        return float('inf')
+
+    def summary(self):
+        summary = {}
+        for labels, (counts, total) in list(self.series.items()):
+            count = sum(counts)
+            summary[','.join(labels)] = {'count': count, 'mean_ms': round(1000 * total / max(1, count), 3), 'p50_ms': 1000 * self.quantile(counts, 0.5), 'p99_ms': 1000 * self.quantile(counts, 0.99)}
+        return summary
+
+class MetricsRegistry(object):
+    '''
+        Process-wide metrics, exposed in Prometheus text format on a local HTTP endpoint
+        (metrics.port) and as a periodic structured log line (metrics.log_interval).
+    '''
+    def __init__(self):
+        self.metrics = []
+        self.server = None
+        self.log_thread = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names = ()):
+        return self.register(Counter(name, help, label_names))
+
+    def gauge(self, name, help, label_names = ()):
+        return self.register(CallbackMetric(name, help, label_names))
+
+    def callback_counter(self, name, help, label_names = ()):
+        return self.register(CallbackMetric(name, help, label_names, 'counter'))
+
+    def histogram(self, name, help, label_names = ()):
+        return self.register(Histogram(name, help, label_names))
+
+    def render(self):
+        ''' Returns every metric in the Prometheus text exposition format. '''
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            label_names = metric.label_names + (('le',) if metric.metric_type == 'histogram' else ())
+            for name, labels, value in metric.samples():
+                lines.append('%s%s %s' % (name, format_metric_labels(label_names if len(labels) == len(label_names) else metric.label_names, labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def log_line(self):
+        ''' Returns one JSON line summarizing every metric (histograms as count, mean and bucketed p50/p99). '''
+        summary = dict((metric.name, metric.summary()) for metric in self.metrics)
+        summary['time'] = datetime.now().isoformat(timespec = 'seconds')
+        return json.dumps(summary, sort_keys = True)
+
+    def start(self, port = None, log_interval = 0):
+        if port and self.server is None:
+            self.serve(port)
+        if log_interval > 0 and self.log_thread is None:
+            self.log_thread = threading.Thread(target = self.run_log, args = (log_interval,), name = 'flowerbot-metrics-log')
+            self.log_thread.daemon = True
+            self.log_thread.start()
+
+    def serve(self, port):
+        try:
+            self.server = http.server.ThreadingHTTPServer((METRICS_BIND_ADDRESS, port), MetricsRequestHandler)
+        except OSError as e:
+            # i.e., another bot already serves metrics on this port; the bot itself keeps running
+            print('Could not serve metrics on %s:%s, running without them: %s' % (METRICS_BIND_ADDRESS, port, e), file = ERROR_FILE)
+            return
+        self.server.daemon_threads = True
+        server_thread = threading.Thread(target = self.server.serve_forever, name = 'flowerbot-metrics-http')
+        server_thread.daemon = True
+        server_thread.start()
+        print('Serving metrics on http://%s:%s/metrics' % (METRICS_BIND_ADDRESS, port), file = OUTPUT_FILE)
+
+    def run_log(self, log_interval):
+        while True:
+            time.sleep(log_interval)
+            try:
+                print('METRICS %s' % (self.log_line()), file = OUTPUT_FILE)
+            except Exception as e:
+                print('Failed to log metrics: %s' % (e), file = ERROR_FILE)
+
+class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        payload = METRICS.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+METRICS = MetricsRegistry()
+MESSAGES_HANDLED = METRICS.counter('flowerbot_messages_total', 'Chat messages handled', ('channel',))
+HANDLER_LATENCY = METRICS.histogram('flowerbot_handler_latency_seconds', 'Time spent handling one chat event', ('channel', 'handler'))
+COMMAND_LATENCY = METRICS.histogram('flowerbot_command_latency_seconds', 'Time spent running a command handler', ('channel', 'command'))
+AUTO_RESPONSES_SENT = METRICS.counter('flowerbot_auto_responses_total', 'Automated keyword responses queued', ('channel',))
+SHOUTOUTS_SENT = METRICS.counter('flowerbot_shoutouts_total', 'Streamer shoutouts queued', ('channel',))
+FLOWERMONS_CATCHES = METRICS.counter('flowerbot_flowermons_catches_total', 'Flowermons caught', ('channel', 'shiny'))
+EXCEPTIONS_RAISED = METRICS.counter('flowerbot_exceptions_total', 'Exceptions raised while handling chat', ('channel', 'where'))
+SEND_FAILURES = METRICS.callback_counter('flowerbot_send_failures_total', 'Chat lines that failed to send', ('channel',))
+MESSAGES_REJECTED = METRICS.counter('flowerbot_messages_rejected_total', 'Chat messages ignored by the flood filter and cooldowns', ('channel', 'reason'))
+MESSAGES_DROPPED = METRICS.callback_counter('flowerbot_outbound_dropped_total', 'Chat lines dropped by the outbound queue', ('channel', 'reason'))
+OUTBOUND_QUEUE_DEPTH = METRICS.gauge('flowerbot_outbound_queue_depth', 'Chat lines waiting for the rate limit', ('channel',))
+PRESENCE_USERS_SIZE = METRICS.gauge('flowerbot_presence_users', 'Users seen this stream session', ('channel',))
+FLOWERMONS_USERS_SIZE = METRICS.gauge('flowerbot_flowermons_users', 'Users with a FlowerDex', ('channel',))
+HANDLER_STALLS = METRICS.counter('flowerbot_handler_stalls_total', 'Handlers that ran longer than the watchdog threshold', ('channel', 'handler'))
+
+class HandlerActivity(object):
+    __slots__ = ('thread_id', 'start', 'channel', 'handler', 'username', 'stalled')
+
+    def __init__(self, thread_id, start, channel, handler, username):
+        self.thread_id = thread_id
+        self.start = start
+        self.channel = channel
+        self.handler = handler
+        self.username = username
+        self.stalled = False # True once reported, None if a handler nested in it was reported instead
+
+class StallWatchdog(object):
+    '''
+        Opt-in watchdog for handlers that block the chat thread (the irc reactor or the asyncio loop).
+
+        Handlers bracket their work with begin() and end(), which only swap the activity recorded for
+        the current thread. A background thread checks those activities and, when one has been running
+        longer than threshold seconds, logs the channel, command, user and the chat thread's stack at
+        that moment (from sys._current_frames()), then logs the total duration once the handler returns.
+    '''
+    def __init__(self, clock = time.monotonic):
+        self.threshold = 0
+        self.clock = clock
+        self.activities = {} # thread id -> the HandlerActivity running on it
+        self.thread = None
+
+    def start(self, threshold):
+        if threshold <= 0 or self.thread is not None:
+            return
+        self.threshold = threshold
+        self.thread = threading.Thread(target = self.run, args = (max(WATCHDOG_MIN_CHECK_INTERVAL, threshold / 4.0),), name = 'flowerbot-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+        print('Stall watchdog logging handlers that run longer than %s second(s)' % (threshold), file = OUTPUT_FILE)
+
+    def begin(self, channel, handler, username = ''):
+        ''' Records that handler started on this thread; pass the result to end(). '''
+        if self.thread is None:
+            return None
+        thread_id = threading.get_ident()
+        previous = self.activities.get(thread_id)
+        self.activities[thread_id] = HandlerActivity(thread_id, self.clock(), channel, handler, username)
+        return previous
+
+    def end(self, previous):
+        ''' Records that the handler returned, restoring the activity it was nested in (if any). '''
+        if self.thread is None:
+            return
+        thread_id = threading.get_ident()
+        activity = self.activities.get(thread_id)
+        if activity is not None and activity.stalled:
+            print('Stall over: %s took %.3f second(s)' % (self.describe(activity), self.clock() - activity.start), file = ERROR_FILE)
+            if previous is not None:
+                # the enclosing handler was stalled by this one; do not report it again
+                previous.stalled = None
+        if previous is None:
+            self.activities.pop(thread_id, None)
+        else:
+            self.activities[thread_id] = previous
+
+    def describe(self, activity):
+        return '%s in %s%s' % (activity.handler, activity.channel, (' from @%s' % (activity.username) if activity.username else ''))
+
+    def run(self, check_interval):
+        while True:
+            time.sleep(check_interval)
+            now = self.clock()
+            for activity in list(self.activities.values()):
+                if activity.stalled is False and now - activity.start >= self.threshold:
+                    activity.stalled = True
+                    self.report(activity, now - activity.start)
+
+    def report(self, activity, duration):
+        HANDLER_STALLS.inc((activity.channel, activity.handler))
+        frame = sys._current_frames().get(activity.thread_id)
+        stack = (''.join(traceback.format_stack(frame)) if frame is not None else '  (thread exited)\n')
+        print('Stall: %s has been running for %.3f second(s), chat thread stack:\n%s' % (self.describe(activity), duration, stack.rstrip('\n')), file = ERROR_FILE)
+
+STALL_WATCHDOG = StallWatchdog()
+
+WORKER_TASKS = METRICS.counter('flowerbot_worker_tasks_total', 'Background tasks by outcome', ('outcome',))
+WORKER_PENDING = METRICS.gauge('flowerbot_worker_pending', 'Background tasks queued or running')
+
+class WorkerTask(object):
+    __slots__ = ('function', 'args', 'on_done', 'on_error', 'deliver', 'key', 'description', 'timeout', 'future', 'finished')
+
+    def __init__(self, function, args, on_done, on_error, deliver, key, description, timeout):
+        self.function = function
+        self.args = args
+        self.on_done = on_done
+        self.on_error = on_error
+        self.deliver = deliver
+        self.key = key
+        self.description = description
+        self.timeout = timeout
+        self.future = None # set for tasks run on the process pool
+        self.finished = False
+
+class WorkerPool(object):
+    '''
+        Bounded pool for blocking work (file writes, HTTP calls) so chat handlers never wait on I/O.
+
+        submit() never blocks: it returns False once max_pending tasks are queued or running, and the
+        caller decides what to do instead. Results and errors are handed to the task's deliver function
+        (i.e., a channel's run_on_chat_thread), so callbacks run on the chat thread and can reply safely.
+        Tasks that share a key run one at a time in submission order (i.e., writes to the same file).
+        A task's timeout counts from when it starts running, not from submit(), so time spent waiting
+        behind a task with the same key (or for a free process) never counts against it, and a task
+        reported as timed out has always already started. A task still running when its timeout is up
+        is reported as failed with a TimeoutError, and its result is dropped when it does finish.
+        With processes > 0, submit(cpu = True) runs picklable CPU-heavy functions on a process pool
+        instead; they are handed to it only as processes free up.
+    '''
+    def __init__(self, threads = WORKERS_DEFAULT_THREADS, max_pending = WORKERS_DEFAULT_MAX_PENDING, processes = 0, timeout = WORKERS_DEFAULT_TIMEOUT):
+        self.threads = threads
+        self.max_pending = max_pending
+        self.processes = processes
+        self.timeout = timeout
+        self.lock = threading.Condition()
+        self.tasks = queue.Queue()
+        self.workers = []
+        self.process_pool = None
+        self.process_backlog = collections.deque() # cpu tasks waiting for a free process
+        self.processes_running = 0
+        self.pending = 0
+        self.key_backlogs = {} # key -> tasks waiting for the running task with the same key
+        self.deadlines = [] # heap of (deadline, sequence, task)
+        self.sequence = 0
+
+    def configure(self, threads, max_pending, processes, timeout):
+        ''' Sizes the pool; only takes effect before the first task is submitted. '''
+        with self.lock:
+            if not self.workers:
+                self.threads = max(1, threads)
+                self.max_pending = max_pending
+                self.processes = processes
+                self.timeout = timeout
+
+    def start(self):
+        for index in range(self.threads):
+            worker = threading.Thread(target = self.run, name = 'flowerbot-worker-%s' % (index + 1))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        monitor = threading.Thread(target = self.run_monitor, name = 'flowerbot-worker-timeouts')
+        monitor.daemon = True
+        monitor.start()
+
+    def submit(self, function, args = (), on_done = None, on_error = None, deliver = None, key = None, timeout = None, cpu = False, description = None):
+        '''
+            Queues function(*args); on_done(result) or on_error(exception) are passed to deliver (or
+            called on the worker thread if deliver is None). Returns False if the pool is full.
+        '''
+        task = WorkerTask(function, args, on_done, on_error, deliver, key, description or getattr(function, '__name__', 'task'), (self.timeout if timeout is None else timeout))
+        use_processes = (cpu and self.processes > 0)
+        with self.lock:
+            if self.pending >= self.max_pending:
+                WORKER_TASKS.inc(('rejected',))
+                print('Worker pool full (%s tasks pending), not running %s' % (self.pending, task.description), file = ERROR_FILE)
+                return False
+            if not self.workers:
+                self.start()
+            self.pending += 1
+            if use_processes:
+                if self.process_pool is None:
+                    self.process_pool = concurrent.futures.ProcessPoolExecutor(self.processes)
+                self.process_backlog.append(task)
+                started = self.start_process_tasks()
+            elif key is not None and key in self.key_backlogs:
+                self.key_backlogs[key].append(task)
+                return True
+            elif key is not None:
+                self.key_backlogs[key] = collections.deque()
+        if use_processes:
+            self.watch_process_tasks(started)
+        else:
+            self.tasks.put(task)
+        return True
+
+    def start_deadline(self, task):
+        ''' Starts counting task's timeout; the caller holds the lock. '''
+        if task.timeout > 0:
+            self.sequence += 1
+            heapq.heappush(self.deadlines, (time.monotonic() + task.timeout, self.sequence, task))
+            self.lock.notify_all()
+
+    def run(self):
+        while True:
+            task = self.tasks.get()
+            with self.lock:
+                self.start_deadline(task)
+            try:
+                result, error = task.function(*task.args), None
+            except Exception as e:
+                result, error = None, e
+            self.finish(task, result, error)
+            if task.key is not None:
+                with self.lock:
+                    backlog = self.key_backlogs[task.key]
+                    if backlog:
+                        self.tasks.put(backlog.popleft())
+                    else:
+                        del self.key_backlogs[task.key]
+
+    def start_process_tasks(self):
+        ''' Hands waiting cpu tasks to free processes and returns them; the caller holds the lock. '''
+        started = []
+        while self.process_backlog and self.processes_running < self.processes and self.process_pool is not None:
+            task = self.process_backlog.popleft()
+            self.processes_running += 1
+            task.future = self.process_pool.submit(task.function, *task.args)
+            self.start_deadline(task)
+            started.append(task)
+        return started
+
+    def watch_process_tasks(self, tasks):
+        ''' Called without the lock held, since a future that is already done runs its callback right away. '''
+        for task in tasks:
+            task.future.add_done_callback(lambda future, task = task: self.finish_future(task, future))
+
+    def finish_future(self, task, future):
+        with self.lock:
+            self.processes_running -= 1
+            started = self.start_process_tasks()
+        self.watch_process_tasks(started)
+        if future.cancelled():
+            self.finish(task, None, concurrent.futures.CancelledError('%s was cancelled' % (task.description)))
+        elif future.exception() is not None:
+            self.finish(task, None, future.exception())
+        else:
+            self.finish(task, future.result(), None)
+
+    def finish(self, task, result, error):
+        with self.lock:
+            self.pending -= 1
+            timed_out = task.finished
+            task.finished = True
+            self.lock.notify_all()
+        if timed_out:
+            print('Background task %s finished after its timeout, result dropped' % (task.description), file = ERROR_FILE)
+            return
+        if error is not None:
+            WORKER_TASKS.inc(('error',))
+            print('Background task %s failed: %s' % (task.description, error), file = ERROR_FILE)
+            self.deliver(task, task.on_error, error)
+        else:
+            WORKER_TASKS.inc(('done',))
+            self.deliver(task, task.on_done, result)
+
+    def deliver(self, task, callback, value):
+        if callback is None:
+            return
+        def run_callback():
+            try:
+                callback(value)
+            except Exception as e:
+                print('Callback for background task %s failed: %s' % (task.description, e), file = ERROR_FILE)
+        if task.deliver is None:
+            run_callback()
+        else:
+            task.deliver(run_callback)
+
+    def close(self, timeout = WORKERS_CLOSE_TIMEOUT):
+        ''' Waits (up to timeout seconds) for pending tasks so writes are not lost at shutdown. '''
+        with self.lock:
+            if not self.lock.wait_for(lambda: self.pending == 0, timeout):
+                print('Gave up waiting for %s background task(s)' % (self.pending), file = ERROR_FILE)
+            process_pool, self.process_pool = self.process_pool, None
+        if process_pool is not None:
+            process_pool.shutdown(wait = False)
+
+    def run_monitor(self):
+        ''' Fails tasks that passed their deadline; the worker running one keeps going until it returns. '''
+        while True:
+            expired = []
+            with self.lock:
+                now = time.monotonic()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    task = heapq.heappop(self.deadlines)[2]
+                    if not task.finished:
+                        task.finished = True
+                        expired.append(task)
+                if not expired:
+                    self.lock.wait((self.deadlines[0][0] - now) if self.deadlines else None)
+            for task in expired:
+                WORKER_TASKS.inc(('timeout',))
+                print('Background task %s timed out' % (task.description), file = ERROR_FILE)
+                self.deliver(task, task.on_error, TimeoutError('%s timed out' % (task.description)))
+
+WORKERS = WorkerPool()
+WORKER_PENDING.track((), lambda: WORKERS.pending)
+
+class PresenceTracker(object):
+    '''
+        Users seen in a channel during the current stream session, fed by JOIN, PART, NAMES
+        and chat activity.
+
+        Memory stays bounded: users are kept least recently active first and the oldest are
+        forgotten once max_users is reached, or once they have been idle longer than ttl
+        (0 keeps them for the whole session). A session ends when the channel has been quiet
+        for session_gap seconds (i.e., between streams) or when reset() is called.
+    '''
+    def __init__(self, max_users = PRESENCE_DEFAULT_MAX_USERS, ttl = 0, session_gap = PRESENCE_DEFAULT_SESSION_GAP, clock = time.monotonic):
+        self.max_users = max_users
+        self.ttl = ttl
+        self.session_gap = session_gap
+        self.clock = clock
+        self.seen = collections.OrderedDict() # username -> last activity, least recent first
+        self.present = set()
+        self.last_activity = clock()
+
+    def reset(self):
+        self.seen.clear()
+        self.present.clear()
+
+    def session_expired(self):
+        return (self.session_gap > 0 and self.clock() - self.last_activity > self.session_gap)
+
+    def arrive(self, username):
+        ''' Records activity from username; returns True if username is new to this session. '''
+        now = self.last_activity = self.clock()
+        seen = self.seen
+        last_seen = seen.get(username)
+        if last_seen is not None:
+            seen.move_to_end(username)
+            seen[username] = now
+            self.present.add(username)
+            return False
+        seen[username] = now
+        self.present.add(username)
+        self.evict(now)
+        return True
+
+    def leave(self, username):
+        ''' username PARTed: no longer present, but still seen for the rest of the session. '''
+        self.present.discard(username)
+
+    def evict(self, now):
+        seen = self.seen
+        while len(seen) > self.max_users:
+            self.present.discard(seen.popitem(last = False)[0])
+        if self.ttl > 0:
+            while seen:
+                username, last_seen = next(iter(seen.items()))
+                if now - last_seen <= self.ttl:
+                    break
+                del seen[username]
+                self.present.discard(username)
+
+    def __contains__(self, username):
+        return username in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+class BurstDetector(object):
+    '''
+        Decides when a channel is in burst mode (i.e., a raid landing) from the chat message rate.
+
+        Messages are counted in one-second buckets over the last window seconds. Burst mode
+        starts when the average rate reaches threshold messages per second, or right away on a
+        raid, and ends once the rate has stayed under half the threshold for calm_period seconds
+        (and not before hold_until after a raid).
+    '''
+    def __init__(self, threshold, window = BURST_RATE_WINDOW, calm_period = BURST_CALM_PERIOD, clock = time.monotonic):
+        self.threshold = threshold
+        self.window = window
+        self.calm_period = calm_period
+        self.clock = clock
+        self.counts = [0] * window
+        self.seconds = [0] * window
+        self.active = False
+        self.hold_until = 0
+        self.calm_since = None
+
+    def rate(self, now):
+        second = int(now)
+        return sum(count for count, bucket_second in zip(self.counts, self.seconds) if second - bucket_second < self.window) / float(self.window)
+
+    def record(self):
+        ''' Counts one chat message; returns True if this changed whether burst mode is active. '''
+        now = self.clock()
+        second = int(now)
+        index = second % self.window
+        if self.seconds[index] != second:
+            self.seconds[index] = second
+            self.counts[index] = 0
+        self.counts[index] += 1
+        if self.threshold <= 0:
+            return False
+        rate = self.rate(now)
+        if not self.active:
+            if rate >= self.threshold:
+                self.active = True
+                self.calm_since = None
+                return True
+            return False
+        if rate >= self.threshold / 2.0 or now < self.hold_until:
+            self.calm_since = None
+            return False
+        if self.calm_since is None:
+            self.calm_since = now
+        if now - self.calm_since >= self.calm_period:
+            self.active = False
+            return True
+        return False
+
+    def raid(self, hold = BURST_RAID_HOLD):
+        ''' Starts burst mode for at least hold seconds; returns True if it was not already active. '''
+        self.hold_until = max(self.hold_until, self.clock() + hold)
+        self.calm_since = None
+        started = not self.active
+        self.active = True
+        return started
+
+class RateRing(object):
+    '''
+        Sliding-window limit of limit events per window seconds. The last limit event times are
+        kept in a ring buffer, so checking and recording an event is O(1): an event is allowed
+        when the oldest of them (the slot it would overwrite) has left the window.
+    '''
+    __slots__ = ('times', 'index')
+
+    def __init__(self, limit):
+        self.times = [float('-inf')] * limit
+        self.index = 0
+
+    def allow(self, now, window):
+        times = self.times
+        index = self.index
+        if now - times[index] < window:
+            return False
+        times[index] = now
+        self.index = (index + 1) % len(times)
+        return True
+
+class UserCooldowns(object):
+    __slots__ = ('messages', 'commands', 'last_seen')
+
+    def __init__(self, message_limit, now):
+        self.messages = RateRing(message_limit)
+        self.commands = {}
+        self.last_seen = now
+
+class FloodFilter(object):
+    '''
+        Cooldowns checked before a chat message reaches the command and auto response handlers.
+
+        Each user may send message_limit messages per message_window seconds and use each command
+        (or auto response trigger) command_limit times per command_window seconds; commands can also
+        have a channel-wide cooldown. Users are kept least recently active first and dropped once
+        idle for longer than both windows (when their state no longer limits anything), or when
+        there are more than max_users of them. A limit of 0 turns that check off.
+    '''
+    def __init__(self, message_limit, message_window, command_limit, command_window, cooldowns = None, max_users = COOLDOWN_MAX_USERS, clock = time.monotonic):
+        self.message_limit = message_limit
+        self.message_window = message_window
+        self.command_limit = command_limit
+        self.command_window = command_window
+        self.cooldowns = cooldowns or {}
+        self.max_users = max_users
+        self.idle_ttl = max(message_window, command_window)
+        self.clock = clock
+        self.users = collections.OrderedDict()
+        self.last_used = {}
+
+    def user(self, username, now):
+        users = self.users
+        user = users.get(username)
+        if user is None:
+            user = users[username] = UserCooldowns(max(1, self.message_limit), now)
+        else:
+            users.move_to_end(username)
+            user.last_seen = now
+        self.evict(now)
+        return user
+
+    def evict(self, now):
+        users = self.users
+        while len(users) > self.max_users:
+            users.popitem(last = False)
+        while users:
+            username, user = next(iter(users.items()))
+            if now - user.last_seen <= self.idle_ttl:
+                break
+            del users[username]
+
+    def allow_message(self, username):
+        ''' Records a chat message from username; returns False if they are over the flood limit. '''
+        now = self.clock()
+        user = self.user(username, now)
+        return (self.message_limit <= 0 or user.messages.allow(now, self.message_window))
+
+    def check_command(self, username, name, cooldown = 0):
+        '''
+            Records a use of command (or trigger) name by username. Returns None if it may run, or why
+            it may not: "global_cooldown" (cooldown seconds since anyone used it, unless overridden by
+            the cooldown.commands property) or "user_cooldown".
+        '''
+        now = self.clock()
+        cooldown = self.cooldowns.get(name, cooldown)
+        if cooldown > 0 and now - self.last_used.get(name, float('-inf')) < cooldown:
+            return 'global_cooldown'
+        if self.command_limit > 0:
+            user = self.user(username, now)
+            ring = user.commands.get(name)
+            if ring is None:
+                ring = user.commands[name] = RateRing(self.command_limit)
+            if not ring.allow(now, self.command_window):
+                return 'user_cooldown'
+        if cooldown > 0:
+            self.last_used[name] = now
+        return None
+
+    def __len__(self):
+        return len(self.users)
+
+def parse_command_cooldowns(value):
+    ''' Parses "name:seconds" pairs (i.e., "leaders:30,print:10") into a dict. '''
+    cooldowns = {}
+    for pair in value.split(','):
+        name, _, seconds = pair.partition(':')
+        if name.strip() and seconds.strip():
+            cooldowns[name.strip().lower().lstrip('!')] = float(seconds)
+    return cooldowns
+
+def parse_queue_names(value):
+    ''' Parses a comma and/or space delimited list of queue names (i.e., "icecream,cake"). '''
+    queue_names = []
+    for name in value.replace(',', ' ').split():
+        name = name.strip().lower().lstrip('!')
+        if name and name not in queue_names:
+            queue_names.append(name)
+    return queue_names
+
+class CustomQueues(object):
+    '''
+        Viewer queues for a channel (i.e., teams for community game nights) and their scores.
+
+        Each queue is an OrderedDict used as a deque with a built-in index, and members maps every
+        queued user to their queue, so join, leave, next and the "already in another queue" check
+        are all O(1) no matter how many viewers are waiting. A viewer can be in one queue at a time.
+        The rendered !print pages are cached until the queues change.
+    '''
+    def __init__(self, names = ()):
+        self.queues = collections.OrderedDict()
+        self.members = {}
+        self.scores = {}
+        self.version = 0
+        self.cached_pages = (None, None, [])
+        self.reset(names)
+
+    def reset(self, names):
+        ''' Replaces the queues with empty ones named names; scores of queues that are kept carry over. '''
+        self.queues = collections.OrderedDict((name, collections.OrderedDict()) for name in names)
+        self.members.clear()
+        self.scores = dict((name, score) for name, score in self.scores.items() if name in self.queues)
+        self.version += 1
+
+    def queue_of(self, username):
+        return self.members.get(username)
+
+    def join(self, name, username):
+        ''' Adds username to the back of queue name; returns their position, or 0 if they are already queued. '''
+        if username in self.members:
+            return 0
+        queue = self.queues[name]
+        queue[username] = None
+        self.members[username] = name
+        self.version += 1
+        return len(queue)
+
+    def leave(self, username):
+        ''' Removes username from whichever queue they are in; returns that queue's name or None. '''
+        name = self.members.pop(username, None)
+        if name is not None:
+            del self.queues[name][username]
+            self.version += 1
+        return name
+
+    def next(self, name):
+        ''' Pops the front of queue name; returns (next username, on deck username) with None for missing ones. '''
+        queue = self.queues[name]
+        if not queue:
+            return (None, None)
+        username = queue.popitem(last = False)[0]
+        del self.members[username]
+        self.version += 1
+        return (username, next(iter(queue), None))
+
+    def win(self, name):
+        self.scores[name] = self.scores.get(name, 0) + 1
+        return self.scores[name]
+
+    def score(self, name):
+        return self.scores.get(name, 0)
+
+    def pages(self, max_length):
+        ''' Returns the !print output split into chat-sized pages, rebuilt only after the queues change. '''
+        version, length, pages = self.cached_pages
+        if version != self.version or length != max_length:
+            message = ';  '.join('Current queue for %s: %s' % (name, (', '.join(queue) or 'empty')) for name, queue in self.queues.items())
+            pages = split_chat_message(message, max_length) if message else []
+            self.cached_pages = (self.version, max_length, pages)
+        return pages
+
+    def __contains__(self, name):
+        return name in self.queues
+
+    def __len__(self):
+        return len(self.queues)
+
+class MessageContext(object):
+    '''
+        Per-message view of a chat message, built once by the connection core and passed to every handler.
+        IRCv3 tags are parsed a single time instead of each handler scanning them.
+    '''
+    __slots__ = ('tags', 'badges', 'username', 'text', 'is_mod', 'is_sub', 'is_founder', 'is_broadcaster', 'bits')
+
+    def __init__(self, tags, nick, message):
+        self.tags = tags
+        self.badges = badges = {}
+        for badge in (tags.get('badges') or '').split(','):
+            name, _, version = badge.partition('/')
+            if name:
+                badges[name] = version
+
+        display_name = tags.get('display-name') or nick or ''
+        self.username = encode_ascii_string(display_name.lower())
+        self.text = normalize_message_text(message or '')
+        self.is_broadcaster = ('broadcaster' in badges)
+        self.is_founder = ('founder' in badges or 'founder' in (tags.get('badge-info') or ''))
+        self.is_mod = (tags.get('mod') == '1')
+        self.is_sub = ((tags.get('subscriber') or '0')[0] == '1' or self.is_founder)
+        self.bits = int(tags.get('bits') or 0)
+
+def split_chat_message(message, max_length = TWITCH_MAX_MESSAGE_LENGTH):
+    ''' Splits message on word boundaries into lines no longer than max_length. '''
+    if len(message) <= max_length:
+        return [message]
+    lines = []
+    line = ''
+    for word in message.split(' '):
+        while len(word) > max_length:
+            if line:
+                lines.append(line)
+                line = ''
+            lines.append(word[:max_length])
+            word = word[max_length:]
+        if line and len(line) + 1 + len(word) > max_length:
+            lines.append(line)
+            line = word
+        else:
+            line = (line + ' ' + word) if line else word
+    if line:
+        lines.append(line)
+    return lines
+
+class OutboundMessageScheduler(object):
+    '''
+        Rate-limited, prioritized queue between the bot and the IRC connection.
+
+        A token bucket enforces Twitch's per-30-second limits (higher when the bot is a
+        moderator in the channel). Pending lines are kept in one queue per priority so
+        moderation/broadcaster replies go out before command replies, which go out before
+        auto responses. Identical pending lines are dropped, over-long messages are split,
+        and each priority queue is bounded (a full queue drops the new line).
+
+        Nothing polls the queue: when lines are left waiting for tokens, a single wakeup is
+        requested through schedule(delay, function), so idle channels cost no timers.
+
+        While connected() is false (i.e., during a reconnect) lines stay queued instead of
+        failing to send; call wakeup() once the connection is back to flush them.
+    '''
+    def __init__(self, send, clock = time.monotonic, max_queue_depth = OUTBOUND_MAX_QUEUE_DEPTH, schedule = None, connected = None):
+        self.send = send
+        self.clock = clock
+        self.max_queue_depth = max_queue_depth
+        self.schedule = schedule
+        self.connected = connected
+        self.wakeup_pending = False
+        self.queues = [collections.deque() for priority in (PRIORITY_MODERATION, PRIORITY_COMMAND, PRIORITY_AUTO_RESPONSE)]
+        self.pending = set()
+        self.last_refill = clock()
+        self.last_sent = float('-inf')
+        self.sent = 0
+        self.dropped_duplicate = 0
+        self.dropped_overflow = 0
+        self.send_failures = 0
+        self.set_moderator(False)
+        self.tokens = self.capacity
+
+    def set_moderator(self, is_moderator):
+        ''' Switches between regular user and moderator rate limits. '''
+        self.is_moderator = is_moderator
+        self.capacity = float(TWITCH_MOD_MESSAGE_LIMIT if is_moderator else TWITCH_USER_MESSAGE_LIMIT)
+        self.refill_rate = self.capacity / TWITCH_MESSAGE_WINDOW
+        self.min_interval = (0.0 if is_moderator else TWITCH_USER_MESSAGE_INTERVAL)
+
+    def enqueue(self, message, priority = PRIORITY_COMMAND):
+        ''' Queues message (split into chat-sized lines) and sends whatever the rate limit allows right away. '''
+        queue = self.queues[priority]
+        for line in split_chat_message(message):
+            if line in self.pending:
+                self.dropped_duplicate += 1
+                continue
+            if len(queue) >= self.max_queue_depth:
+                self.dropped_overflow += 1
+                continue
+            queue.append(line)
+            self.pending.add(line)
+        self.drain()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.refill_rate)
+        self.last_refill = now
+
+    def drain(self):
+        ''' Sends queued lines, highest priority first, while the token bucket allows. '''
+        if self.connected is not None and not self.connected():
+            return
+        now = self.clock()
+        self.refill(now)
+        for queue in self.queues:
+            while queue:
+                if self.tokens < 1 or (now - self.last_sent) < self.min_interval:
+                    self.schedule_wakeup(now)
+                    return
+                line = queue.popleft()
+                self.pending.discard(line)
+                self.tokens -= 1
+                self.last_sent = now
+                try:
+                    self.send(line)
+                    self.sent += 1
+                except Exception as e:
+                    self.send_failures += 1
+                    print('Failed to send message to chat: %s' % (e), file = ERROR_FILE)
+
+    def schedule_wakeup(self, now):
+        ''' Requests one call to wakeup() for when the next line may be sent. '''
+        if self.wakeup_pending or self.schedule is None:
+            return
+        self.wakeup_pending = True
+        delay = max((1 - self.tokens) / self.refill_rate, self.min_interval - (now - self.last_sent), OUTBOUND_DRAIN_INTERVAL)
+        self.schedule(delay, self.wakeup)
+
+    def wakeup(self):
+        self.wakeup_pending = False
+        self.drain()
+
+    def queue_depth(self):
+        return sum(len(queue) for queue in self.queues)
+
+    def stats(self):
+        return {
+            'queue_depth': self.queue_depth(),
+            'queue_depth_moderation': len(self.queues[PRIORITY_MODERATION]),
+            'queue_depth_command': len(self.queues[PRIORITY_COMMAND]),
+            'queue_depth_auto_response': len(self.queues[PRIORITY_AUTO_RESPONSE]),
+            'tokens': int(self.tokens),
+            'sent': self.sent,
+            'dropped_duplicate': self.dropped_duplicate,
+            'dropped_overflow': self.dropped_overflow,
+            'send_failures': self.send_failures
+        }
+
+class SoundEffectPlayer(object):
+    '''
+        Plays sound effects on a dedicated audio thread so handlers return immediately.
+
+        Clips are resolved and read once when the mappings are loaded, so a missing clip
+        is reported at startup and the first play does not hit a cold disk. Requests wait
+        in a bounded queue and the overlap policy decides what happens to a request made
+        while another clip is playing or waiting.
+    '''
+    def __init__(self, sfx_directory, overlap_policy = SFX_POLICY_QUEUE, queue_size = SFX_DEFAULT_QUEUE_SIZE):
+        self.sfx_directory = sfx_directory
+        self.overlap_policy = overlap_policy
+        self.clips = {}
+        self.requests = queue.Queue(maxsize = queue_size)
+        self.lock = threading.Lock()
+        self.waiting = set()
+        self.playing = None
+        self.played = 0
+        self.dropped = 0
+        self.worker = None
+
+    def load_clips(self, mappings):
+        self.clips = self.resolve_clips(mappings)
+
+    def resolve_clips(self, mappings):
+        ''' Resolves and preloads every mapped clip, skipping (and reporting) missing files. '''
+        clips = {}
+        for key, clip_filename in mappings.items():
+            sfx_filename = os.path.join(self.sfx_directory, clip_filename)
+            if not os.path.isfile(sfx_filename):
+                print('Sound effect file for "%s" does not exist: %s' % (key, sfx_filename), file = ERROR_FILE)
+                continue
+            with open(sfx_filename, 'rb') as sfx_file:
+                sfx_file.read()
+            clips[key] = sfx_filename
+        return clips
+
+    def has_clip(self, key):
+        return key in self.clips
+
+    def start(self):
+        self.worker = threading.Thread(target = self.run, name = 'flowerbot-audio')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def play(self, key):
+        ''' Requests clip for key. Never blocks; returns whether the clip was accepted. '''
+        if key not in self.clips:
+            return False
+        with self.lock:
+            busy = (self.playing is not None or len(self.waiting) > 0)
+            if (self.overlap_policy == SFX_POLICY_DROP and busy) or (self.overlap_policy == SFX_POLICY_MERGE and key in self.waiting):
+                self.dropped += 1
+                return False
+            try:
+                self.requests.put_nowait(key)
+            except queue.Full:
+                self.dropped += 1
+                return False
+            self.waiting.add(key)
+        return True
+
+    def run(self):
+        while True:
+            key = self.requests.get()
+            with self.lock:
+                self.waiting.discard(key)
+                self.playing = key
+            try:
+                playsound(self.clips[key])
+                self.played += 1
+            except Exception as e:
+                print('Failed to play sound effect "%s": %s' % (key, e), file = ERROR_FILE)
+            finally:
+                with self.lock:
+                    self.playing = None
+
+def parse_amount(value):
+    ''' Parses a whole-number amount that may be given with decimals (i.e., "4.99" dollars). '''
+    return int(float(value))
+
+class Command(object):
+    ''' A registered chat command and everything needed to dispatch it. '''
+    __slots__ = ('name', 'handler', 'permission', 'aliases', 'args', 'help', 'flowermons', 'cooldown')
+
+    def __init__(self, name, handler, permission, aliases, args, help, flowermons, cooldown):
+        self.name = name
+        self.handler = handler
+        self.permission = permission
+        self.aliases = aliases
+        self.args = args
+        self.help = help
+        self.flowermons = flowermons
+        self.cooldown = cooldown
+
+    def usage(self):
+        ''' Returns usage string, i.e., "!addballs <username> <type> <quantity>". '''
+        arg_names = [('<%s>' % arg[0] if len(arg) == 2 else '[%s]' % arg[0]) for arg in self.args]
+        return ' '.join(['!' + self.name] + arg_names)
+
+    def parse_args(self, cmd_args):
+        '''
+            Converts raw chat arguments using the declared (name, converter[, default]) specs.
+            Raises ValueError if a required argument is missing or cannot be converted.
+            Extra arguments are ignored.
+        '''
+        parsed_args = []
+        for index, arg in enumerate(self.args):
+            if index < len(cmd_args):
+                parsed_args.append(arg[1](cmd_args[index]))
+            elif len(arg) == 3:
+                parsed_args.append(arg[2])
+            else:
+                raise ValueError('missing argument: %s' % (arg[0]))
+        return parsed_args
+
+class CommandRegistry(object):
+    '''
+        Maps command names and aliases to Command objects for constant-time dispatch.
+        Handlers register themselves with the command() decorator.
+    '''
+    def __init__(self):
+        self.commands = {}
 
-def encode_ascii_string(value):
-    return value.encode('ascii', 'ignore').decode('utf-8')
+    def command(self, name, permission = PERMISSION_EVERYONE, aliases = (), args = (), help = '', flowermons = False, cooldown = 0):
+        ''' cooldown is the default channel-wide cooldown (seconds) between uses by non-mods. '''
+        def register(handler):
+            command = Command(name, handler, permission, tuple(aliases), tuple(args), help, flowermons, cooldown)
+            for command_name in (name,) + command.aliases:
+                if command_name in self.commands:
+                    raise ValueError('Command already registered: %s' % (command_name))
+                self.commands[command_name] = command
+            return handler
+        return register
 
-class TwitchBot(irc.bot.SingleServerIRCBot):
+    def lookup(self, name):
+        return self.commands.get(name)
+
+    def list_commands(self):
+        ''' Returns each registered command once (aliases excluded), sorted by name. '''
+        return sorted(set(self.commands.values()), key = operator.attrgetter('name'))
+
+COMMANDS = CommandRegistry()
+
+class FlowerbotChannel(object):
+    '''
+        Everything the bot knows and does for one twitch channel.
+
+        All chat state (auto responses, shoutout lists, Flowermons data, sound effects and
+        the outbound queue) lives on the channel object, so one process can host any
+        number of channels. The channel does no network I/O itself: a connection core
+        (TwitchBot or AsyncTwitchBot) feeds it messages and attach()es a send function
+        and a scheduler providing execute_after(delay, function).
+    '''
     def __init__(self, properties):
         self.channel_display_name = properties[CHANNEL]
         self.channel = '#' + properties[CHANNEL]
-        self.bot_username = properties[BOT_USERNAME]
         self.client_id = properties[CLIENT_ID]
-        self.token = properties[CLIENT_SECRETS]
+        self.send = None
+        self.scheduler = None
+        self.autobot_responses = AutoBotResponses({})
+        self.approved_auto_shoutout_users = {}
+        self.custom_user_shoutouts = {}
+        self.sfx_mappings = {}
+        self.flowermons = FlowermonsState()
         self.auto_shoutout_users_file = os.path.join(DATA_DIRECTORY, properties.get(AUTO_SHOUTOUT_USERS_FILE, ''))
         self.auto_bot_responses_file = os.path.join(DATA_DIRECTORY, properties.get(AUTOBOT_RESPONSES_FILE, ''))
         self.custom_shoutouts_file = os.path.join(DATA_DIRECTORY, properties.get(CUSTOM_SHOUTOUTS_FILE, ''))
-        self.sfx_directory = os.path.join(RESOURCES_DIR, 'sfx')
+        self.sfx_directory = os.path.join(RESOURCES_DIR, properties.get(SFX_DIRECTORY) or 'sfx')
+        self.sfx_mappings_file = os.path.join(DATA_DIRECTORY, properties.get(SFX_MAPPINGS_FILE) or DEFAULT_SFX_MAPPINGS_FILE)
+        self.sound_effects = SoundEffectPlayer(self.sfx_directory, properties.get(SFX_OVERLAP_POLICY) or SFX_POLICY_QUEUE, int(properties.get(SFX_QUEUE_SIZE) or SFX_DEFAULT_QUEUE_SIZE))
+        self.outbound_scheduler = OutboundMessageScheduler(self.send_message_to_connection, schedule = self.schedule_after, connected = self.is_connected)
 
         self.death_count = 0
         self.channel_id = properties[CHANNEL_ID]
@@ -133,54 +2762,177 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         self.flowermons_subs_only_mode = (properties.get(FLOWERMONS_SUBS_ONLY_MODE, 'false') == 'true')
         self.flowermons_default_pokeball_limit = int(properties.get(FLOWERMONS_DEFAULT_POKEBALL_LIMIT, 3))
         self.flowermons_subscribers_pokeball_limit = int(properties.get(FLOWERMONS_SUBSCRIBERS_POKEBALL_LIMIT, 10))
+        self.flowermons_compaction_interval = int(properties.get(FLOWERMONS_COMPACTION_INTERVAL, FLOWERMONS_DEFAULT_COMPACTION_INTERVAL))
+        self.flowermons_storage_type = properties.get(FLOWERMONS_STORAGE) or FLOWERMONS_STORAGE_FILE
+        self.flowermons_sqlite_filename = os.path.join(FLOWERMONS_DIRECTORY, properties.get(FLOWERMONS_SQLITE_FILENAME) or DEFAULT_FLOWERMONS_SQLITE_FILENAME)
+        self.flowermons_storage = None
+        self.flowermons_species_sources = data_file_sources()
+        self.flowermons_boosts = parse_flowermons_boosts(properties.get(FLOWERMONS_BOOSTS) or '')
+        self.flowermons_boost_days = parse_weekdays(properties.get(FLOWERMONS_BOOST_DAYS) or '')
+        self.flowermons_event_boosts = {}
+        self.bot_username = properties[BOT_USERNAME].lower()
+        self.presence = PresenceTracker(int(properties.get(PRESENCE_MAX_USERS) or PRESENCE_DEFAULT_MAX_USERS), float(properties.get(PRESENCE_TTL) or 0), float(properties.get(PRESENCE_SESSION_GAP) or PRESENCE_DEFAULT_SESSION_GAP))
+        self.burst = BurstDetector(float(properties.get(BURST_MESSAGES_PER_SECOND) or BURST_DEFAULT_MESSAGES_PER_SECOND))
+        self.burst_catch_window = float(properties.get(BURST_CATCH_WINDOW) or BURST_DEFAULT_CATCH_WINDOW)
+        self.pending_catches = []
+        self.queues = CustomQueues([name for name in parse_queue_names(properties.get(QUEUE_NAMES_LIST) or '') if COMMANDS.lookup(name) is None])
+        self.flood_filter = FloodFilter(int(properties.get(COOLDOWN_USER_MESSAGES) or COOLDOWN_DEFAULT_USER_MESSAGES), float(properties.get(COOLDOWN_USER_WINDOW) or COOLDOWN_DEFAULT_USER_WINDOW),
+            int(properties.get(COOLDOWN_COMMAND_USES) or COOLDOWN_DEFAULT_COMMAND_USES), float(properties.get(COOLDOWN_COMMAND_WINDOW) or COOLDOWN_DEFAULT_COMMAND_WINDOW), parse_command_cooldowns(properties.get(COOLDOWN_COMMANDS) or ''))
+        self.queue_scores_file = os.path.join(DATA_DIRECTORY, properties.get(QUEUE_SCORES_FILE) or DEFAULT_QUEUE_SCORES_FILENAME_TEMPLATE % (properties[CHANNEL]))
+        self.hot_reload = (properties.get(DATA_FILES_HOT_RELOAD, 'true') == 'true')
+        self.metric_labels = (self.channel,)
+        self.snapshot_enabled = (properties.get(SNAPSHOT_ENABLED, 'true') == 'true')
+        self.snapshot = ChannelSnapshot(os.path.join(DATA_DIRECTORY, properties.get(SNAPSHOT_FILENAME) or DEFAULT_SNAPSHOT_FILENAME_TEMPLATE % (properties[CHANNEL])))
+        self.snapshot_stale = False
+        self.properties = properties
 
         self.user_shoutout_message_template = DEFAULT_USER_SHOUTOUT_MESSAGE_TEMPLATE
         if CUSTOM_USER_SHOUTOUT_MESSAGE_TEMPLATE in properties and properties[CUSTOM_USER_SHOUTOUT_MESSAGE_TEMPLATE]:
             self.user_shoutout_message_template = properties[CUSTOM_USER_SHOUTOUT_MESSAGE_TEMPLATE]
-        # self.db_connection = establish_db_connection(properties)
+        self.shoutout_team_name = (properties.get(SHOUTOUT_TEAM_NAME) or '').strip().lower()
+        self.helix = helix_client(self.client_id, properties[CLIENT_SECRETS], properties.get(HELIX_URL) or HELIX_API_URL, (self.shoutout_team_name != ''), int(properties.get(HELIX_CACHE_TTL_PROPERTY) or HELIX_CACHE_TTL))
+
+        if self.snapshot_enabled:
+            self.snapshot.load()
 
         # init auto shoutout list for auto-shoutouts (optional)
-        if self.auto_shoutout_users_file != '' and os.path.exists(self.auto_shoutout_users_file):
+        if os.path.isfile(self.auto_shoutout_users_file):
             self.init_auto_shoutout_users(self.auto_shoutout_users_file)
 
         # init auto responses for bot (optional)
-        if self.auto_bot_responses_file != '' and os.path.exists(self.auto_bot_responses_file):
+        if os.path.isfile(self.auto_bot_responses_file):
             self.init_autobot_responses(self.auto_bot_responses_file)
 
-        if self.custom_shoutouts_file != '' and os.path.exists(self.custom_shoutouts_file):
+        if os.path.isfile(self.custom_shoutouts_file):
             self.init_custom_shoutout_users(self.custom_shoutouts_file)
 
+        # init sound effects (optional)
+        if os.path.exists(self.sfx_mappings_file):
+            self.init_sfx_mappings(self.sfx_mappings_file)
+        if self.sound_effects.clips:
+            self.sound_effects.start()
+
         if self.flowermons_enabled:
-            if self.flowermons_filename != '' and os.path.exists(self.flowermons_filename):
+            if os.path.isfile(self.flowermons_filename):
                 self.init_flowermons_pokedex(self.flowermons_filename)
             if self.flowermons_user_data_filename != '':
                 self.load_flowermons_user_data(self.flowermons_user_data_filename)
 
+        if len(self.queues) > 0 and os.path.isfile(self.queue_scores_file):
+            self.init_queue_scores(self.queue_scores_file)
 
-        server = properties[IRC_CHAT_SERVER]
-        port = int(properties[IRC_CHAT_SERVER_PORT])
+        if self.snapshot_stale:
+            self.save_snapshot()
 
-        # Create IRC bot connection
-        print('Connecting to %s on port %s...' % (server, port), file = OUTPUT_FILE)
-        irc.bot.SingleServerIRCBot.__init__(self, [(server, port, 'oauth:'+ self.token)], self.channel_display_name, self.bot_username)
+        self.track_metrics()
+
+        if self.hot_reload:
+            self.watch_data_files()
+
+    def track_metrics(self):
+        ''' Registers the channel's gauges; they are only read when metrics are collected. '''
+        outbound_scheduler = self.outbound_scheduler
+        SEND_FAILURES.track(self.metric_labels, lambda: outbound_scheduler.send_failures)
+        MESSAGES_DROPPED.track((self.channel, 'duplicate'), lambda: outbound_scheduler.dropped_duplicate)
+        MESSAGES_DROPPED.track((self.channel, 'overflow'), lambda: outbound_scheduler.dropped_overflow)
+        OUTBOUND_QUEUE_DEPTH.track(self.metric_labels, outbound_scheduler.queue_depth)
+        PRESENCE_USERS_SIZE.track(self.metric_labels, lambda: len(self.presence))
+        if self.flowermons_enabled:
+            FLOWERMONS_USERS_SIZE.track(self.metric_labels, lambda: len(self.flowermons.user_pokedex))
+
+    def attach(self, send, scheduler):
+        ''' Connects the channel to a connection core; called again after every reconnect, which flushes lines queued meanwhile. '''
+        self.send = send
+        self.scheduler = scheduler
+        self.outbound_scheduler.wakeup()
+
+    def is_connected(self):
+        return self.send is not None
+
+    def schedule_after(self, delay, function):
+        if self.scheduler is not None:
+            self.scheduler.execute_after(delay, function)
+
+    def run_on_chat_thread(self, function):
+        ''' Runs function on the thread that handles chat (right away if not connected yet). '''
+        if self.scheduler is None:
+            function()
+        else:
+            self.scheduler.execute_after(0, function)
+
+    def run_in_background(self, function, args = (), on_done = None, on_error = None, key = None):
+        '''
+            Runs blocking function(*args) on the worker pool so chat is never held up; on_done(result)
+            and on_error(exception) are called back on the chat thread. Returns False if the pool is full.
+        '''
+        return WORKERS.submit(function, args, on_done = on_done, on_error = on_error, deliver = self.run_on_chat_thread, key = key, description = '%s for %s' % (getattr(function, '__name__', 'task'), self.channel))
+
+    def close(self):
+        ''' Flushes outstanding state before the process exits. '''
+        if self.pending_catches:
+            self.resolve_burst_catches()
+        self.close_flowermons_user_data()
 
-    def print_message_to_chat(self, message):
-        c = self.connection
-        c.privmsg(self.channel, message)
+    def print_message_to_chat(self, message, priority = PRIORITY_COMMAND):
+        ''' Queues message for chat; the outbound scheduler paces delivery to stay under twitch rate limits. '''
+        self.outbound_scheduler.enqueue(message, priority)
         return
 
+    def send_message_to_connection(self, message):
+        if self.send is None:
+            raise IOError('channel %s is not connected' % (self.channel))
+        self.send(message)
+
+    def load_data_file(self, section, filename, read, encode, decode):
+        '''
+            Returns the data parsed from filename by read(filename), decoding it from the binary
+            snapshot instead when the snapshot section was built from the file as it is now.
+            A missing or stale section is re-encoded and the snapshot saved once startup is done.
+        '''
+        sources = data_file_sources(filename)
+        if self.snapshot_enabled:
+            payload = self.snapshot.get(section, sources)
+            if payload is not None:
+                try:
+                    return decode(payload)
+                except (ValueError, struct.error, UnicodeDecodeError) as e:
+                    print('Ignoring unreadable %s section in snapshot %s: %s' % (section, self.snapshot.filename, e), file = ERROR_FILE)
+        data = read(filename)
+        if self.snapshot_enabled:
+            self.snapshot.put(section, sources, encode(data))
+            self.snapshot_stale = True
+        return data
+
+    def save_snapshot(self):
+        try:
+            self.snapshot.save()
+            self.snapshot_stale = False
+        except OSError as e:
+            print('Failed to save snapshot %s: %s' % (self.snapshot.filename, e), file = ERROR_FILE)
+
     def init_auto_shoutout_users(self, auto_shoutout_users_filename):
+        self.approved_auto_shoutout_users = self.load_data_file(SNAPSHOT_AUTO_SHOUTOUT_USERS, auto_shoutout_users_filename, self.read_auto_shoutout_users, encode_auto_shoutout_users, decode_auto_shoutout_users)
+
+    def read_auto_shoutout_users(self, auto_shoutout_users_filename):
+        ''' Returns approved auto shoutout users, keeping track of who already got their shoutout. '''
+        approved_auto_shoutout_users = {}
         with open (auto_shoutout_users_filename, 'r', encoding = "utf8") as auto_shoutout_users_file:
             for username in auto_shoutout_users_file.readlines():
-                APPROVED_AUTO_SHOUTOUT_USERS[username.strip()] = False
+                approved_auto_shoutout_users[username.strip()] = self.approved_auto_shoutout_users.get(username.strip(), False)
+        return approved_auto_shoutout_users
 
     def init_autobot_responses(self, auto_bot_responses_filename):
+        self.autobot_responses = self.load_data_file(SNAPSHOT_AUTOBOT_RESPONSES, auto_bot_responses_filename, self.read_autobot_responses, encode_autobot_responses, decode_autobot_responses)
+
+    def read_autobot_responses(self, auto_bot_responses_filename):
+        autobot_responses = {}
         with open(auto_bot_responses_filename, 'r', encoding = "utf8") as auto_bot_responses_file:
             for line in csv.DictReader(auto_bot_responses_file, dialect = 'excel-tab'):
-                message = line['MESSAGE'].lower().strip()
-                bot_responses = AUTOBOT_RESPONSES.get(message, [])
+                message = normalize_message_text(line['MESSAGE'])
+                bot_responses = autobot_responses.get(message, [])
                 bot_responses.append(line['RESPONSE'])
-                AUTOBOT_RESPONSES[message] = list(set(bot_responses))
+                autobot_responses[message] = list(set(bot_responses))
+        return AutoBotResponses(autobot_responses)
 
 #### TODO: Fix how commands are updated 
     # def update_autobot_responses_file(self):
@@ -188,7 +2940,7 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
     #         file_header = ['MESSAGE', 'RESPONSE']
     #         auto_bot_responses_file.write('\t'.join(file_header))
     #         auto_bot_responses_file.write('\n')
-    #         for cmd,message_list in AUTOBOT_RESPONSES.items():
+    #         for cmd,message_list in self.autobot_responses.items():
     #             for message in message_list:
     #                 auto_bot_responses_file.write(cmd)
     #                 auto_bot_responses_file.write('\t')
@@ -196,94 +2948,282 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
     #                 auto_bot_responses_file.write('\n')
 
     # def edit_existing_command(self, cmd, response):
-    #     AUTOBOT_RESPONSES[cmd.lower()] = response
+    #     self.autobot_responses[cmd.lower()] = response
     #     self.update_autobot_responses_file()
 
     # def add_new_command(self, cmd, response):
     #     cmd = cmd.lower()
-    #     if cmd in AUTOBOT_RESPONSES.keys():
+    #     if cmd in self.autobot_responses.keys():
     #         message = 'Command %s already exists - use !editcmd to edit an existing command' % cmd
     #         self.print_message_to_chat(message)
     #     else:
-    #         AUTOBOT_RESPONSES[cmd] = response
+    #         self.autobot_responses[cmd] = response
     #         self.update_autobot_responses_file()
 
     # def add_new_alias_keyword(self, cmd, response):
     #     cmd = cmd.lower()
-    #     existing_responses = AUTOBOT_RESPONSES.get(cmd, [])
+    #     existing_responses = self.autobot_responses.get(cmd, [])
     #     existing_responses.append(response)
-    #     AUTOBOT_RESPONSES[cmd] = existing_responses
+    #     self.autobot_responses[cmd] = existing_responses
     #     self.update_autobot_responses_file()
 
     def init_custom_shoutout_users(self, custom_shoutouts_filename):
+        try:
+            self.custom_user_shoutouts = self.load_data_file(SNAPSHOT_CUSTOM_SHOUTOUTS, custom_shoutouts_filename, self.read_custom_shoutout_users, encode_custom_shoutouts, decode_custom_shoutouts)
+        except ValueError as e:
+            print(e, file = ERROR_FILE)
+            sys.exit(2)
+
+    def read_custom_shoutout_users(self, custom_shoutouts_filename):
+        custom_user_shoutouts = {}
         with open(custom_shoutouts_filename, 'r', encoding = "utf8") as custom_shoutouts_file:
             for record in csv.DictReader(custom_shoutouts_file, dialect='excel-tab'):
                 if not 'TWITCH_USERNAME' in record.keys() or not 'SHOUTOUT_MESSAGE' in record.keys():
-                    print('Custom shoutout file does not contain one or more of required headers:: "TWITCH_USERNAME", "SHOUTOUT_MESSAGE"', file = ERROR_FILE)
-                    sys.exit(2)
-                CUSTOM_USER_SHOUTOUTS[record['TWITCH_USERNAME']] = record['SHOUTOUT_MESSAGE']
+                    raise ValueError('Custom shoutout file does not contain one or more of required headers:: "TWITCH_USERNAME", "SHOUTOUT_MESSAGE"')
+                custom_user_shoutouts[record['TWITCH_USERNAME']] = record['SHOUTOUT_MESSAGE']
+        return custom_user_shoutouts
+
+    def init_queue_scores(self, queue_scores_filename):
+        ''' Loads saved queue scores ("queue<tab>score" per line) for the configured queues. '''
+        with open(queue_scores_filename, 'r', encoding = "utf8") as queue_scores_file:
+            for line in queue_scores_file:
+                name, _, score = line.rstrip('\n').partition('\t')
+                if name in self.queues and score.isdigit():
+                    self.queues.scores[name] = int(score)
+
+    def save_queue_scores(self):
+        self.run_in_background(replace_file_atomically, (self.queue_scores_file, ['%s\t%s\n' % (name, score) for name, score in self.queues.scores.items()]), key = self.queue_scores_file)
+
+    def init_sfx_mappings(self, sfx_mappings_filename):
+        try:
+            self.sfx_mappings = self.read_sfx_mappings(sfx_mappings_filename)
+        except ValueError as e:
+            print(e, file = ERROR_FILE)
+            sys.exit(2)
+        self.sound_effects.load_clips(self.sfx_mappings)
+
+    def read_sfx_mappings(self, sfx_mappings_filename):
+        sfx_mappings = {}
+        with open(sfx_mappings_filename, 'r', encoding = "utf8") as sfx_mappings_file:
+            for record in csv.DictReader(sfx_mappings_file, dialect='excel-tab'):
+                if not 'KEY' in record.keys() or not 'SFX_FILENAME' in record.keys():
+                    raise ValueError('Sound effect mappings file does not contain one or more of required headers:: "KEY", "SFX_FILENAME"')
+                sfx_mappings[record['KEY'].strip().lower()] = record['SFX_FILENAME'].strip()
+        return sfx_mappings
+
+    def read_sfx_clips(self, sfx_mappings_filename):
+        ''' Returns (mappings, preloaded clips) for a reload. '''
+        sfx_mappings = self.read_sfx_mappings(sfx_mappings_filename)
+        return (sfx_mappings, self.sound_effects.resolve_clips(sfx_mappings))
+
+    def apply_sfx_clips(self, sfx_clips):
+        self.sfx_mappings, self.sound_effects.clips = sfx_clips
+        if self.sound_effects.clips and self.sound_effects.worker is None:
+            self.sound_effects.start()
 
     def init_flowermons_pokedex(self, flowermons_filename):
+        try:
+            self.flowermons_species_sources, species = self.read_flowermons_species(flowermons_filename)
+        except ValueError as e:
+            print(e, file = ERROR_FILE)
+            sys.exit(2)
+        for pokemon, rarity, weight in species:
+            self.flowermons.pokedex.add(pokemon, weight = weight, rarity = rarity)
+
+    def read_flowermons_species(self, flowermons_filename):
+        '''
+            Returns (sources, species); sources identifies the version of the file the species were read from
+            and species is a list of (name, rarity, weight) tuples.
+        '''
+        sources = data_file_sources(flowermons_filename)
         with open(flowermons_filename, 'r', encoding = "utf8") as flowermons_file:
-            for line in flowermons_file.readlines():
-                FLOWERMONS_POKEDEX.add(line.strip().lower())
+            return (sources, [species for species in map(parse_flowermons_species, flowermons_file.readlines()) if species is not None])
 
-    def load_flowermons_user_data(self, flowermons_user_data_filename):
-        if os.path.exists(flowermons_user_data_filename):
-            with open(flowermons_user_data_filename, 'r', encoding = "utf8") as flowermons_user_data_file:
-                for line in flowermons_user_data_file.readlines():
-                    data = list(map(lambda x: x.strip().lower(), line.split('\t')))
-                    username = data[0]
-                    user_pokemon_stats = FLOWERMONS_USER_POKEDEX.get(username, {})
+    def apply_flowermons_species(self, species):
+        ''' Swaps in the reloaded species table; completion percentages change, so the leaderboards are rebuilt. '''
+        self.flowermons_species_sources, species = species
+        self.flowermons.pokedex = self.flowermons.pokedex.reloaded(species)
+        self.flowermons.rebuild_leaderboards()
 
-                    user_pokemon_set = user_pokemon_stats.get('CAUGHT', set())
-                    user_pokemon_shiny_set = user_pokemon_stats.get('SHINY', set())
+    def watch_data_files(self):
+        ''' Registers the channel's data files with the data file watcher so edits apply without a restart. '''
+        if os.path.isfile(self.auto_shoutout_users_file):
+            self.watch_data_file(self.auto_shoutout_users_file, self.read_auto_shoutout_users, functools.partial(setattr, self, 'approved_auto_shoutout_users'))
+        if os.path.isfile(self.auto_bot_responses_file):
+            self.watch_data_file(self.auto_bot_responses_file, self.read_autobot_responses, functools.partial(setattr, self, 'autobot_responses'))
+        if os.path.isfile(self.custom_shoutouts_file):
+            self.watch_data_file(self.custom_shoutouts_file, self.read_custom_shoutout_users, functools.partial(setattr, self, 'custom_user_shoutouts'))
+        if os.path.isfile(self.sfx_mappings_file):
+            self.watch_data_file(self.sfx_mappings_file, self.read_sfx_clips, self.apply_sfx_clips)
+        if self.flowermons_enabled and os.path.isfile(self.flowermons_filename):
+            self.watch_data_file(self.flowermons_filename, self.read_flowermons_species, self.apply_flowermons_species)
 
-                    user_pokemon_set.add(data[1])
-                    if 'SHINY' in line:
-                        user_pokemon_shiny_set.add(data[1])
-                    user_pokemon_stats['CAUGHT'] = user_pokemon_set
-                    user_pokemon_stats['SHINY'] = user_pokemon_shiny_set
+    def watch_data_file(self, filename, build, apply):
+        '''
+            Hot reloads filename when it changes. build(filename) parses the file and builds the
+            new lookup structures on the watcher thread; apply(data) then swaps them in on the chat
+            thread, so in-flight messages only ever see the old or the new data.
+        '''
+        def reload(modified_time):
+            start = time.perf_counter()
+            data = build(filename)
+            build_ms = 1000 * (time.perf_counter() - start)
+            def swap():
+                apply(data)
+                print('Reloaded %s for %s (built in %.1f ms, live %.2f s after the file changed)' % (os.path.basename(filename), self.channel, build_ms, time.time() - modified_time), file = OUTPUT_FILE)
+            self.run_on_chat_thread(swap)
+        DATA_FILE_WATCHER.watch(filename, reload)
 
-                    FLOWERMONS_USER_POKEDEX[username] = user_pokemon_stats
+    def create_flowermons_storage(self, flowermons_user_data_filename):
+        ''' Returns the storage backend selected by flowermons.storage (file, sqlite or mysql). '''
+        if self.flowermons_storage_type == FLOWERMONS_STORAGE_SQLITE:
+            return SqliteFlowermonsStorage(self.flowermons, self.flowermons_sqlite_filename, flowermons_user_data_filename)
+        elif self.flowermons_storage_type == FLOWERMONS_STORAGE_MYSQL:
+            return MySQLFlowermonsStorage(self.flowermons, self.properties, flowermons_user_data_filename)
+        elif self.flowermons_storage_type == FLOWERMONS_STORAGE_FILE:
+            return FlowermonsJournal(self.flowermons, flowermons_user_data_filename, self.flowermons_compaction_interval)
+        print('Unknown flowermons.storage "%s", expected one of: file, sqlite, mysql' % (self.flowermons_storage_type), file = ERROR_FILE)
+        sys.exit(2)
 
-    def on_welcome(self, c, e):
-        ''' Handle welcome. '''
-        print('Joining channel: %s' % (self.channel), file = OUTPUT_FILE)
-        c.cap('REQ', ':twitch.tv/membership')
-        c.cap('REQ', ':twitch.tv/tags')
-        c.cap('REQ', ':twitch.tv/commands')
-        c.join(self.channel)
-        print('Successfully joined channel, have at it!')
+    def load_flowermons_user_data(self, flowermons_user_data_filename):
+        ''' Loads Flowermons user data from the configured storage backend and starts persisting changes. '''
+        if self.snapshot_enabled and self.flowermons_storage_type == FLOWERMONS_STORAGE_FILE:
+            self.load_flowermons_snapshot(flowermons_user_data_filename)
+        else:
+            self.flowermons_storage = self.create_flowermons_storage(flowermons_user_data_filename)
+            self.flowermons_storage.load()
+        self.flowermons.rebuild_leaderboards()
+        self.flowermons_storage.open()
 
-    def on_pubmsg(self, c, e):
-        ''' Handles message in chat. '''
+    def flowermons_snapshot_sources(self):
+        return self.flowermons_species_sources + data_file_sources(self.flowermons_storage.snapshot_filename, self.flowermons_storage.pokeballs_filename)
+
+    def load_flowermons_snapshot(self, flowermons_user_data_filename):
+        '''
+            File storage only: the species table and the journal's snapshot files are decoded from
+            the binary snapshot if none of them changed since it was written, and the journal is
+            replayed on top as usual. Each journal compaction refreshes the binary snapshot.
+        '''
+        self.flowermons_storage = self.create_flowermons_storage(flowermons_user_data_filename)
+        sources = self.flowermons_snapshot_sources()
+        payload = self.snapshot.get(SNAPSHOT_FLOWERMONS, sources)
+        flowermons = None
+        if payload is not None:
+            try:
+                flowermons = decode_flowermons_state(payload)
+            except (ValueError, struct.error, UnicodeDecodeError) as e:
+                print('Ignoring unreadable %s section in snapshot %s: %s' % (SNAPSHOT_FLOWERMONS, self.snapshot.filename, e), file = ERROR_FILE)
+        if flowermons is not None:
+            self.flowermons = self.flowermons_storage.flowermons = flowermons
+        else:
+            self.flowermons_storage.load_user_data_snapshot()
+            self.flowermons_storage.load_pokeballs_snapshot()
+            self.snapshot.put(SNAPSHOT_FLOWERMONS, sources, encode_flowermons_state(self.flowermons.pokedex, [(user, entry.caught, entry.shiny) for user, entry in self.flowermons.user_pokedex.items()], self.flowermons.user_pokeballs.items()))
+            self.snapshot_stale = True
+        self.flowermons_storage.load_journal()
+        self.flowermons_storage.on_compacted = self.update_flowermons_snapshot
 
-        # give a streamer shoutout if viewer is in the approved streamers set
-        # and streamer has not already gotten a shout out
-        # (i.e., manual shoutout with !so <username> command)
-        self.auto_streamer_shoutout(e)
-        user_message = e.arguments[0].encode('ascii', 'ignore').strip().lower().decode("utf-8")
-        if user_message in AUTOBOT_RESPONSES.keys():
-            self.send_auto_bot_response(user_message)
+    def update_flowermons_snapshot(self, pokedex, user_pokedex_items, user_pokeballs_items):
+        ''' Called on the compaction thread with exactly the data just written to the snapshot files. '''
+        if pokedex is not self.flowermons.pokedex:
+            # the species file was reloaded mid-compaction; the next compaction catches up
             return
-        cmd_issuer = self.get_username(e)
+        self.snapshot.put(SNAPSHOT_FLOWERMONS, self.flowermons_snapshot_sources(), encode_flowermons_state(pokedex, user_pokedex_items, user_pokeballs_items))
+        self.save_snapshot()
 
-        # If a chat message starts with an exclamation point, try to run it as a command
+    def close_flowermons_user_data(self):
+        ''' Flushes outstanding Flowermons changes to the storage backend. '''
+        if self.flowermons_storage is not None:
+            self.flowermons_storage.close()
+
+    def handle_join(self, nick):
+        if nick.lower() != self.bot_username:
+            self.user_seen(nick.lower())
+
+    def handle_part(self, nick):
+        self.presence.leave(nick.lower())
+
+    def handle_names(self, nicks):
+        ''' NAMES lists who was already in chat when the bot joined. '''
+        for nick in nicks:
+            self.handle_join(nick)
+
+    def user_seen(self, username):
+        '''
+            Presence from JOIN, NAMES or chat. Approved streamers get their auto shoutout the
+            first time they show up in a stream session; after that nothing is checked.
+        '''
+        if self.presence.session_expired():
+            self.start_session()
+        if self.presence.arrive(username):
+            self.auto_streamer_shoutout(username)
+
+    def start_session(self):
+        ''' A new stream: forget who was seen and let every approved streamer get a shoutout again. '''
+        print('Starting a new stream session for %s' % (self.channel), file = OUTPUT_FILE)
+        self.presence.reset()
+        self.approved_auto_shoutout_users = dict.fromkeys(self.approved_auto_shoutout_users, False)
+
+    def handle_usernotice(self, tags):
+        ''' A raid starts burst mode before the raiders' messages arrive. '''
+        if tags.get('msg-id') == 'raid':
+            print('%s raided %s with %s viewers' % (tags.get('msg-param-login'), self.channel, tags.get('msg-param-viewerCount')), file = OUTPUT_FILE)
+            if self.burst.raid():
+                self.burst_mode_changed()
+
+    def burst_mode_changed(self):
+        print('Burst mode %s for %s' % (('on' if self.burst.active else 'off'), self.channel), file = OUTPUT_FILE)
+
+    def handle_userstate(self, tags):
+        ''' Twitch sends USERSTATE on join and after each message; use it to pick the bot's rate limits. '''
+        is_moderator = (tags.get('mod') == '1' or 'broadcaster/' in (tags.get('badges') or ''))
+        if is_moderator != self.outbound_scheduler.is_moderator:
+            self.outbound_scheduler.set_moderator(is_moderator)
+
+    def handle_pubmsg(self, ctx):
+        ''' Handles message in chat, recording how long it took. '''
+        start = time.perf_counter()
+        MESSAGES_HANDLED.inc(self.metric_labels)
+        watch = STALL_WATCHDOG.begin(self.channel, 'pubmsg', ctx.username)
         try:
-            parsed_args = user_message.split(' ')
-        except UnicodeEncodeError:
-            print("[UnicodeEncodeError], Error parsing command.", file = ERROR_FILE)
+            self.process_pubmsg(ctx)
+        finally:
+            STALL_WATCHDOG.end(watch)
+            HANDLER_LATENCY.observe(self.metric_labels + ('pubmsg',), time.perf_counter() - start)
+
+    def process_pubmsg(self, ctx):
+        ''' Handles message in chat. '''
+        if self.burst.record():
+            self.burst_mode_changed()
+        # chatting counts as presence (JOINs lag behind and are not sent for big channels)
+        self.user_seen(ctx.username)
+        # flooding users are dropped here, before any matching or command parsing
+        exempt = self.user_is_exempt(ctx)
+        if not exempt and not self.flood_filter.allow_message(ctx.username):
+            MESSAGES_REJECTED.inc((self.channel, 'flood'))
+            return
+        user_message = ctx.text
+        autobot_responses = self.autobot_responses
+        if user_message in autobot_responses.responses:
+            # in burst mode only !-triggered responses are sent; random keyword replies would flood chat
+            if (not self.burst.active or user_message.startswith('!')) and (exempt or self.check_cooldown(ctx, user_message)):
+                self.send_auto_bot_response(user_message, autobot_responses.responses[user_message])
+            return
+        if self.burst.active and not user_message.startswith('!'):
             return
 
-        # check message for any keywords used
-        keyword_matches = [v for v in parsed_args if v in AUTOBOT_RESPONSES.keys()]
-        if len(keyword_matches) > 0:
-            self.send_auto_bot_response(random.choice(keyword_matches))
+        # check message for any keywords or trigger phrases used (in burst mode only commands are handled)
+        if not self.burst.active:
+            keyword_matches = autobot_responses.matcher.find_all(user_message)
+            if len(keyword_matches) > 0:
+                keyword_match = random.choice(keyword_matches)
+                if exempt or self.check_cooldown(ctx, keyword_match):
+                    self.send_auto_bot_response(keyword_match, autobot_responses.responses[keyword_match])
 
-        ##TODO: REPLACE WITH REGEX
-        if not parsed_args[0].startswith('!'):
+        # If a chat message starts with an exclamation point, try to run it as a command
+        if not user_message.startswith('!'):
             return
+        parsed_args = user_message.split(' ')
         cmd = parsed_args[0].replace('!','')
         cmd_args = []
 
@@ -291,84 +3231,41 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             cmd_args = list(map(lambda x: x.replace('@',''), parsed_args[1:]))
         print('Received command: %s with args: %s' % (cmd, ', '.join(cmd_args)), file = OUTPUT_FILE)
         try:
-            self.do_command(e, cmd_issuer, cmd, cmd_args)
+            self.do_command(ctx, cmd, cmd_args)
         except Exception as e:
-            print(e, file = OUTPUT_FILE)
+            EXCEPTIONS_RAISED.inc((self.channel, 'command'))
+            print('Command %s failed: %s' % (cmd, e), file = ERROR_FILE)
         return
 
-    def send_auto_bot_response(self, message):
+    def user_is_exempt(self, ctx):
+        ''' Mods, trusted users and the broadcaster skip the flood filter and cooldowns. '''
+        return (ctx.is_mod or ctx.is_broadcaster or ctx.username == self.channel_display_name or ctx.username in self.trusted_users_list)
+
+    def check_cooldown(self, ctx, name, cooldown = 0):
+        ''' Records a use of command or trigger name; returns False (and counts and logs the rejection) if it is on cooldown. '''
+        reason = self.flood_filter.check_command(ctx.username, name, cooldown)
+        if reason is not None:
+            MESSAGES_REJECTED.inc((self.channel, reason))
+            print('Ignoring %s from %s in %s (%s)' % (name, ctx.username, self.channel, reason.replace('_', ' ')), file = OUTPUT_FILE)
+            return False
+        return True
+
+    def send_auto_bot_response(self, message, bot_responses):
         '''
             Sends custom response to matching messages in chat.
             Always send response if message startswith '!', otherwise
             randomly decide whether to send response.
         '''
-        c = self.connection
-        response = response = random.choice(AUTOBOT_RESPONSES[message])
+        response = random.choice(bot_responses)
         if message.startswith('!') or random.choice([True, False, False]):
-            c.privmsg(self.channel, response)
+            AUTO_RESPONSES_SENT.inc(self.metric_labels)
+            self.print_message_to_chat(response, PRIORITY_AUTO_RESPONSE)
         return
 
-    # ---------------------------------------------------------------------------------------------
-    # FETCH CHANNEL / USER DETAILS
-    def get_username(self, e):
-        ''' Returns username for given event. '''
-        user = [d['value'] for d in e.tags if d['key'] == 'display-name'][0]
-        return encode_ascii_string(user.lower())
-
-    def user_is_mod(self, e):
-        ''' Returns whether user has mod permissions. '''
-        val = [d['value'] for d in e.tags if d['key'] == 'mod'][0]
-        return (val == '1')
-
-    def user_is_sub(self, e):
-        ''' Returns whether user is a subscriber. '''
-        try:
-            for d in e.tags:
-                if d['key'] in ['subscriber', 'founder']:
-                    if d['value'][0] == '1':
-                        return True
-                elif d['key'] in ['badges', 'badge-info']:
-                    if 'founder' in d['value']:
-                        return True
-        except:
-            return False
-        return False
-
-# TODO: update to use latest twitch api
-
-    # def get_channel_id(self, twitch_channel):
-    #     ''' Returns the twitch channel id. '''
-    #     url = 'https://api.twitch.tv/kraken/users?login=' + twitch_channel
-    #     headers = {'Client-ID': self.client_id, 'Accept': 'application/vnd.twitchtv.v5+json'}
-    #     r = requests.get(url, headers=headers).json()
-    #     return r['users'][0]['_id']
-
-    # def get_last_game_played(self, twitch_channel_id):
-    #     ''' Returns last game played for given channel id. '''
-    #     url = 'https://api.twitch.tv/kraken/channels/' + twitch_channel_id
-    #     headers = {'Client-ID': self.client_id, 'Accept': 'application/vnd.twitchtv.v5+json'}
-    #     r = requests.get(url, headers=headers).json()
-    #     try:
-    #         game = encode_ascii_string(r['game'])
-    #     except:
-    #         game = 'None'
-    #     return game
-
-    # def is_spawnpoint_team_member(self, twitch_channel_id):
-    #     ''' Returns which stream teams a channel belongs to. '''
-    #     url = 'https://api.twitch.tv/kraken/channels/' + twitch_channel_id + '/teams'
-    #     headers = {'Client-ID': self.client_id, 'Accept': 'application/vnd.twitchtv.v5+json'}
-    #     r = requests.get(url, headers=headers).json()
-    #     if 'teams' in r:
-    #         for data in r['teams']:
-    #             if data.get('name', '').lower() == 'spawnpoint':
-    #                 return True
-    #     return False
-
-    def current_death_count(self, c):
+    def current_death_count(self):
         ''' Returns current death count. '''
         message = "@%s's current death count is %s" % (self.channel_display_name, self.death_count)
-        c.privmsg(self.channel, message)
+        self.print_message_to_chat(message)
 
     # ---------------------------------------------------------------------------------------------
     # STREAMER SHOUTOUT FUNCTIONS
@@ -376,67 +3273,60 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         ''' Determines whether user is valid for giving shout outs to or should be ignored. '''
         return (user not in self.ignored_users_list)
 
-    def format_streamer_shoutout_message(self, user):
-        message = CUSTOM_USER_SHOUTOUTS.get(user, self.user_shoutout_message_template)
+    def format_streamer_shoutout_message(self, user, channel_info = None):
+        ''' channel_info is the user's HelixChannelInfo, or None if it was not needed or could not be fetched. '''
+        message = self.custom_user_shoutouts.get(user, self.user_shoutout_message_template)
         if MSG_USERNAME_REPLACE_STRING in message:
             message = message.replace(MSG_USERNAME_REPLACE_STRING, user)
-
-        # TODO: update to use latest twitch api
-        # if MSG_LAST_GAME_PLAYED_REPLACE_STRING in message:
-        #     message = message.replace(MSG_LAST_GAME_PLAYED_REPLACE_STRING, game)
+        if MSG_LAST_GAME_PLAYED_REPLACE_STRING in message:
+            message = message.replace(MSG_LAST_GAME_PLAYED_REPLACE_STRING, str(channel_info.game if channel_info is not None else None))
+        if channel_info is not None and self.shoutout_team_name in channel_info.teams:
+            message = (TEAM_MEMBER_SHOUTOUT_PREFIX % (self.shoutout_team_name)) + message
         return encode_ascii_string(message)
 
-    def streamer_shoutout_message(self, user):
-        ''' Gives a streamer shoutout in twitch chat. '''
+    def shoutout_needs_helix(self, user):
+        ''' Whether the shoutout for user includes anything that has to be looked up on twitch. '''
+        return (self.shoutout_team_name != '' or MSG_LAST_GAME_PLAYED_REPLACE_STRING in self.custom_user_shoutouts.get(user, self.user_shoutout_message_template))
+
+    def streamer_shoutout_message(self, user, priority = PRIORITY_COMMAND):
+        '''
+            Gives a streamer shoutout in twitch chat. If the message needs the user's last game or
+            teams, it is sent once the helix lookup completes (right away when it is cached).
+        '''
         if not self.is_valid_user(user):
             return
 
-        c = self.connection
         if user == self.channel_display_name:
-            c.privmsg(self.channel, 'Jebaited')
-            return
-        # TODO: update to use latest twitch api
-        # cid = self.get_channel_id(user)
-        # game = self.get_last_game_played(cid)
-        USERS_CHECKED.add(user)
-        # TODO: update to use latest twitch api
-        # if str(game) != "None" or user in APPROVED_AUTO_SHOUTOUT_USERS:
-        if user in APPROVED_AUTO_SHOUTOUT_USERS:
-            message = self.format_streamer_shoutout_message(user)
-            # TODO: update to use latest twitch api
-            # if self.is_spawnpoint_team_member(cid):
-            #     message = 'Is that a Spawn Point team member I see?! xcornfPOG ' + message
-            c.privmsg(self.channel, message)
+            self.print_message_to_chat('Jebaited', priority)
+            return
+        if user in self.approved_auto_shoutout_users:
+            # a manual shoutout counts as this session's auto shoutout
+            self.approved_auto_shoutout_users[user] = True
+        if self.shoutout_needs_helix(user):
+            self.helix.lookup(user, lambda channel_info: self.run_on_chat_thread(lambda: self.send_streamer_shoutout(user, channel_info, priority)))
         else:
-            message = self.format_streamer_shoutout_message(user)
-            # TODO: update to use latest twitch api
-            # if self.is_spawnpoint_team_member(cid):
-            #     message = 'Is that a Spawn Point team member I see?! xcornfPOG ' + message
-            c.privmsg(self.channel, message)
-        if user in SFX_MAPPINGS.keys():
-            sfx_filename = os.path.join(self.sfx_directory, SFX_MAPPINGS[user])
-            playsound(sfx_filename)
+            self.send_streamer_shoutout(user, None, priority)
         return
 
-    def auto_streamer_shoutout(self, e):
-        ''' Gives an automated streamer shoutout. '''
-        c = self.connection
-        user = self.get_username(e)
-        if user in USERS_CHECKED:
-            return
-        if user in APPROVED_AUTO_SHOUTOUT_USERS and not APPROVED_AUTO_SHOUTOUT_USERS[user]:
-            APPROVED_AUTO_SHOUTOUT_USERS[user] = True
+    def send_streamer_shoutout(self, user, channel_info, priority):
+        SHOUTOUTS_SENT.inc(self.metric_labels)
+        self.print_message_to_chat(self.format_streamer_shoutout_message(user, channel_info), priority)
+        self.sound_effects.play(user)
+
+    def auto_streamer_shoutout(self, user):
+        ''' Gives an automated streamer shoutout if user is an approved streamer who has not had one yet. '''
+        if user in self.approved_auto_shoutout_users and not self.approved_auto_shoutout_users[user]:
             self.streamer_shoutout_message(user)
-        USERS_CHECKED.add(user)
         return
 
     def update_approved_auto_shoutout_users_list(self, streamer):
         ''' Updates auto shoutout users file. This is only permitted for channel broadcaster. '''
-        if not streamer in APPROVED_AUTO_SHOUTOUT_USERS.keys():
-            APPROVED_AUTO_SHOUTOUT_USERS[streamer] = True
-            if len(APPROVED_AUTO_SHOUTOUT_USERS.keys()) > 0:
-                with open(self.auto_shoutout_users_file, 'w') as streamer_file:
-                    streamer_file.write('\n'.join(APPROVED_AUTO_SHOUTOUT_USERS.keys()))
+        if not streamer in self.approved_auto_shoutout_users.keys():
+            self.approved_auto_shoutout_users[streamer] = True
+            if len(self.approved_auto_shoutout_users.keys()) > 0:
+                # written in the background; writes to the file run in order, each with the full list at the time
+                self.run_in_background(replace_file_atomically, (self.auto_shoutout_users_file, ['\n'.join(self.approved_auto_shoutout_users.keys())]), key = self.auto_shoutout_users_file,
+                    on_error = lambda e: self.print_message_to_chat('Could not save the auto shoutout list, @%s was only added until the bot restarts.' % (streamer)))
 
     # ---------------------------------------------------------------------------------------------
     # FLOWERMONS
@@ -455,109 +3345,203 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             user_index = random.randint(0, 4095)
         return (user_index == shiny_index)
 
+    def determine_shiny_statuses(self, count, user_is_sub):
+        '''
+            Rolls count shiny statuses at once with the same odds as determine_shiny_status(),
+            vectorized with NumPy when it is installed.
+        '''
+        if numpy is None:
+            return [self.determine_shiny_status(user_is_sub) for n in range(count)]
+        shiny_index = NUMPY_RANDOM.integers(0, 4096, count)
+        if user_is_sub:
+            shiny_index_lower = numpy.maximum(shiny_index - FLOWERMONS_SUB_SHINY_DENOM, 0)
+            shiny_index_upper = numpy.minimum(shiny_index + FLOWERMONS_SUB_SHINY_DENOM, 4095)
+            user_index = NUMPY_RANDOM.integers(shiny_index_lower, shiny_index_upper + 1)
+        else:
+            user_index = NUMPY_RANDOM.integers(0, 4096, count)
+        return (user_index == shiny_index).tolist()
+
     def format_flowerdex_check_message(self, cmd_issuer, user_is_sub):
-        user_pokemon_stats = FLOWERMONS_USER_POKEDEX.get(cmd_issuer, {})
-        user_pokemon_set = user_pokemon_stats.get('CAUGHT', set())
-        user_pokemon_shiny_set = user_pokemon_stats.get('SHINY', set())
+        user_pokedex_entry = self.flowermons.user_pokedex.get(cmd_issuer)
 
-        if len(user_pokemon_set) > 0:
+        if user_pokedex_entry is not None and user_pokedex_entry.caught:
             message = '@%s your FlowerDex is %s%% complete' % (cmd_issuer, self.calculate_flowerdex_completion(cmd_issuer))
-            if len(user_pokemon_shiny_set) > 0:
-                if len(user_pokemon_shiny_set) == 1:
-                    message = message + ' (%s shiny caught!) ' % (len(user_pokemon_shiny_set))
+            num_shinies = popcount(user_pokedex_entry.shiny)
+            if num_shinies > 0:
+                if num_shinies == 1:
+                    message = message + ' (%s shiny caught!) ' % (num_shinies)
                 else:
-                    message = message + ' (%s shinies caught!) ' % (len(user_pokemon_shiny_set))
+                    message = message + ' (%s shinies caught!) ' % (num_shinies)
             message = message + ' and you have %s Flowerballs left!' % (self.get_users_pokeball_count(cmd_issuer, user_is_sub))
         else:
             message = '@%s you have not caught any pokemon yet :(' % (cmd_issuer)
         return message
 
     def check_flowerdex(self, cmd_issuer, user_is_sub):
-        c = self.connection
-        c.privmsg(self.channel, self.format_flowerdex_check_message(cmd_issuer, user_is_sub))
+        self.print_message_to_chat(self.format_flowerdex_check_message(cmd_issuer, user_is_sub))
         return
 
     def calculate_flowerdex_completion(self, cmd_issuer):
-        user_pokemon_stats = FLOWERMONS_USER_POKEDEX.get(cmd_issuer, {})
-        caught_mons = user_pokemon_stats.get('CAUGHT', set())
-        return round((100 * len(caught_mons) / len(FLOWERMONS_POKEDEX)), 1)
+        user_pokedex_entry = self.flowermons.user_pokedex.get(cmd_issuer)
+        if user_pokedex_entry is None:
+            return 0.0
+        return self.calculate_completion_value(self.flowermons.pokedex.completion_count(user_pokedex_entry.caught))
+
+    def active_flowermons_boosts(self):
+        ''' The configured boosts (on flowermons.boost_days, or every day if none are set) overridden by the !boost ones. '''
+        boosts = {}
+        if not self.flowermons_boost_days or date.today().weekday() in self.flowermons_boost_days:
+            boosts.update(self.flowermons_boosts)
+        boosts.update(self.flowermons_event_boosts)
+        return dict((target, multiplier) for target, multiplier in boosts.items() if multiplier != 1)
+
+    def update_flowermons_boosts(self):
+        ''' Called before each draw; the pokedex only rebuilds its alias table when the active boosts changed. '''
+        self.flowermons.pokedex.set_boosts(self.active_flowermons_boosts())
 
     def catch_flowermon(self, cmd_issuer, user_is_sub):
         ''' Catches random pokemon for user and stores mon in flowerdex. '''
-        c = self.connection
+        if self.burst.active:
+            self.queue_burst_catch(cmd_issuer, user_is_sub)
+            return
         pokeballs = self.get_users_pokeball_count(cmd_issuer, user_is_sub)
         if pokeballs <= 0:
-            c.privmsg(self.channel, '@%s, you do not have any flowerballs left! BibleThump' % (cmd_issuer))
+            self.print_message_to_chat('@%s, you do not have any flowerballs left! BibleThump' % (cmd_issuer))
             return
-        pokemon = random.choice(list(FLOWERMONS_POKEDEX))
+        self.update_flowermons_boosts()
+        pokedex = self.flowermons.pokedex
+        pokemon = pokedex.random_species()
         shiny_status = self.determine_shiny_status(user_is_sub)
         self.store_caught_pokemon(cmd_issuer, pokemon, shiny_status)
 
-        FLOWERMONS_USER_POKEBALLS[cmd_issuer] = pokeballs - 1
+        self.set_users_pokeball_count(cmd_issuer, pokeballs - 1)
         shiny_message = ''
         if shiny_status:
             shiny_message = ' and it was * SHINY * !!!'
-        message = '@%s caught %s%s! %s' % (cmd_issuer, pokemon.title(), shiny_message, self.format_flowerdex_check_message(cmd_issuer, user_is_sub))
-        try:
-            try:
-                if shiny_status:
-                    shiny_filename = os.path.join(self.sfx_directory, SFX_MAPPINGS['shiny'])
-                    playsound(shiny_filename)
-            except Exception as e:
-                print(e, file = OUTPUT_FILE)
-                print('Failed to play shiny sound', file = OUTPUT_FILE)
-            c.privmsg(self.channel, message)
-        except Exception as e:
-            print(e, file = OUTPUT_FILE)
-            print(message, file = OUTPUT_FILE)
-            c.privmsg(self.channel, 'whoops BibleThump @%s broke me snowpoNK' % (cmd_issuer))
+        rarity = pokedex.rarities[pokedex.ids[pokemon]]
+        rarity_message = (' (%s)' % (rarity) if rarity and rarity != FLOWERMONS_DEFAULT_RARITY else '')
+        message = '@%s caught %s%s%s! %s' % (cmd_issuer, pokemon.title(), rarity_message, shiny_message, self.format_flowerdex_check_message(cmd_issuer, user_is_sub))
+        if shiny_status:
+            self.sound_effects.play(SFX_SHINY_KEY)
+        self.print_message_to_chat(message)
         return
 
+    def catch_flowermons(self, cmd_issuer, user_is_sub, count):
+        '''
+            !catch N: throws up to count flowerballs (capped by the user's balance) in one go. Species and
+            shiny rolls are drawn in one batch, persisted with one storage write and summed up in one message.
+            It already produces a single message, so it is not queued in burst mode.
+        '''
+        pokeballs = self.get_users_pokeball_count(cmd_issuer, user_is_sub)
+        if pokeballs <= 0:
+            self.print_message_to_chat('@%s, you do not have any flowerballs left! BibleThump' % (cmd_issuer))
+            return
+        count = min(count, pokeballs)
+        self.update_flowermons_boosts()
+        pokedex = self.flowermons.pokedex
+        user_pokedex_entry = self.flowermons.user_pokedex.get(cmd_issuer)
+        caught_before = (user_pokedex_entry.caught if user_pokedex_entry is not None else 0)
+
+        catches = [(cmd_issuer, pokedex.names[species_id], shiny_status) for species_id, shiny_status in zip(pokedex.random_species_ids(count), self.determine_shiny_statuses(count, user_is_sub))]
+        for username, pokemon, shiny_status in catches:
+            self.flowermons.add_pokemon_to_user_pokedex(username, pokemon, shiny_status, update_leaderboards = False)
+        shinies = [pokemon for username, pokemon, shiny_status in catches if shiny_status]
+        FLOWERMONS_CATCHES.inc((self.channel, 'false'), len(catches) - len(shinies))
+        if shinies:
+            FLOWERMONS_CATCHES.inc((self.channel, 'true'), len(shinies))
+        self.flowermons.user_pokeballs[cmd_issuer] = pokeballs - count
+        if self.flowermons_storage is not None:
+            self.flowermons_storage.record_catches(catches, [(cmd_issuer, pokeballs - count)])
+        self.flowermons.update_leaderboards([cmd_issuer])
+
+        new_species = [pokemon.title() for pokemon in pokedex.names_for_bits(self.flowermons.user_pokedex[cmd_issuer].caught & ~caught_before)]
+        message = '@%s threw %s Flowerballs and caught %s new Flowermon%s' % (cmd_issuer, count, len(new_species), ('' if len(new_species) == 1 else 's'))
+        if new_species:
+            message += ' (%s%s)' % (', '.join(new_species[:FLOWERMONS_MULTI_CATCH_NAMES_LIMIT]), (', ...' if len(new_species) > FLOWERMONS_MULTI_CATCH_NAMES_LIMIT else ''))
+        if shinies:
+            message += ' and %s * SHINY * (%s) !!!' % (len(shinies), ', '.join(pokemon.title() for pokemon in shinies[:FLOWERMONS_MULTI_CATCH_NAMES_LIMIT]))
+            self.sound_effects.play(SFX_SHINY_KEY)
+        self.print_message_to_chat('%s! %s' % (message, self.format_flowerdex_check_message(cmd_issuer, user_is_sub)))
+
+    def queue_burst_catch(self, cmd_issuer, user_is_sub):
+        ''' In burst mode catches are resolved together at the end of a short window. '''
+        self.pending_catches.append((cmd_issuer, user_is_sub))
+        if len(self.pending_catches) == 1:
+            if self.scheduler is None:
+                self.resolve_burst_catches()
+            else:
+                self.schedule_after(self.burst_catch_window, self.resolve_burst_catches)
+
+    def resolve_burst_catches(self):
+        '''
+            Resolves the queued catches with one storage write, one leaderboard update per user
+            and a few summary messages instead of a chat line per catch.
+        '''
+        pending_catches, self.pending_catches = self.pending_catches, []
+        self.update_flowermons_boosts()
+        catches = []
+        pokeballs = {}
+        out_of_balls = []
+        caught = []
+        for cmd_issuer, user_is_sub in pending_catches:
+            num_balls = self.get_users_pokeball_count(cmd_issuer, user_is_sub)
+            if num_balls <= 0:
+                if cmd_issuer not in out_of_balls:
+                    out_of_balls.append(cmd_issuer)
+                continue
+            pokemon = self.flowermons.pokedex.random_species()
+            shiny_status = self.determine_shiny_status(user_is_sub)
+            FLOWERMONS_CATCHES.inc((self.channel, ('true' if shiny_status else 'false')))
+            self.flowermons.add_pokemon_to_user_pokedex(cmd_issuer, pokemon, shiny_status, update_leaderboards = False)
+            self.flowermons.user_pokeballs[cmd_issuer] = pokeballs[cmd_issuer] = num_balls - 1
+            catches.append((cmd_issuer, pokemon, shiny_status))
+            caught.append('@%s %s%s' % (cmd_issuer, pokemon.title(), (' (* SHINY *)' if shiny_status else '')))
+            if shiny_status:
+                self.sound_effects.play(SFX_SHINY_KEY)
+        if self.flowermons_storage is not None:
+            self.flowermons_storage.record_catches(catches, list(pokeballs.items()))
+        self.flowermons.update_leaderboards(pokeballs.keys())
+
+        for index in range(0, len(caught), BURST_CATCH_SUMMARY_LIMIT):
+            self.print_message_to_chat('Caught: %s' % (', '.join(caught[index:index + BURST_CATCH_SUMMARY_LIMIT])))
+        if out_of_balls:
+            self.print_message_to_chat('Out of flowerballs: %s BibleThump' % (', '.join('@' + cmd_issuer for cmd_issuer in out_of_balls)))
+
     def store_caught_pokemon(self, cmd_issuer, pokemon, shiny_status):
-        ''' Stores pokemon in data file for user. '''
-        user_pokemon_stats = FLOWERMONS_USER_POKEDEX.get(cmd_issuer, {})
-        user_pokemon_set = user_pokemon_stats.get('CAUGHT', set())
-        user_pokemon_shiny_set = user_pokemon_stats.get('SHINY', set())
+        ''' Stores pokemon for user and persists the catch. '''
+        FLOWERMONS_CATCHES.inc((self.channel, ('true' if shiny_status else 'false')))
+        self.flowermons.add_pokemon_to_user_pokedex(cmd_issuer, pokemon, shiny_status)
+        if self.flowermons_storage is not None:
+            self.flowermons_storage.record_catch(cmd_issuer, pokemon, shiny_status)
 
-        user_pokemon_set.add(pokemon)
-        if shiny_status:
-            user_pokemon_shiny_set.add(pokemon)
-
-        user_pokemon_stats['CAUGHT'] = user_pokemon_set
-        user_pokemon_stats['SHINY'] = user_pokemon_shiny_set
-        FLOWERMONS_USER_POKEDEX[cmd_issuer] = user_pokemon_stats
-        self.update_flowermons_user_pokedex_data_file()
-
-    def update_flowermons_user_pokedex_data_file(self):
-        ''' Updates Flowermons user data file. '''
-        with open(self.flowermons_user_data_filename, 'w') as flowermons_user_data_file:
-            for user, user_pokemon_stats in FLOWERMONS_USER_POKEDEX.items():
-                user_pokemon_set = user_pokemon_stats['CAUGHT']
-                user_pokemon_shiny_set = user_pokemon_stats['SHINY']
-                for pokemon in user_pokemon_set:
-                    shiny_status = ('SHINY' if pokemon in user_pokemon_shiny_set else '')
-                    flowermons_user_data_file.write('%s\t%s\t%s\n' % (user, pokemon, shiny_status))
+    def set_users_pokeball_count(self, username, num_balls):
+        ''' Sets number of pokeballs for user and persists the new balance. '''
+        self.flowermons.user_pokeballs[username] = num_balls
+        if self.flowermons_storage is not None:
+            self.flowermons_storage.record_pokeballs(username, num_balls)
 
     def get_users_pokeball_count(self, cmd_issuer, user_is_sub):
         ''' Returns number of pokeballs user has left. '''
-        if not cmd_issuer in FLOWERMONS_USER_POKEBALLS.keys():
+        if not cmd_issuer in self.flowermons.user_pokeballs.keys():
             if user_is_sub:
-                FLOWERMONS_USER_POKEBALLS[cmd_issuer] = self.flowermons_subscribers_pokeball_limit
+                self.flowermons.user_pokeballs[cmd_issuer] = self.flowermons_subscribers_pokeball_limit
             else:
-                FLOWERMONS_USER_POKEBALLS[cmd_issuer] = self.flowermons_default_pokeball_limit
-        return FLOWERMONS_USER_POKEBALLS[cmd_issuer]
+                self.flowermons.user_pokeballs[cmd_issuer] = self.flowermons_default_pokeball_limit
+        return self.flowermons.user_pokeballs[cmd_issuer]
+
+    def calculate_completion_value(self, num_caught):
+        return round((100 * num_caught / len(self.flowermons.pokedex)), 1)
 
     def print_flowerdex_leaders_message(self):
-        ''' Prings current FlowerDex leaders. '''
-        c = self.connection
-        if len(FLOWERMONS_USER_POKEDEX) == 0:
+        ''' Prints current FlowerDex leaders. '''
+        if len(self.flowermons.leaderboard) == 0:
             return
         flowerdex_leaders = self.get_flowerdex_leaders_set()
         message = "Current top 5 FlowerDex leaders are:  %s (%s%%)" % (', '.join(flowerdex_leaders[0][1]), flowerdex_leaders[0][0])
         if len(flowerdex_leaders) > 1:
             for flowerdex_completion_value,tied_users_by_flowerdex_completion_value in flowerdex_leaders[1:]:
                 message += "  //  %s (%s%%)" % (', '.join(tied_users_by_flowerdex_completion_value), flowerdex_completion_value)
-        c.privmsg(self.channel, message)
+        self.print_message_to_chat(message)
         return
 
     def get_flowerdex_leaders_set(self):
@@ -565,35 +3549,47 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
             Returns the 5 users with the most (unique) flowermons.
             If multiple users are tied for 5th then they are also included in the set of users returned.
         '''
-        flowerdex_completion_by_values = {}
-        for user in FLOWERMONS_USER_POKEDEX.keys():
-            flowerdex_completion_value = self.calculate_flowerdex_completion(user)
-            tied_users_by_flowerdex_completion_value = flowerdex_completion_by_values.get(flowerdex_completion_value, [])
-            tied_users_by_flowerdex_completion_value.append(user)
-            flowerdex_completion_by_values[flowerdex_completion_value] = tied_users_by_flowerdex_completion_value
-        leaders = []
-        for flowerdex_completion_value,tied_users_by_flowerdex_completion_value in sorted(flowerdex_completion_by_values.items(), key = operator.itemgetter(0), reverse = True):
-            leaders.append((flowerdex_completion_value, tied_users_by_flowerdex_completion_value))
-            if len(leaders) >= 5:
-                break
-        return leaders
+        return [(self.calculate_completion_value(num_caught), tied_users) for num_caught, tied_users in self.flowermons.leaderboard.top(FLOWERMONS_LEADERS_LIMIT)]
+
+    def print_flowerdex_shiny_leaders_message(self):
+        ''' Prints users with the most shinies caught. '''
+        if len(self.flowermons.shiny_leaderboard) == 0:
+            self.print_message_to_chat('No shinies have been caught yet BibleThump')
+            return
+        shiny_leaders = ['%s (%s)' % (', '.join(tied_users), num_shinies) for num_shinies, tied_users in self.flowermons.shiny_leaderboard.top(FLOWERMONS_LEADERS_LIMIT)]
+        self.print_message_to_chat('Current top 5 shiny hunters are:  %s' % ('  //  '.join(shiny_leaders)))
+        return
+
+    def print_flowerdex_rank_message(self, username):
+        ''' Prints user's FlowerDex rank (and shiny rank if they have caught any shinies). '''
+        user_rank = self.flowermons.leaderboard.rank(username)
+        if user_rank is None:
+            self.print_message_to_chat('@%s has not caught any pokemon yet :(' % (username))
+            return
+        rank, num_caught, num_tied = user_rank
+        message = '@%s is ranked #%s of %s on the FlowerDex leaderboard (%s%%)' % (username, rank, len(self.flowermons.leaderboard), self.calculate_completion_value(num_caught))
+        if num_tied > 1:
+            message += ' tied with %s other(s)' % (num_tied - 1)
+        shiny_rank = self.flowermons.shiny_leaderboard.rank(username)
+        if shiny_rank is not None:
+            message += ' and #%s of %s shiny hunters (%s caught)' % (shiny_rank[0], len(self.flowermons.shiny_leaderboard), shiny_rank[1])
+        self.print_message_to_chat(message)
+        return
 
     def add_balls_purchased_with_bits(self, username, num_bits_used, user_is_sub):
         ''' Add balls for users who purchase pokeballs for bits. A bonus ball is given for every 200 bits donated. '''
         balls_purchased = num_bits_used / 50
         bonus_balls = num_bits_used / 200;
         current_num_balls = self.get_users_pokeball_count(username, user_is_sub)
-        FLOWERMONS_USER_POKEBALLS[username] = math.ceil( current_num_balls + balls_purchased + bonus_balls)
-        c = self.connection
-        c.privmsg(self.channel, '%s now has %s flowerballs!' % (username, FLOWERMONS_USER_POKEBALLS[username]))
+        self.set_users_pokeball_count(username, math.ceil( current_num_balls + balls_purchased + bonus_balls))
+        self.print_message_to_chat('%s now has %s flowerballs!' % (username, self.flowermons.user_pokeballs[username]), PRIORITY_MODERATION)
         return
 
     def add_balls_by_amount(self, username, num_balls, user_is_sub):
         ''' Add balls for users who purchase pokeballs for bits. A bonus ball is given for every 200 bits donated. '''
         current_num_balls = self.get_users_pokeball_count(username, user_is_sub)
-        FLOWERMONS_USER_POKEBALLS[username] = current_num_balls + num_balls
-        c = self.connection
-        c.privmsg(self.channel, '%s now has %s flowerballs!' % (username, FLOWERMONS_USER_POKEBALLS[username]))
+        self.set_users_pokeball_count(username, current_num_balls + num_balls)
+        self.print_message_to_chat('%s now has %s flowerballs!' % (username, self.flowermons.user_pokeballs[username]), PRIORITY_MODERATION)
         return
 
     def purchase_flowerballs(self, username, purchase_type, ball_or_bits_amount, user_is_sub):
@@ -605,8 +3601,7 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         elif purchase_type == 'balls':
             self.add_balls_by_amount(username, ball_or_bits_amount, user_is_sub)
         else:
-            c = self.connection
-            c.privmsg(self.channel, '"%s" is an invalid way to add balls for a user' % (purchase_type))
+            self.print_message_to_chat('"%s" is an invalid way to add balls for a user' % (purchase_type), PRIORITY_MODERATION)
         return
 
     def splat3_reveal_day_count(self):
@@ -614,55 +3609,521 @@ class TwitchBot(irc.bot.SingleServerIRCBot):
         release_date = datetime.strptime('9/9/2022', '%m/%d/%Y')
         today = datetime.strptime(date.today().strftime('%m/%d/%Y'), '%m/%d/%Y')
         days_togo = release_date - today
-        c = self.connection
-        c.privmsg(self.channel, "xcornfETTI xcornfUN xcornfETTI ONLY %s days UNTIL SPLATOON 3 ARRIVES xcornfETTI xcornfUN xcornfETTI" % days_togo.days)
+        self.print_message_to_chat("xcornfETTI xcornfUN xcornfETTI ONLY %s days UNTIL SPLATOON 3 ARRIVES xcornfETTI xcornfUN xcornfETTI" % days_togo.days)
         return
 
     # ---------------------------------------------------------------------------------------------
-    # BOT MAIN
-    def do_command(self, e, cmd_issuer, cmd, cmd_args):
-        c = self.connection
-        user_has_mod_privileges = False
-        if self.user_is_mod(e) or cmd_issuer in self.trusted_users_list:
-            user_has_mod_privileges = True
-        user_is_sub = True #self.user_is_sub(e)
-
-        if cmd == 'splat3':
-            self.splat3_reveal_day_count()
-        elif cmd == 'death':
-            self.current_death_count(c)
-        elif cmd == 'flowermons':
-            c.privmsg(self.channel, 'The Flowermons help doc can be found here: https://github.com/xcornflowerx/flowerbot/blob/master/docs/Flowermons.md')
-            c.privmsg(self.channel, 'Flowermons commands list: !catch !flowerdex !leaders')
-        elif cmd in ['flowerdex', 'catch', 'addballs', 'leaders'] and self.flowermons_enabled:
-            if cmd == 'addballs' and cmd_issuer == self.channel_display_name:
-                username = cmd_args[0]
-                purchase_type = cmd_args[1]
-                ball_or_bits_amount = int(float(cmd_args[2]))
-                self.purchase_flowerballs(username, purchase_type, ball_or_bits_amount, user_is_sub)
+    # CUSTOM QUEUES
+
+    def do_queue_command(self, ctx, name, cmd_args):
+        ''' Handles !<queue> [leave | next | win] for one of the custom queues. '''
+        action = (cmd_args[0] if cmd_args else '')
+        if action == '':
+            self.join_queue(ctx.username, name)
+        elif action == 'leave':
+            self.leave_queue(ctx.username, name)
+        elif action in ('next', 'win'):
+            if not self.user_has_permission(ctx, PERMISSION_BROADCASTER):
+                return
+            if action == 'next':
+                self.next_in_queue(name)
+            else:
+                self.queues.win(name)
+                self.save_queue_scores()
+                self.print_queue_scores()
+        else:
+            self.print_message_to_chat('Usage: !%s [leave | next | win]' % (name))
+
+    def join_queue(self, username, name):
+        current_queue = self.queues.queue_of(username)
+        if current_queue == name:
+            self.print_message_to_chat('@%s you are already in the %s queue!' % (username, name))
+        elif current_queue is not None:
+            self.print_message_to_chat('@%s you are already in the %s queue, use "!%s leave" first if you want to join %s instead.' % (username, current_queue, current_queue, name))
+        else:
+            self.print_message_to_chat('@%s joined the %s queue (#%s)' % (username, name, self.queues.join(name, username)))
+
+    def leave_queue(self, username, name):
+        if self.queues.queue_of(username) != name:
+            self.print_message_to_chat('@%s you are not in the %s queue.' % (username, name))
+            return
+        self.queues.leave(username)
+        self.print_message_to_chat('@%s left the %s queue.' % (username, name))
+
+    def next_in_queue(self, name):
+        username, on_deck = self.queues.next(name)
+        if username is None:
+            self.print_message_to_chat('The %s queue is empty!' % (name))
+        elif on_deck is None:
+            self.print_message_to_chat('Next up for %s: @%s' % (name, username))
+        else:
+            self.print_message_to_chat('Next up for %s: @%s  //  On deck: @%s' % (name, username, on_deck))
+
+    def print_queue_scores(self):
+        self.print_message_to_chat('Current score: %s' % ('  //  '.join('%s: %s' % (name, self.queues.score(name)) for name in self.queues.queues)))
+
+    def print_queues(self, page):
+        ''' Prints one chat message worth of the queues; large queues are paged with !print <page>. '''
+        pages = self.queues.pages(TWITCH_MAX_MESSAGE_LENGTH - QUEUE_PAGE_SUFFIX_LENGTH)
+        if not pages:
+            return
+        page = min(max(page, 1), len(pages))
+        message = pages[page - 1]
+        if len(pages) > 1:
+            message += ' (page %s/%s%s)' % (page, len(pages), (', !print %s for more' % (page + 1) if page < len(pages) else ''))
+        self.print_message_to_chat(message)
+
+    # ---------------------------------------------------------------------------------------------
+    # BOT COMMANDS
+    @COMMANDS.command('splat3', help = 'days until Splatoon 3 arrives')
+    def command_splat3(self, ctx):
+        self.splat3_reveal_day_count()
+
+    @COMMANDS.command('death', help = 'current death count')
+    def command_death(self, ctx):
+        self.current_death_count()
+
+    @COMMANDS.command('deathadd', permission = PERMISSION_MOD, help = 'adds one to the death count')
+    def command_deathadd(self, ctx):
+        self.death_count += 1
+        self.print_message_to_chat("%s's current death count is now %s BibleThump" % (self.channel_display_name, self.death_count), PRIORITY_MODERATION)
+
+    @COMMANDS.command('deathreset', permission = PERMISSION_MOD, help = 'resets the death count')
+    def command_deathreset(self, ctx):
+        self.death_count = 0
+        self.print_message_to_chat("%s reset their current death count" % (self.channel_display_name), PRIORITY_MODERATION)
+
+    @COMMANDS.command('deathinit', permission = PERMISSION_MOD, args = [('count', int)], help = 'sets the death count')
+    def command_deathinit(self, ctx, count):
+        self.death_count = count
+        self.print_message_to_chat("%s initialized their current death count to %s" % (self.channel_display_name, self.death_count), PRIORITY_MODERATION)
+
+    @COMMANDS.command('so', permission = PERMISSION_MOD, aliases = ['shoutout'], args = [('username', str)], help = 'gives a streamer shoutout')
+    def command_so(self, ctx, username):
+        self.streamer_shoutout_message(username, PRIORITY_MODERATION)
+
+    @COMMANDS.command('streameraddnew', permission = PERMISSION_BROADCASTER, args = [('username', str)], help = 'adds a streamer to the auto shoutout list')
+    def command_streameraddnew(self, ctx, username):
+        self.update_approved_auto_shoutout_users_list(username)
+
+    @COMMANDS.command('newstream', permission = PERMISSION_MOD, help = 'starts a new stream session so approved streamers get their auto shoutout again')
+    def command_newstream(self, ctx):
+        self.start_session()
+        self.print_message_to_chat('Started a new stream session, auto shoutouts are reset', PRIORITY_MODERATION)
+
+    @COMMANDS.command('sendqueue', permission = PERMISSION_MOD, help = 'outbound chat queue depth and drop counters')
+    def command_sendqueue(self, ctx):
+        stats = self.outbound_scheduler.stats()
+        self.print_message_to_chat(', '.join('%s: %s' % (key, stats[key]) for key in sorted(stats.keys())), PRIORITY_MODERATION)
+
+    @COMMANDS.command('flowermons', cooldown = 30, help = 'Flowermons help doc')
+    def command_flowermons(self, ctx):
+        self.print_message_to_chat('The Flowermons help doc can be found here: https://github.com/xcornflowerx/flowerbot/blob/master/docs/Flowermons.md')
+        self.print_message_to_chat('Flowermons commands list: !catch !flowerdex !leaders !shinyleaders !rank')
+
+    @COMMANDS.command('flowerdex', flowermons = True, help = 'your FlowerDex stats')
+    def command_flowerdex(self, ctx):
+        self.check_flowerdex(ctx.username, self.user_is_sub(ctx))
+
+    @COMMANDS.command('leaders', flowermons = True, cooldown = 15, help = 'current FlowerDex leaders')
+    def command_leaders(self, ctx):
+        self.print_flowerdex_leaders_message()
+
+    @COMMANDS.command('shinyleaders', flowermons = True, cooldown = 15, help = 'users with the most shinies')
+    def command_shinyleaders(self, ctx):
+        self.print_flowerdex_shiny_leaders_message()
+
+    @COMMANDS.command('rank', flowermons = True, args = [('username', str, None)], help = 'your (or a user\'s) FlowerDex rank')
+    def command_rank(self, ctx, username):
+        self.print_flowerdex_rank_message(username or ctx.username)
+
+    @COMMANDS.command('catch', flowermons = True, args = [('count', int, 1)], help = 'catch a Flowermon (or throw count flowerballs at once)')
+    def command_catch(self, ctx, count):
+        if count > 1:
+            self.catch_flowermons(ctx.username, self.user_is_sub(ctx), count)
+        else:
+            self.catch_flowermon(ctx.username, self.user_is_sub(ctx))
+
+    @COMMANDS.command('addballs', permission = PERMISSION_BROADCASTER, flowermons = True, args = [('username', str), ('type', str), ('quantity', parse_amount)], help = 'gives a user flowerballs for bits, dollars or a number of balls')
+    def command_addballs(self, ctx, username, purchase_type, ball_or_bits_amount):
+        self.purchase_flowerballs(username, purchase_type, ball_or_bits_amount, self.user_is_sub(ctx))
+
+    @COMMANDS.command('boost', permission = PERMISSION_BROADCASTER, flowermons = True, args = [('target', str, None), ('multiplier', float, None)], help = 'sets the catch rate multiplier for a rarity tier or species (no multiplier goes back to the configured one), or lists the active boosts')
+    def command_boost(self, ctx, target, multiplier):
+        if target is not None:
+            target = target.lower()
+            if target not in FLOWERMONS_RARITY_WEIGHTS and target not in self.flowermons.pokedex.ids:
+                self.print_message_to_chat('@%s, %s is not a rarity tier (%s) or a Flowermon' % (ctx.username, target, ', '.join(FLOWERMONS_RARITY_WEIGHTS)))
+                return
+            if multiplier is not None and not multiplier >= 0:
+                self.print_message_to_chat('@%s, the multiplier cannot be negative' % (ctx.username))
                 return
-            if self.flowermons_subs_only_mode and not user_is_sub:
-                c.privmsg(self.channel, 'Flowermons is running in subs-only mode.')
+            if multiplier is None:
+                self.flowermons_event_boosts.pop(target, None)
             else:
-                if cmd == 'flowerdex':
-                    self.check_flowerdex(cmd_issuer, user_is_sub)
-                elif cmd == 'leaders':
-                    self.print_flowerdex_leaders_message()
-                elif cmd == 'catch':
-                    self.catch_flowermon(cmd_issuer, user_is_sub)
-        elif cmd == 'deathadd' and user_has_mod_privileges:
-            self.death_count += 1
-            c.privmsg(self.channel, "%s's current death count is now %s BibleThump" % (self.channel_display_name, self.death_count))
-        elif cmd == 'deathreset' and user_has_mod_privileges:
-            self.death_count = 0
-            c.privmsg(self.channel, "%s reset their current death count" % (self.channel_display_name))
-        elif cmd == 'deathinit' and user_has_mod_privileges:
-            self.death_count = int(cmd_args[0])
-            c.privmsg(self.channel, "%s initialized their current death count to %s" % (self.channel_display_name, self.death_count))
-        elif cmd == "so" and len(cmd_args) > 0 and user_has_mod_privileges:
-            self.streamer_shoutout_message(cmd_args[0])
-        elif cmd == "streameraddnew" and cmd_issuer == self.channel_display_name:
-            self.update_approved_auto_shoutout_users_list(cmd_args[0])
+                self.flowermons_event_boosts[target] = multiplier
+        boosts = self.active_flowermons_boosts()
+        if boosts:
+            self.print_message_to_chat('Active Flowermons boosts: %s' % (', '.join('%s x%g' % (name.title(), multiplier) for name, multiplier in sorted(boosts.items()))))
+        else:
+            self.print_message_to_chat('No Flowermons boosts are active')
+
+    @COMMANDS.command('queueinit', permission = PERMISSION_BROADCASTER, args = [('queuenames', str)], help = 'resets the custom queues to the given list')
+    def command_queueinit(self, ctx, queue_names):
+        queue_names = parse_queue_names(ctx.text.partition(' ')[2])
+        reserved = [name for name in queue_names if COMMANDS.lookup(name) is not None]
+        self.queues.reset([name for name in queue_names if name not in reserved])
+        if reserved:
+            self.print_message_to_chat('Queue names cannot be bot commands: %s' % (', '.join(reserved)))
+        if len(self.queues) > 0:
+            self.print_message_to_chat('Available queue(s) to join: %s' % (', '.join(self.queues.queues)))
+
+    @COMMANDS.command('print', args = [('page', int, 1)], cooldown = 10, help = 'prints who is in each queue')
+    def command_print(self, ctx, page):
+        self.print_queues(page)
+
+    @COMMANDS.command('score', cooldown = 5, help = 'prints the score for each queue')
+    def command_score(self, ctx):
+        if len(self.queues) > 0:
+            self.print_queue_scores()
+
+    @COMMANDS.command('commands', cooldown = 10, help = 'lists the commands you can use')
+    def command_commands(self, ctx):
+        available = ['!' + command.name for command in COMMANDS.list_commands() if self.command_is_available(ctx, command)]
+        self.print_message_to_chat('@%s available commands: %s' % (ctx.username, ' '.join(available)))
+
+    @COMMANDS.command('help', args = [('command', str, None)], help = 'usage for a command')
+    def command_help(self, ctx, cmd):
+        command = COMMANDS.lookup(cmd.replace('!', '')) if cmd else None
+        if command is None or not self.command_is_available(ctx, command):
+            self.command_commands(ctx)
+            return
+        self.print_message_to_chat('%s - %s' % (command.usage(), command.help))
+
+    # ---------------------------------------------------------------------------------------------
+    # BOT MAIN
+    def user_is_sub(self, ctx):
+        ''' Returns whether user is treated as a subscriber. '''
+        return True #ctx.is_sub
+
+    def user_has_permission(self, ctx, permission):
+        ''' Returns whether user meets the permission level. Only evaluated for commands that declare one. '''
+        if permission == PERMISSION_EVERYONE:
+            return True
+        if ctx.username == self.channel_display_name:
+            return True
+        if permission == PERMISSION_MOD:
+            return (ctx.is_mod or ctx.username in self.trusted_users_list)
+        return False
+
+    def command_is_available(self, ctx, command):
+        if command.flowermons and not self.flowermons_enabled:
+            return False
+        return self.user_has_permission(ctx, command.permission)
+
+    def do_command(self, ctx, cmd, cmd_args):
+        command = COMMANDS.lookup(cmd)
+        if command is None:
+            if cmd in self.queues and (self.user_is_exempt(ctx) or self.check_cooldown(ctx, cmd)):
+                self.do_queue_command(ctx, cmd, cmd_args)
+            return
+        if not self.command_is_available(ctx, command):
+            return
+        if not self.user_is_exempt(ctx) and not self.check_cooldown(ctx, command.name, command.cooldown):
+            return
+        if command.flowermons and self.flowermons_subs_only_mode and not self.user_is_sub(ctx):
+            self.print_message_to_chat('Flowermons is running in subs-only mode.')
+            return
+        try:
+            parsed_args = command.parse_args(cmd_args)
+        except ValueError:
+            self.print_message_to_chat('Usage: %s' % (command.usage()))
+            return
+        start = time.perf_counter()
+        watch = STALL_WATCHDOG.begin(self.channel, '!' + command.name, ctx.username)
+        try:
+            command.handler(self, ctx, *parsed_args)
+        finally:
+            STALL_WATCHDOG.end(watch)
+            COMMAND_LATENCY.observe((self.channel, command.name), time.perf_counter() - start)
+
+class TwitchBot(irc.bot.SingleServerIRCBot):
+    ''' Single channel connection core on the irc library's reactor. '''
+    def __init__(self, properties):
+        self.flowerbot_channel = FlowerbotChannel(properties)
+        self.channel = self.flowerbot_channel.channel
+        server = properties[IRC_CHAT_SERVER]
+        port = int(properties[IRC_CHAT_SERVER_PORT])
+
+        # Create IRC bot connection
+        print('Connecting to %s on port %s...' % (server, port), file = OUTPUT_FILE)
+        irc.bot.SingleServerIRCBot.__init__(self, [(server, port, 'oauth:'+ properties[CLIENT_SECRETS])], properties[CHANNEL], properties[BOT_USERNAME])
+
+    def send_message_to_connection(self, message):
+        self.connection.privmsg(self.channel, message)
+
+    def on_welcome(self, c, e):
+        ''' Handle welcome. '''
+        print('Joining channel: %s' % (self.channel), file = OUTPUT_FILE)
+        c.cap('REQ', ':twitch.tv/membership')
+        c.cap('REQ', ':twitch.tv/tags')
+        c.cap('REQ', ':twitch.tv/commands')
+        c.join(self.channel)
+        self.flowerbot_channel.attach(self.send_message_to_connection, self.reactor.scheduler)
+        print('Successfully joined channel, have at it!')
+
+    def on_disconnect(self, c, e):
+        ''' Holds outbound lines until on_welcome attaches the channel to the new connection. '''
+        self.flowerbot_channel.send = None
+
+    def on_userstate(self, c, e):
+        self.flowerbot_channel.handle_userstate(event_tags(e))
+
+    def on_pubmsg(self, c, e):
+        ctx = MessageContext(event_tags(e), (e.source.nick if e.source else ''), (e.arguments[0] if e.arguments else ''))
+        self.flowerbot_channel.handle_pubmsg(ctx)
+
+    def on_usernotice(self, c, e):
+        self.flowerbot_channel.handle_usernotice(event_tags(e))
+
+    def on_join(self, c, e):
+        if e.source:
+            self.flowerbot_channel.handle_join(e.source.nick)
+
+    def on_part(self, c, e):
+        if e.source:
+            self.flowerbot_channel.handle_part(e.source.nick)
+
+    def on_namreply(self, c, e):
+        # arguments are (channel type, channel, space-delimited nicks)
+        if len(e.arguments) == 3:
+            self.flowerbot_channel.handle_names(e.arguments[2].split())
+
+    def close(self):
+        self.flowerbot_channel.close()
+
+def unescape_tag_value(value):
+    ''' Unescapes an IRCv3 tag value (i.e., "\\s" is a space). '''
+    if '\\' not in value:
+        return value
+    unescaped = []
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char == '\\':
+            index += 1
+            if index < len(value):
+                unescaped.append(IRC_TAG_ESCAPES.get(value[index], value[index]))
+        else:
+            unescaped.append(char)
+        index += 1
+    return ''.join(unescaped)
+
+def parse_irc_line(line):
+    ''' Splits a raw IRC line into (tags dict, prefix, command, params). The trailing parameter is the last param. '''
+    tags = {}
+    if line.startswith('@'):
+        raw_tags, _, line = line[1:].partition(' ')
+        for tag in raw_tags.split(';'):
+            key, _, value = tag.partition('=')
+            tags[key] = unescape_tag_value(value)
+    prefix = ''
+    if line.startswith(':'):
+        prefix, _, line = line[1:].partition(' ')
+    if line.startswith(':'):
+        line, trailing = '', [line[1:]]
+    else:
+        line, separator, trailing = line.partition(' :')
+        trailing = [trailing] if separator else []
+    params = line.split()
+    command = params.pop(0).upper() if params else ''
+    return (tags, prefix, command, params + trailing)
+
+class AsyncioScheduler(object):
+    '''
+        The execute_after/execute_every interface of the irc library's scheduler, on an asyncio event loop.
+        Like the irc library's scheduler it may be called from other threads (i.e., the data file watcher).
+    '''
+    def __init__(self, loop):
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+
+    def execute_after(self, delay, function):
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(self.loop.call_later, delay, function)
+            return None
+        return self.loop.call_later(delay, function)
+
+    def execute_every(self, period, function):
+        def run():
+            self.loop.call_later(period, run)
+            function()
+        return self.loop.call_later(period, run)
+
+class AsyncTwitchConnection(object):
+    '''
+        One IRC connection carrying a shard of the channels hosted by AsyncTwitchBot.
+
+        Channels are joined in batches paced to twitch's JOIN rate limit. Lost connections
+        (or a server RECONNECT) are retried with exponential backoff and every channel is
+        re-joined and re-attached once the connection is back.
+    '''
+    def __init__(self, bot, channels, scheduler, name):
+        self.bot = bot
+        self.channels = dict((channel.channel, channel) for channel in channels)
+        self.scheduler = scheduler
+        self.name = name
+        self.reader = None
+        self.writer = None
+        self.join_task = None
+        self.welcomed = False
+        self.lines_received = 0
+
+    async def run(self):
+        reconnect_delay = RECONNECT_MIN_DELAY
+        while True:
+            self.welcomed = False
+            try:
+                await self.connect()
+                await self.read_lines()
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                print('Connection %s lost: %s' % (self.name, e), file = ERROR_FILE)
+            finally:
+                self.disconnect()
+            if self.welcomed:
+                reconnect_delay = RECONNECT_MIN_DELAY
+            print('Reconnecting %s in %s second(s)...' % (self.name, reconnect_delay), file = OUTPUT_FILE)
+            await asyncio.sleep(reconnect_delay)
+            reconnect_delay = min(2 * reconnect_delay, RECONNECT_MAX_DELAY)
+
+    async def connect(self):
+        print('Connecting %s to %s on port %s...' % (self.name, self.bot.server, self.bot.port), file = OUTPUT_FILE)
+        self.reader, self.writer = await asyncio.open_connection(self.bot.server, self.bot.port, ssl = (True if self.bot.port == TWITCH_SSL_PORT else None))
+        self.send_line('PASS oauth:%s' % (self.bot.token))
+        self.send_line('NICK %s' % (self.bot.bot_username))
+        self.send_line('CAP REQ :twitch.tv/membership twitch.tv/tags twitch.tv/commands')
+
+    def disconnect(self):
+        if self.join_task is not None:
+            self.join_task.cancel()
+            self.join_task = None
+        for channel in self.channels.values():
+            channel.send = None
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def read_lines(self):
+        while True:
+            # twitch PINGs about every five minutes, so a longer silence means the connection is dead
+            raw_line = await asyncio.wait_for(self.reader.readline(), ASYNC_READ_TIMEOUT)
+            if not raw_line:
+                raise EOFError('connection closed by server')
+            self.handle_line(raw_line.decode('utf-8', 'replace').rstrip('\r\n'))
+
+    async def join_channels(self):
+        ''' Joins every channel in batches of TWITCH_JOIN_LIMIT per TWITCH_JOIN_WINDOW seconds. '''
+        channel_names = list(self.channels.keys())
+        for index in range(0, len(channel_names), TWITCH_JOIN_LIMIT):
+            if index > 0:
+                await asyncio.sleep(TWITCH_JOIN_WINDOW)
+            batch = channel_names[index:index + TWITCH_JOIN_LIMIT]
+            self.send_line('JOIN %s' % (','.join(batch)))
+            for channel_name in batch:
+                channel = self.channels[channel_name]
+                channel.attach(functools.partial(self.privmsg, channel_name), self.scheduler)
+        print('Connection %s joined %s channel(s), have at it!' % (self.name, len(channel_names)), file = OUTPUT_FILE)
+
+    def send_line(self, line):
+        if self.writer is None:
+            raise IOError('connection %s is not connected' % (self.name))
+        self.writer.write((line + '\r\n').encode('utf-8'))
+
+    def privmsg(self, channel_name, message):
+        self.send_line('PRIVMSG %s :%s' % (channel_name, message))
+
+    def handle_line(self, line):
+        ''' Dispatches one line from the server to the channel it is for. '''
+        self.lines_received += 1
+        tags, prefix, command, params = parse_irc_line(line)
+        if command == 'PRIVMSG' and len(params) == 2:
+            channel = self.channels.get(params[0])
+            if channel is not None:
+                try:
+                    channel.handle_pubmsg(MessageContext(tags, prefix.partition('!')[0], params[1]))
+                except Exception as e:
+                    EXCEPTIONS_RAISED.inc((params[0], 'pubmsg'))
+                    print('Failed to handle message in %s: %s' % (params[0], e), file = ERROR_FILE)
+        elif command in ('JOIN', 'PART') and params and prefix:
+            channel = self.channels.get(params[0])
+            if channel is not None:
+                if command == 'JOIN':
+                    channel.handle_join(prefix.partition('!')[0])
+                else:
+                    channel.handle_part(prefix.partition('!')[0])
+        elif command == 'USERNOTICE' and params:
+            channel = self.channels.get(params[0])
+            if channel is not None:
+                channel.handle_usernotice(tags)
+        elif command == '353' and len(params) == 4:
+            channel = self.channels.get(params[2])
+            if channel is not None:
+                channel.handle_names(params[3].split())
+        elif command == 'PING':
+            self.send_line('PONG :%s' % (params[-1] if params else ''))
+        elif command == 'USERSTATE' and params:
+            channel = self.channels.get(params[0])
+            if channel is not None:
+                channel.handle_userstate(tags)
+        elif command == '001':
+            self.welcomed = True
+            self.join_task = asyncio.ensure_future(self.join_channels())
+        elif command == 'RECONNECT':
+            raise EOFError('server requested a reconnect')
+
+class AsyncTwitchBot(object):
+    '''
+        asyncio connection core hosting many channels from one process.
+
+        Each properties file describes one channel (a FlowerbotChannel with its own state);
+        the bot credentials and server come from the first file. Channels are spread over
+        as many connections as needed to keep at most server.channels_per_connection
+        channels on each.
+    '''
+    def __init__(self, properties_list):
+        properties = properties_list[0]
+        self.server = properties[IRC_CHAT_SERVER]
+        self.port = int(properties[IRC_CHAT_SERVER_PORT])
+        self.bot_username = properties[BOT_USERNAME]
+        self.token = properties[CLIENT_SECRETS]
+        self.channels_per_connection = int(properties.get(CHANNELS_PER_CONNECTION) or DEFAULT_CHANNELS_PER_CONNECTION)
+        self.channels = []
+        channel_names = set()
+        for channel_properties in properties_list:
+            if channel_properties[CHANNEL] in channel_names:
+                print('Channel %s is configured more than once' % (channel_properties[CHANNEL]), file = ERROR_FILE)
+                sys.exit(2)
+            channel_names.add(channel_properties[CHANNEL])
+            self.channels.append(FlowerbotChannel(channel_properties))
+        self.connections = []
+
+    def create_connections(self, scheduler):
+        self.connections = []
+        for index in range(0, len(self.channels), self.channels_per_connection):
+            shard = self.channels[index:index + self.channels_per_connection]
+            self.connections.append(AsyncTwitchConnection(self, shard, scheduler, 'connection-%s' % (len(self.connections) + 1)))
+        return self.connections
+
+    async def run(self):
+        scheduler = AsyncioScheduler(asyncio.get_running_loop())
+        await asyncio.gather(*[connection.run() for connection in self.create_connections(scheduler)])
+
+    def start(self):
+        asyncio.run(self.run())
+
+    def close(self):
+        for channel in self.channels:
+            channel.close()
 
 def usage(parser):
     print(parser.print_help(), file = OUTPUT_FILE)
@@ -671,16 +4132,30 @@ def usage(parser):
 def main():
     # parse command line
     parser = optparse.OptionParser()
-    parser.add_option('-p', '--properties-file', action = 'store', dest = 'propsfile', help = 'path to properties file')
+    parser.add_option('-p', '--properties-file', action = 'append', dest = 'propsfiles', help = 'path to properties file (repeat to host several channels from one process)')
+    parser.add_option('-a', '--async', action = 'store_true', dest = 'use_async', default = False, help = 'use the asyncio core (always used for more than one channel)')
+    parser.add_option('-m', '--metrics-port-offset', action = 'store', dest = 'metrics_port_offset', type = 'int', default = 0, help = 'added to metrics.port, so processes sharing a properties template serve metrics on different ports')
     (options, args) = parser.parse_args()
-    properties_filename = options.propsfile
+    properties_filenames = options.propsfiles
 
-    if not properties_filename:
+    if not properties_filenames:
         usage(parser)
-    properties = parse_properties(properties_filename)
+    properties_list = [parse_properties(properties_filename) for properties_filename in properties_filenames]
 
-    bot = TwitchBot(properties)
-    bot.start()
+    if len(properties_list) > 1 or options.use_async:
+        bot = AsyncTwitchBot(properties_list)
+    else:
+        bot = TwitchBot(properties_list[0])
+    metrics_port = int(properties_list[0].get(METRICS_PORT) or 0)
+    METRICS.start((metrics_port + options.metrics_port_offset if metrics_port else 0), float(properties_list[0].get(METRICS_LOG_INTERVAL) or 0))
+    STALL_WATCHDOG.start(float(properties_list[0].get(WATCHDOG_STALL_THRESHOLD) or 0))
+    WORKERS.configure(int(properties_list[0].get(WORKERS_THREADS) or WORKERS_DEFAULT_THREADS), int(properties_list[0].get(WORKERS_MAX_PENDING) or WORKERS_DEFAULT_MAX_PENDING),
+        int(properties_list[0].get(WORKERS_PROCESSES) or 0), float(properties_list[0].get(WORKERS_TIMEOUT) or WORKERS_DEFAULT_TIMEOUT))
+    try:
+        bot.start()
+    finally:
+        bot.close()
+        WORKERS.close()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,113 @@
+import sys
+import os
+import gc
+import optparse
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+CHAT_WORDS = ['hello', 'pog', 'lol', 'gg', 'what', 'is', 'this', 'game', 'nice', 'play', 'hype', 'the', 'boss']
+
+class NullWriter(object):
+    ''' Stands in for the asyncio stream writer; counts bytes instead of sending them. '''
+    def __init__(self):
+        self.bytes_written = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+
+    def close(self):
+        pass
+
+class NullScheduler(object):
+    def execute_after(self, delay, function):
+        pass
+
+    def execute_every(self, period, function):
+        pass
+
+def channel_properties(index, tmp_dir, flowermons_enabled):
+    properties = {
+        flowerbot.CHANNEL: 'channel%s' % (index),
+        flowerbot.CHANNEL_ID: str(index),
+        flowerbot.CLIENT_ID: 'bench',
+        flowerbot.CLIENT_SECRETS: 'bench',
+        flowerbot.BOT_USERNAME: 'flowerbot',
+        flowerbot.IRC_CHAT_SERVER: 'localhost',
+        flowerbot.IRC_CHAT_SERVER_PORT: '6667',
+        flowerbot.CHANNEL_TRUSTED_USERS_LIST: ['channel%s' % (index)],
+        # no snapshot files written into resources/data and no file-watcher thread per channel
+        flowerbot.DATA_FILES_HOT_RELOAD: 'false',
+        flowerbot.SNAPSHOT_ENABLED: 'false'
+    }
+    if flowermons_enabled:
+        properties[flowerbot.FLOWERMONS_ENABLED] = 'true'
+        properties[flowerbot.FLOWERMONS_FILENAME] = 'flowermons.txt'
+        properties[flowerbot.FLOWERMONS_USER_DATA_FILENAME] = os.path.join(tmp_dir, 'flowermons_user_data_%s.txt' % (index))
+        properties[flowerbot.FLOWERMONS_COMPACTION_INTERVAL] = '3600'
+    return properties
+
+def generate_lines(rng, num_channels, num_messages, flowermons_enabled):
+    ''' (channel, raw PRIVMSG line) pairs spread over every channel; roughly one in twenty is a command. '''
+    commands = ['!death', '!help'] + (['!catch', '!flowerdex', '!leaders'] if flowermons_enabled else [])
+    lines = []
+    for n in range(num_messages):
+        user = 'user%s' % (rng.randint(0, 999))
+        if rng.random() < 0.05:
+            text = rng.choice(commands)
+        else:
+            text = ' '.join(rng.choice(CHAT_WORDS) for i in range(rng.randint(2, 12)))
+        channel_name = '#channel%s' % (rng.randint(0, num_channels - 1))
+        lines.append((channel_name, '@badge-info=;badges=;display-name=%s;mod=0;subscriber=0 :%s!%s@%s.tmi.twitch.tv PRIVMSG %s :%s' % (user, user, user, user, channel_name, text)))
+    return lines
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--channels', action = 'store', dest = 'channels', default = '10,100,500', help = 'comma-delimited list of channel counts')
+    parser.add_option('-m', '--messages', action = 'store', dest = 'messages', type = 'int', default = 50000, help = 'number of messages per run')
+    parser.add_option('-f', '--flowermons', action = 'store_true', dest = 'flowermons', default = False, help = 'enable Flowermons (with file storage) in every channel')
+    (options, args) = parser.parse_args()
+
+    # command handlers print every command received
+    flowerbot.OUTPUT_FILE = open(os.devnull, 'w')
+    rng = random.Random(1)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%10s  %18s  %16s' % ('channels', 'KB per channel', 'msgs/s'), file = OUTPUT_FILE)
+        for num_channels in map(int, options.channels.split(',')):
+            gc.collect()
+            tracemalloc.start()
+            bot = flowerbot.AsyncTwitchBot([channel_properties(index, tmp_dir, options.flowermons) for index in range(num_channels)])
+            connections = bot.create_connections(NullScheduler())
+            kb_per_channel = tracemalloc.get_traced_memory()[0] / 1024.0 / num_channels
+            tracemalloc.stop()
+
+            channel_connections = {}
+            for connection in connections:
+                connection.writer = NullWriter()
+                for channel_name, channel in connection.channels.items():
+                    channel.attach(lambda message, connection = connection, channel_name = channel_name: connection.privmsg(channel_name, message), NullScheduler())
+                    channel_connections[channel_name] = connection
+
+            lines = generate_lines(rng, num_channels, options.messages, options.flowermons)
+            start = time.perf_counter()
+            for channel_name, line in lines:
+                channel_connections[channel_name].handle_line(line)
+            elapsed = time.perf_counter() - start
+            bot.close()
+            print('%10s  %18.1f  %16.0f' % (num_channels, kb_per_channel, len(lines) / elapsed), file = OUTPUT_FILE)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
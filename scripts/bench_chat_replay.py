@@ -0,0 +1,336 @@
+import sys
+import os
+import functools
+import gc
+import json
+import optparse
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import irc.client
+import irc.message
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+CHANNEL_NAME = 'benchchannel'
+DEFAULT_RESULTS_FILE = 'chat_replay_results.jsonl'
+CHAT_WORDS = ['hello', 'pog', 'lol', 'gg', 'what', 'is', 'this', 'game', 'nice', 'play', 'hype', 'the', 'boss', 'clip', 'that']
+EVERYONE_COMMANDS = ['!death', '!help', '!commands', '!help death', '!splat3', '!flowermons']
+FLOWERMONS_COMMANDS = ['!catch', '!catch', '!catch', '!flowerdex', '!leaders', '!shinyleaders', '!rank']
+MOD_COMMANDS = ['!deathadd', '!so someone', '!sendqueue']
+BADGE_SETS = ['', 'subscriber/12', 'subscriber/3,premium/1', 'moderator/1', 'vip/1', 'founder/0', 'bits/1000']
+ALLOCATION_SAMPLE_SIZE = 2000 # messages replayed under tracemalloc (it slows every allocation down)
+CORE_IRC = 'irc'
+CORE_ASYNC = 'async'
+
+class FakeConnection(object):
+    ''' Stands in for the connection's privmsg(); captures what the bot sends. '''
+    def __init__(self):
+        self.messages = []
+
+    def privmsg(self, message):
+        self.messages.append(message)
+
+class NullWriter(object):
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class NullScheduler(object):
+    ''' Drops timers, so the outbound queue only drains when new messages are queued. '''
+    def execute_after(self, delay, function):
+        pass
+
+    def execute_every(self, period, function):
+        pass
+
+def privmsg_line(user, text, badges = '', bits = None):
+    ''' Returns a raw tagged PRIVMSG line like twitch sends. '''
+    tags = 'badge-info=;badges=%s;color=#1E90FF;display-name=%s;emotes=;first-msg=0;id=%s;mod=%s;subscriber=%s;tmi-sent-ts=%s;turbo=0;user-id=%s;user-type=' % (badges, user, random.getrandbits(64), int('moderator/' in badges), int('subscriber/' in badges), int(time.time() * 1000), abs(hash(user)) % 100000000)
+    if bits:
+        tags += ';bits=%s' % (bits)
+    return '@%s :%s!%s@%s.tmi.twitch.tv PRIVMSG #%s :%s' % (tags, user, user, user, CHANNEL_NAME, text)
+
+def chatter(rng, num_users):
+    return 'user%s' % (rng.randint(0, num_users - 1))
+
+def chat_text(rng):
+    return ' '.join(rng.choice(CHAT_WORDS) for i in range(rng.randint(2, 12)))
+
+# ---------------------------------------------------------------------------------------------
+# scenarios: each returns (properties overrides, raw lines, setup(channel) or None)
+
+def scenario_chatter(rng, options, tmp_dir):
+    ''' Plain chat with about one command in twenty. '''
+    lines = []
+    for n in range(options.messages):
+        text = rng.choice(EVERYONE_COMMANDS) if rng.random() < 0.05 else chat_text(rng)
+        lines.append(privmsg_line(chatter(rng, 1000), text, rng.choice(BADGE_SETS)))
+    return {}, lines, None
+
+def scenario_commands(rng, options, tmp_dir):
+    ''' Every message is a command, including mod commands and flowermons. '''
+    properties = flowermons_properties(tmp_dir)
+    commands = EVERYONE_COMMANDS + FLOWERMONS_COMMANDS
+    lines = []
+    for n in range(options.messages):
+        if rng.random() < 0.1:
+            lines.append(privmsg_line(chatter(rng, 20), rng.choice(MOD_COMMANDS), 'moderator/1'))
+        else:
+            lines.append(privmsg_line(chatter(rng, 1000), rng.choice(commands), rng.choice(BADGE_SETS)))
+    return properties, lines, None
+
+def scenario_raid(rng, options, tmp_dir):
+    ''' Raid bursts: thousands of first-time chatters spamming the raid message, some of them approved streamers. '''
+    approved_streamers = ['raider%s' % (n) for n in range(0, options.messages, 50)]
+    auto_shoutout_users_file = os.path.join(tmp_dir, 'approved_streamers.txt')
+    with open(auto_shoutout_users_file, 'w', encoding = "utf8") as streamer_file:
+        streamer_file.write('\n'.join(approved_streamers))
+    lines = []
+    for n in range(options.messages):
+        text = rng.choice(['xcornfRAID xcornfRAID xcornfRAID', 'RAID HYPE', 'hi chat!', '!catch'])
+        lines.append(privmsg_line('raider%s' % (n), text, rng.choice(BADGE_SETS)))
+    properties = flowermons_properties(tmp_dir)
+    properties[flowerbot.AUTO_SHOUTOUT_USERS_FILE] = auto_shoutout_users_file
+    return properties, lines, None
+
+def scenario_autobot(rng, options, tmp_dir):
+    ''' A large auto bot response table; a fifth of the messages hit an exact trigger or keyword. '''
+    triggers = ['keyword%s' % (n) for n in range(options.autobot_responses)]
+    auto_bot_responses_file = os.path.join(tmp_dir, 'autobot_responses.txt')
+    with open(auto_bot_responses_file, 'w', encoding = "utf8") as responses_file:
+        responses_file.write('MESSAGE\tRESPONSE\n')
+        for trigger in triggers:
+            responses_file.write('%s\tresponse for %s\n' % (trigger, trigger))
+    lines = []
+    for n in range(options.messages):
+        roll = rng.random()
+        if roll < 0.1:
+            text = rng.choice(triggers)
+        elif roll < 0.2:
+            text = '%s %s %s' % (chat_text(rng), rng.choice(triggers), chat_text(rng))
+        else:
+            text = chat_text(rng)
+        lines.append(privmsg_line(chatter(rng, 1000), text, rng.choice(BADGE_SETS)))
+    return {flowerbot.AUTOBOT_RESPONSES_FILE: auto_bot_responses_file}, lines, None
+
+def scenario_flowermons(rng, options, tmp_dir):
+    ''' Flowermons commands against a large FlowerDex history. '''
+    def setup(channel):
+        flowermons = channel.flowermons
+        species = list(flowermons.pokedex.names)
+        history_rng = random.Random(2)
+        for user in range(options.flowermons_users):
+            username = 'user%s' % (user)
+            for pokemon in history_rng.sample(species, min(len(species), history_rng.randint(1, 60))):
+                flowermons.add_pokemon_to_user_pokedex(username, pokemon, (history_rng.randint(0, 511) == 0), update_leaderboards = False)
+            flowermons.user_pokeballs[username] = 1000000
+        flowermons.rebuild_leaderboards()
+    lines = []
+    for n in range(options.messages):
+        text = rng.choice(FLOWERMONS_COMMANDS) if rng.random() < 0.5 else chat_text(rng)
+        lines.append(privmsg_line(chatter(rng, options.flowermons_users), text, rng.choice(BADGE_SETS)))
+    return flowermons_properties(tmp_dir), lines, setup
+
+def scenario_replay(rng, options, tmp_dir):
+    ''' Raw IRC lines from --replay-file (one per line, optionally prefixed with a timestamp and a tab). '''
+    lines = []
+    with open(options.replay_file, 'r', encoding = "utf8") as replay_file:
+        for line in replay_file:
+            line = line.rstrip('\r\n').split('\t')[-1]
+            if ' PRIVMSG ' in line:
+                # retarget every channel in the recording at the bench channel
+                tags, prefix, command, params = flowerbot.parse_irc_line(line)
+                lines.append(line.replace(' PRIVMSG %s ' % (params[0]), ' PRIVMSG #%s ' % (CHANNEL_NAME), 1))
+    return flowermons_properties(tmp_dir), lines, None
+
+SCENARIOS = [
+    ('chatter', scenario_chatter),
+    ('commands', scenario_commands),
+    ('raid', scenario_raid),
+    ('autobot', scenario_autobot),
+    ('flowermons', scenario_flowermons),
+    ('replay', scenario_replay)
+]
+
+def flowermons_properties(tmp_dir):
+    return {
+        flowerbot.FLOWERMONS_ENABLED: 'true',
+        flowerbot.FLOWERMONS_FILENAME: 'flowermons.txt',
+        flowerbot.FLOWERMONS_USER_DATA_FILENAME: os.path.join(tmp_dir, 'flowermons_user_data.txt'),
+        flowerbot.FLOWERMONS_COMPACTION_INTERVAL: '3600'
+    }
+
+def create_channel(overrides):
+    properties = {
+        flowerbot.CHANNEL: CHANNEL_NAME,
+        flowerbot.CHANNEL_ID: '1',
+        flowerbot.CLIENT_ID: 'bench',
+        flowerbot.CLIENT_SECRETS: 'bench',
+        flowerbot.BOT_USERNAME: 'flowerbot',
+        flowerbot.IRC_CHAT_SERVER: 'localhost',
+        flowerbot.IRC_CHAT_SERVER_PORT: '6667',
+        flowerbot.CHANNEL_TRUSTED_USERS_LIST: [CHANNEL_NAME],
+        flowerbot.DATA_FILES_HOT_RELOAD: 'false',
+        flowerbot.SNAPSHOT_ENABLED: 'false'
+    }
+    properties.update(overrides)
+    return flowerbot.FlowerbotChannel(properties)
+
+def irc_event(line):
+    ''' Builds the irc library's pubmsg event for a raw PRIVMSG line, with tags parsed the way the library parses them. '''
+    tags, prefix, command, params = flowerbot.parse_irc_line(line)
+    raw_tags = (line[1:].partition(' ')[0] if line.startswith('@') else '')
+    return irc.client.Event('pubmsg', irc.client.NickMask(prefix), params[0], [params[-1]], irc.message.Tag.from_group(raw_tags))
+
+def message_handler(core, channel, lines):
+    '''
+        Returns (handle, messages) where handle(message) runs one message through the core's
+        per-message path. The irc library core is driven through TwitchBot.on_pubmsg (event_tags,
+        MessageContext and FlowerbotChannel.handle_pubmsg) with __init__ bypassed, since it connects
+        to the server; events are built before the timed loop, so the library's own line parsing is
+        not measured. The asyncio core is driven through AsyncTwitchConnection.handle_line, which
+        includes its IRC parsing.
+    '''
+    if core == CORE_IRC:
+        bot = flowerbot.TwitchBot.__new__(flowerbot.TwitchBot)
+        bot.flowerbot_channel = channel
+        bot.channel = channel.channel
+        return (functools.partial(bot.on_pubmsg, None), [irc_event(line) for line in lines])
+    connection = flowerbot.AsyncTwitchConnection(None, [channel], NullScheduler(), 'bench')
+    connection.writer = NullWriter()
+    return (connection.handle_line, lines)
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def run_scenario(name, scenario, options):
+    ''' Replays the scenario's lines through the per-message path of options.core and returns its results. '''
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        overrides, lines, setup = scenario(random.Random(1), options, tmp_dir)
+        channel = create_channel(overrides)
+        if setup is not None:
+            setup(channel)
+        fake_connection = FakeConnection()
+        channel.attach(fake_connection.privmsg, NullScheduler())
+        channel.outbound_scheduler.set_moderator(True)
+        handle_message, messages = message_handler(options.core, channel, lines)
+        perf_counter_ns = time.perf_counter_ns
+
+        gc.collect()
+        latencies = []
+        start = perf_counter_ns()
+        for message in messages:
+            message_start = perf_counter_ns()
+            handle_message(message)
+            latencies.append(perf_counter_ns() - message_start)
+        elapsed = (perf_counter_ns() - start) / 1e9
+        latencies.sort()
+
+        # allocations are measured in a second pass over a sample, tracemalloc would skew the timings above
+        sample = messages[:ALLOCATION_SAMPLE_SIZE]
+        gc.collect()
+        tracemalloc.start()
+        allocated = 0
+        for message in sample:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            handle_message(message)
+            allocated += tracemalloc.get_traced_memory()[1] - before
+        tracemalloc.stop()
+        channel.close()
+        return {
+            'scenario': name,
+            'core': options.core,
+            'messages': len(lines),
+            'msgs_per_sec': round(len(lines) / elapsed, 1),
+            'p50_us': round(percentile(latencies, 0.50) / 1e3, 2),
+            'p99_us': round(percentile(latencies, 0.99) / 1e3, 2),
+            'alloc_bytes_per_msg': round(allocated / float(max(1, len(sample))), 1),
+            'sent': len(fake_connection.messages)
+        }
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd = os.path.dirname(os.path.abspath(flowerbot.__file__)), stderr = subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def load_previous_results(results_filename):
+    ''' Returns (scenario, core) -> results from the most recent saved runs (results saved before --core existed are async). '''
+    if not os.path.exists(results_filename):
+        return {}
+    with open(results_filename, 'r', encoding = "utf8") as results_file:
+        runs = [json.loads(line) for line in results_file if line.strip()]
+    return dict(((results['scenario'], results.get('core', CORE_ASYNC)), results) for run in runs for results in run['results'])
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-s', '--scenarios', action = 'store', dest = 'scenarios', default = 'chatter,commands,raid,autobot,flowermons', help = 'comma-delimited list of scenarios: %s' % (', '.join(name for name, scenario in SCENARIOS)))
+    parser.add_option('-c', '--core', action = 'store', dest = 'core', default = CORE_IRC, help = 'connection core whose per-message path is measured: %s (default, TwitchBot.on_pubmsg) or %s (AsyncTwitchConnection.handle_line)' % (CORE_IRC, CORE_ASYNC))
+    parser.add_option('-m', '--messages', action = 'store', dest = 'messages', type = 'int', default = 20000, help = 'number of messages per synthetic scenario')
+    parser.add_option('-a', '--autobot-responses', action = 'store', dest = 'autobot_responses', type = 'int', default = 5000, help = 'size of the auto bot response table in the autobot scenario')
+    parser.add_option('-u', '--flowermons-users', action = 'store', dest = 'flowermons_users', type = 'int', default = 50000, help = 'users with FlowerDex history in the flowermons scenario')
+    parser.add_option('-r', '--replay-file', action = 'store', dest = 'replay_file', default = None, help = 'recorded IRC lines for the replay scenario')
+    parser.add_option('-o', '--results-file', action = 'store', dest = 'results_file', default = DEFAULT_RESULTS_FILE, help = 'JSON lines file results are appended to and compared against')
+    parser.add_option('-n', '--no-save', action = 'store_false', dest = 'save', default = True, help = 'do not append this run to the results file')
+    (options, args) = parser.parse_args()
+
+    scenario_names = [name.strip() for name in options.scenarios.split(',') if name.strip()]
+    scenarios = dict(SCENARIOS)
+    for name in scenario_names:
+        if name not in scenarios:
+            print('Unknown scenario "%s"' % (name), file = ERROR_FILE)
+            sys.exit(2)
+    if options.core not in (CORE_IRC, CORE_ASYNC):
+        print('Unknown core "%s"' % (options.core), file = ERROR_FILE)
+        sys.exit(2)
+    if 'replay' in scenario_names and not options.replay_file:
+        print('The replay scenario needs --replay-file', file = ERROR_FILE)
+        sys.exit(2)
+
+    # command handlers print every command received
+    flowerbot.OUTPUT_FILE = open(os.devnull, 'w')
+    revision = git_revision()
+    previous = load_previous_results(options.results_file)
+    results = []
+    print('%12s  %9s  %12s  %10s  %10s  %14s  %10s' % ('scenario', 'messages', 'msgs/s', 'p50 (us)', 'p99 (us)', 'alloc B/msg', 'vs prev'), file = OUTPUT_FILE)
+    for name in scenario_names:
+        scenario_results = run_scenario(name, scenarios[name], options)
+        results.append(scenario_results)
+        change = ''
+        if (name, options.core) in previous:
+            change = '%+.1f%%' % (100.0 * (scenario_results['msgs_per_sec'] / previous[(name, options.core)]['msgs_per_sec'] - 1))
+        print('%12s  %9s  %12.0f  %10.2f  %10.2f  %14.0f  %10s' % (name, scenario_results['messages'], scenario_results['msgs_per_sec'], scenario_results['p50_us'], scenario_results['p99_us'], scenario_results['alloc_bytes_per_msg'], change), file = OUTPUT_FILE)
+
+    if options.save:
+        run = {
+            'revision': revision,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': {'core': options.core, 'messages': options.messages, 'autobot_responses': options.autobot_responses, 'flowermons_users': options.flowermons_users, 'replay_file': options.replay_file},
+            'results': results
+        }
+        with open(options.results_file, 'a', encoding = "utf8") as results_file:
+            results_file.write(json.dumps(run) + '\n')
+        print('Saved results for %s to %s' % (revision, options.results_file), file = OUTPUT_FILE)
+
+if __name__ == '__main__':
+    main()
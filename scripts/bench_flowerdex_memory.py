@@ -0,0 +1,74 @@
+import sys
+import os
+import gc
+import optparse
+import random
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+POKEDEX = flowerbot.FlowermonsPokedex()
+
+def generate_catches(rng, species, num_users, mean_caught):
+    ''' Yields (username, pokemon, shiny) rows like the Flowermons user data file. '''
+    for user in range(num_users):
+        for pokemon in rng.sample(species, min(len(species), max(1, int(rng.expovariate(1.0 / mean_caught))))):
+            yield ('user%s' % (user), pokemon, (rng.randint(0, 511) == 0))
+
+def build_legacy_pokedex(rows):
+    ''' The pre-bitset layout: per-user dict of two sets of species names. '''
+    user_pokedex = {}
+    for username, pokemon, shiny_status in rows:
+        user_pokemon_stats = user_pokedex.setdefault(username, {'CAUGHT': set(), 'SHINY': set()})
+        user_pokemon_stats['CAUGHT'].add(pokemon)
+        if shiny_status:
+            user_pokemon_stats['SHINY'].add(pokemon)
+    return user_pokedex
+
+def build_bitset_pokedex(rows):
+    flowermons = flowerbot.FlowermonsState()
+    flowermons.pokedex = POKEDEX
+    for username, pokemon, shiny_status in rows:
+        flowermons.add_pokemon_to_user_pokedex(username, pokemon, shiny_status, update_leaderboards = False)
+    flowermons.rebuild_leaderboards()
+    return flowermons.user_pokedex
+
+def measure(build, rows):
+    ''' Returns (bytes allocated by the structure, seconds to build it). '''
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    user_pokedex = build(rows)
+    elapsed = time.perf_counter() - start
+    allocated = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return allocated, elapsed
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-u', '--users', action = 'store', dest = 'users', type = 'int', default = 100000, help = 'number of users')
+    parser.add_option('-c', '--mean-caught', action = 'store', dest = 'mean_caught', type = 'int', default = 40, help = 'mean number of unique mons caught per user')
+    parser.add_option('-f', '--flowermons-file', action = 'store', dest = 'flowermons_file', default = os.path.join(flowerbot.FLOWERMONS_DIRECTORY, 'flowermons.txt'), help = 'species file')
+    (options, args) = parser.parse_args()
+
+    with open(options.flowermons_file, 'r', encoding = "utf8") as flowermons_file:
+        species = [species[0] for species in map(flowerbot.parse_flowermons_species, flowermons_file) if species is not None]
+    for pokemon in species:
+        POKEDEX.add(pokemon)
+
+    rows = list(generate_catches(random.Random(1), species, options.users, options.mean_caught))
+    scale = 100000.0 / options.users
+    print('%s users, %s species, %s catch rows' % (options.users, len(species), len(rows)), file = OUTPUT_FILE)
+    print('%14s  %20s  %14s' % ('layout', 'MB per 100k users', 'build (s)'), file = OUTPUT_FILE)
+    for name, build in [('sets', build_legacy_pokedex), ('bitsets', build_bitset_pokedex)]:
+        allocated, elapsed = measure(build, rows)
+        print('%14s  %20.1f  %14.2f' % (name, scale * allocated / (1024.0 * 1024.0), elapsed), file = OUTPUT_FILE)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import sys
+import os
+import optparse
+import random
+import shutil
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+def populate_user_pokedex(num_rows, num_species = 358):
+    ''' Returns a FlowermonsState with roughly num_rows (user, pokemon) rows. '''
+    flowermons = flowerbot.FlowermonsState()
+    num_users = max(1, num_rows // 50)
+    for row in range(num_rows):
+        flowermons.add_pokemon_to_user_pokedex('user%s' % (row % num_users), 'mon%s' % (row % num_species), (row % 4096 == 0), update_leaderboards = False)
+    return flowermons
+
+def full_rewrite(flowermons, filename):
+    ''' The pre-journal persistence path: rewrite every row on every catch. '''
+    with open(filename, 'w') as flowermons_user_data_file:
+        for user, user_pokedex_entry in flowermons.user_pokedex.items():
+            for pokemon in flowermons.pokedex.names_for_bits(user_pokedex_entry.caught):
+                shiny_status = ('SHINY' if user_pokedex_entry.shiny & (1 << flowermons.pokedex.species_id(pokemon)) else '')
+                flowermons_user_data_file.write('%s\t%s\t%s\n' % (user, pokemon, shiny_status))
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-r', '--rows', action = 'store', dest = 'rows', default = '1000,10000,100000,1000000', help = 'comma-delimited list of user data file sizes (rows)')
+    parser.add_option('-n', '--catches', action = 'store', dest = 'catches', type = 'int', default = 1000, help = 'number of catches to time per size')
+    (options, args) = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        print('%10s  %22s  %22s' % ('rows', 'journal (us/catch)', 'full rewrite (us/catch)'), file = OUTPUT_FILE)
+        for num_rows in map(int, options.rows.split(',')):
+            flowermons = populate_user_pokedex(num_rows)
+            user_data_filename = os.path.join(tmp_dir, 'flowermons_user_data_%s.txt' % (num_rows))
+            full_rewrite(flowermons, user_data_filename)
+
+            journal = flowerbot.FlowermonsJournal(flowermons, user_data_filename, compaction_interval = 3600)
+            journal.open()
+            journal_seconds = timeit.timeit(lambda: journal.record_catch('user%s' % (random.randint(0, 999)), 'mon1', False), number = options.catches)
+            journal.close()
+
+            rewrite_catches = max(1, min(options.catches, 1000000 // num_rows))
+            rewrite_seconds = timeit.timeit(lambda: full_rewrite(flowermons, user_data_filename), number = rewrite_catches)
+
+            print('%10s  %22.2f  %22.2f' % (num_rows, 1e6 * journal_seconds / options.catches, 1e6 * rewrite_seconds / rewrite_catches), file = OUTPUT_FILE)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+import sys
+import os
+import optparse
+import random
+import string
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+def random_word(rng):
+    return ''.join(rng.choice(string.ascii_lowercase) for i in range(rng.randint(2, 8)))
+
+def generate_triggers(rng, num_triggers):
+    ''' Mix of single keywords and multi-word trigger phrases. '''
+    return [' '.join(random_word(rng) for i in range(rng.choice([1, 1, 2, 3]))) for n in range(num_triggers)]
+
+def generate_messages(rng, triggers, num_messages):
+    ''' Chat-like messages where roughly one in ten contains a trigger phrase. '''
+    messages = []
+    for n in range(num_messages):
+        words = [random_word(rng) for i in range(rng.randint(3, 15))]
+        if rng.random() < 0.1:
+            words.insert(rng.randint(0, len(words)), rng.choice(triggers))
+        messages.append(' '.join(words))
+    return messages
+
+def token_lookup(responses, message):
+    ''' The pre-matcher approach: look up every whitespace token in the responses dict. '''
+    return [v for v in message.split(' ') if v in responses]
+
+def messages_per_second(func, messages):
+    start = time.perf_counter()
+    for message in messages:
+        func(message)
+    return len(messages) / (time.perf_counter() - start)
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-t', '--triggers', action = 'store', dest = 'triggers', default = '10,100,1000,5000,10000', help = 'comma-delimited list of trigger table sizes')
+    parser.add_option('-m', '--messages', action = 'store', dest = 'messages', type = 'int', default = 20000, help = 'number of messages per run')
+    parser.add_option('-s', '--seed', action = 'store', dest = 'seed', type = 'int', default = 1, help = 'random seed')
+    (options, args) = parser.parse_args()
+
+    rng = random.Random(options.seed)
+    print('%10s  %14s  %16s  %18s' % ('triggers', 'build (ms)', 'matcher (msg/s)', 'token dict (msg/s)'), file = OUTPUT_FILE)
+    for num_triggers in map(int, options.triggers.split(',')):
+        triggers = generate_triggers(rng, num_triggers)
+        messages = generate_messages(rng, triggers, options.messages)
+        responses = dict.fromkeys(triggers)
+
+        start = time.perf_counter()
+        matcher = flowerbot.KeywordMatcher(triggers)
+        build_ms = 1000 * (time.perf_counter() - start)
+
+        matcher_rate = messages_per_second(matcher.find_all, messages)
+        token_rate = messages_per_second(lambda message: token_lookup(responses, message), messages)
+        print('%10s  %14.1f  %16.0f  %18.0f' % (num_triggers, build_ms, matcher_rate, token_rate), file = OUTPUT_FILE)
+
+if __name__ == '__main__':
+    main()
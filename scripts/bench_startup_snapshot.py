@@ -0,0 +1,101 @@
+import sys
+import os
+import gc
+import optparse
+import random
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import flowerbot
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+def write_user_data_files(rng, user_data_filename, species, num_rows):
+    ''' Writes num_rows catch rows (and a pokeball balance per user) in the journal's snapshot file format. '''
+    num_users = max(1, num_rows // 40)
+    users_species = {}
+    with open(user_data_filename, 'w', encoding = "utf8") as user_data_file:
+        for row in range(num_rows):
+            user = 'user%s' % (row % num_users)
+            # distinct species per user, so every row is a real catch
+            pokemon = species[(users_species.setdefault(user, rng.randrange(len(species))) + row // num_users) % len(species)]
+            user_data_file.write('%s\t%s\t%s\n' % (user, pokemon, ('SHINY' if rng.randint(0, 511) == 0 else '')))
+    with open(user_data_filename + '.pokeballs', 'w', encoding = "utf8") as pokeballs_file:
+        for user in range(num_users):
+            pokeballs_file.write('user%s\t%s\n' % (user, rng.randint(0, 10)))
+
+def load_text(flowermons_filename, user_data_filename):
+    ''' The text path: parse the species file and both user data snapshot files. '''
+    flowermons = flowerbot.FlowermonsState()
+    with open(flowermons_filename, 'r', encoding = "utf8") as flowermons_file:
+        for species in map(flowerbot.parse_flowermons_species, flowermons_file):
+            if species is not None:
+                flowermons.pokedex.add(species[0], weight = species[2], rarity = species[1])
+    journal = flowerbot.FlowermonsJournal(flowermons, user_data_filename)
+    journal.load_user_data_snapshot()
+    journal.load_pokeballs_snapshot()
+    flowermons.rebuild_leaderboards()
+    return flowermons
+
+def load_snapshot(snapshot_filename, sources):
+    ''' The snapshot path: one bulk read, source check and decode. '''
+    snapshot = flowerbot.ChannelSnapshot(snapshot_filename)
+    snapshot.load()
+    flowermons = flowerbot.decode_flowermons_state(snapshot.get(flowerbot.SNAPSHOT_FLOWERMONS, sources))
+    flowermons.rebuild_leaderboards()
+    return flowermons
+
+def best_of(repeat, load, *args):
+    ''' Returns the fastest of repeat cold loads (seconds) and the last result. '''
+    best = None
+    for n in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        flowermons = load(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, flowermons
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-r', '--rows', action = 'store', dest = 'rows', type = 'int', default = 1000000, help = 'number of catch rows in the user data file')
+    parser.add_option('-n', '--repeat', action = 'store', dest = 'repeat', type = 'int', default = 3, help = 'loads per path; the fastest is reported')
+    parser.add_option('-f', '--flowermons-file', action = 'store', dest = 'flowermons_file', default = os.path.join(flowerbot.FLOWERMONS_DIRECTORY, 'flowermons.txt'), help = 'species file')
+    (options, args) = parser.parse_args()
+
+    with open(options.flowermons_file, 'r', encoding = "utf8") as flowermons_file:
+        species = [species[0] for species in map(flowerbot.parse_flowermons_species, flowermons_file) if species is not None]
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        user_data_filename = os.path.join(tmp_dir, 'flowermons_user_data.txt')
+        snapshot_filename = os.path.join(tmp_dir, 'bench.snapshot')
+        write_user_data_files(random.Random(1), user_data_filename, species, options.rows)
+
+        flowermons = load_text(options.flowermons_file, user_data_filename)
+        sources = flowerbot.data_file_sources(options.flowermons_file, user_data_filename, user_data_filename + '.pokeballs')
+        snapshot = flowerbot.ChannelSnapshot(snapshot_filename)
+        snapshot.put(flowerbot.SNAPSHOT_FLOWERMONS, sources, flowerbot.encode_flowermons_state(flowermons.pokedex, [(user, entry.caught, entry.shiny) for user, entry in flowermons.user_pokedex.items()], flowermons.user_pokeballs.items()))
+        snapshot.save()
+
+        text_seconds, text_flowermons = best_of(options.repeat, load_text, options.flowermons_file, user_data_filename)
+        snapshot_seconds, snapshot_flowermons = best_of(options.repeat, load_snapshot, snapshot_filename, sources)
+        if snapshot_flowermons.user_pokeballs != text_flowermons.user_pokeballs or len(snapshot_flowermons.user_pokedex) != len(text_flowermons.user_pokedex):
+            print('Snapshot does not match the text files!', file = ERROR_FILE)
+            sys.exit(1)
+
+        text_bytes = sum(os.path.getsize(filename) for filename in [options.flowermons_file, user_data_filename, user_data_filename + '.pokeballs'])
+        print('%s catch rows, %s users' % (options.rows, len(text_flowermons.user_pokedex)), file = OUTPUT_FILE)
+        print('%10s  %12s  %14s' % ('path', 'size (MB)', 'startup (s)'), file = OUTPUT_FILE)
+        print('%10s  %12.1f  %14.3f' % ('text', text_bytes / (1024.0 * 1024.0), text_seconds), file = OUTPUT_FILE)
+        print('%10s  %12.1f  %14.3f' % ('snapshot', os.path.getsize(snapshot_filename) / (1024.0 * 1024.0), snapshot_seconds), file = OUTPUT_FILE)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import sys
+import json
+import optparse
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+GAMES = ['Splatoon 3', 'Pokemon Scarlet', 'Stardew Valley', 'Hollow Knight', 'Just Chatting']
+MISSING_USER_PREFIX = 'nouser' # logins starting with this do not exist
+
+class FakeHelixServer(ThreadingHTTPServer):
+    '''
+        Local stand-in for the Twitch Helix endpoints flowerbot uses (users, channels and
+        teams/channel), so shoutout lookups can be exercised without twitch credentials.
+        Point a channel at it with helix.url=http://localhost:<port>/helix.
+
+        Every login except those starting with "nouser" exists; ids and games are derived from
+        the login. Requests over the rate limit get a 429 with Ratelimit-* headers like twitch
+        (plus Retry-After). Every answered request is kept in request_log as (path, status).
+    '''
+    daemon_threads = True
+
+    def __init__(self, address, rate_limit, rate_window, latency, team_name, team_members):
+        ThreadingHTTPServer.__init__(self, address, FakeHelixRequestHandler)
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self.latency = latency
+        self.team_name = team_name
+        self.team_members = team_members
+        self.lock = threading.Lock()
+        self.window_start = time.time()
+        self.window_requests = 0
+        self.request_log = []
+
+    def take_request(self):
+        ''' Returns (allowed, remaining, reset) for the current rate limit window. '''
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= self.rate_window:
+                self.window_start = now
+                self.window_requests = 0
+            self.window_requests += 1
+            reset = int(self.window_start + self.rate_window) + 1
+            return (self.window_requests <= self.rate_limit, max(0, self.rate_limit - self.window_requests), reset)
+
+def user_id(login):
+    return str(zlib.crc32(login.encode('utf-8')))
+
+class FakeHelixRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        allowed, remaining, reset = self.server.take_request()
+        if not allowed:
+            self.send_json(429, {'error': 'Too Many Requests', 'status': 429}, remaining, reset)
+            return
+        if url.path.endswith('/users'):
+            logins = params.get('login', [])
+            data = [{'id': user_id(login), 'login': login, 'display_name': login} for login in logins if not login.startswith(MISSING_USER_PREFIX)]
+        elif url.path.endswith('/channels'):
+            data = [{'broadcaster_id': broadcaster_id, 'game_name': GAMES[int(broadcaster_id) % len(GAMES)]} for broadcaster_id in params.get('broadcaster_id', [])]
+        elif url.path.endswith('/teams/channel'):
+            member_ids = set(user_id(login) for login in self.server.team_members)
+            data = ([{'team_name': self.server.team_name}] if params.get('broadcaster_id', [''])[0] in member_ids else None)
+        else:
+            self.send_json(404, {'error': 'Not Found', 'status': 404}, remaining, reset)
+            return
+        self.send_json(200, {'data': data}, remaining, reset)
+
+    def send_json(self, status, body, remaining, reset):
+        payload = json.dumps(body).encode('utf-8')
+        with self.server.lock:
+            self.server.request_log.append((self.path, status))
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.send_header('Ratelimit-Limit', str(self.server.rate_limit))
+        self.send_header('Ratelimit-Remaining', str(remaining))
+        self.send_header('Ratelimit-Reset', str(reset))
+        if status == 429:
+            self.send_header('Retry-After', str(max(0, reset - int(time.time()))))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        print('%s %s' % (time.strftime('%H:%M:%S'), format % args), file = OUTPUT_FILE)
+        OUTPUT_FILE.flush()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('-p', '--port', action = 'store', dest = 'port', type = 'int', default = 8080, help = 'port to listen on')
+    parser.add_option('-r', '--rate-limit', action = 'store', dest = 'rate_limit', type = 'int', default = 800, help = 'requests allowed per rate limit window')
+    parser.add_option('-w', '--rate-window', action = 'store', dest = 'rate_window', type = 'float', default = 60.0, help = 'rate limit window (seconds)')
+    parser.add_option('-l', '--latency', action = 'store', dest = 'latency', type = 'float', default = 0.0, help = 'seconds to wait before answering each request')
+    parser.add_option('-t', '--team-name', action = 'store', dest = 'team_name', default = 'spawnpoint', help = 'team returned for team members')
+    parser.add_option('-m', '--team-members', action = 'store', dest = 'team_members', default = '', help = 'comma-delimited list of logins on the team')
+    (options, args) = parser.parse_args()
+
+    team_members = [login.strip().lower() for login in options.team_members.split(',') if login.strip()]
+    server = FakeHelixServer(('localhost', options.port), options.rate_limit, options.rate_window, options.latency, options.team_name, team_members)
+    print('Fake Helix API listening on http://localhost:%s/helix' % (options.port), file = OUTPUT_FILE)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,390 @@
+import sys
+import asyncio
+import optparse
+import random
+import re
+import time
+
+# ---------------------------------------------------------------------------------------------
+# globals
+OUTPUT_FILE = sys.stdout
+ERROR_FILE = sys.stderr
+
+SERVER_NAME = 'tmi.twitch.tv'
+CHAT_WORDS = ['hello', 'pog', 'lol', 'gg', 'what', 'is', 'this', 'game', 'nice', 'play', 'hype', 'the', 'boss', 'clip', 'that']
+CHAT_COMMANDS = ['!death', '!commands', '!help death', '!flowermons', '!catch', '!flowerdex', '!leaders', '!rank']
+BADGE_SETS = ['', 'subscriber/12', 'subscriber/3,premium/1', 'vip/1', 'founder/0', 'bits/1000']
+SUPPORTED_CAPS = ['twitch.tv/membership', 'twitch.tv/tags', 'twitch.tv/commands']
+PROBE_PATTERN = re.compile(r'\b(probe\d+)\b')
+CHANNEL_PATTERN = re.compile(r' (PRIVMSG|USERNOTICE|JOIN|PART|CLEARCHAT|ROOMSTATE) #\S+')
+RATE_LIMIT_WINDOW = 30 # seconds twitch counts bot messages over (20 per window, 100 as a mod)
+LOAD_TICK = 0.005 # seconds between load generator wakeups; messages due in between are sent together
+
+def privmsg_line(user, channel, text, badges = ''):
+    ''' Returns a tagged PRIVMSG line like twitch sends. '''
+    tags = 'badge-info=;badges=%s;color=#1E90FF;display-name=%s;emotes=;first-msg=0;id=%s;mod=%s;subscriber=%s;tmi-sent-ts=%s;turbo=0;user-id=%s;user-type=' % (badges, user, random.getrandbits(64), int('moderator/' in badges), int('subscriber/' in badges), int(time.time() * 1000), abs(hash(user)) % 100000000)
+    return '@%s :%s!%s@%s.%s PRIVMSG %s :%s' % (tags, user, user, user, SERVER_NAME, channel, text)
+
+def raid_line(raider, channel, viewers):
+    return '@badge-info=;badges=;display-name=%s;login=%s;msg-id=raid;msg-param-displayName=%s;msg-param-login=%s;msg-param-viewerCount=%s;system-msg=%s\\sviewers\\sare\\sraiding;tmi-sent-ts=%s :%s USERNOTICE %s' % (raider, raider, raider, raider, viewers, viewers, int(time.time() * 1000), SERVER_NAME, channel)
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+class Recorder(object):
+    '''
+        Timestamped log of everything on the wire, one "timestamp<tab>direction<tab>line" per line.
+        direction is "send" (server to bot), "recv" (bot to server) or "event". The chat load lines
+        can be fed straight back into scripts/bench_chat_replay.py --replay-file or --script here.
+    '''
+    def __init__(self, filename):
+        self.record_file = (open(filename, 'w', encoding = "utf8") if filename else None)
+
+    def write(self, direction, line):
+        if self.record_file is not None:
+            self.record_file.write('%.6f\t%s\t%s\n' % (time.time(), direction, line))
+
+    def close(self):
+        if self.record_file is not None:
+            self.record_file.close()
+
+class FakeTwitchClient(object):
+    ''' One bot connection: registration, CAP negotiation, joined channels and the lines the bot sends. '''
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.nick = None
+        self.caps = set()
+        self.channels = []
+
+    def send_line(self, line):
+        if self.writer is None:
+            return
+        self.server.recorder.write('send', line)
+        self.writer.write((line + '\r\n').encode('utf-8'))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    async def run(self):
+        try:
+            while True:
+                raw_line = await self.reader.readline()
+                if not raw_line:
+                    break
+                self.handle_line(raw_line.decode('utf-8', 'replace').rstrip('\r\n'))
+                await self.writer.drain()
+        except (ConnectionError, AttributeError, asyncio.CancelledError):
+            pass
+        finally:
+            self.close()
+            self.server.client_closed(self)
+
+    def handle_line(self, line):
+        self.server.recorder.write('recv', line)
+        command, _, rest = line.partition(' ')
+        if command == 'PASS':
+            return
+        elif command == 'NICK':
+            self.nick = rest.strip().lower()
+            for numeric, text in [('001', 'Welcome, GLHF!'), ('002', 'Your host is %s' % (SERVER_NAME)), ('003', 'This server is rather new'), ('004', '-'), ('375', '-'), ('372', 'You are in a maze of twisty passages, all alike.'), ('376', '>')]:
+                self.send_line(':%s %s %s :%s' % (SERVER_NAME, numeric, self.nick, text))
+        elif command == 'USER':
+            return
+        elif command == 'CAP':
+            subcommand, _, requested = rest.partition(' ')
+            requested = requested.lstrip(':').split()
+            if subcommand == 'REQ':
+                acked = all(cap in SUPPORTED_CAPS for cap in requested)
+                if acked:
+                    self.caps.update(requested)
+                self.send_line(':%s CAP * %s :%s' % (SERVER_NAME, ('ACK' if acked else 'NAK'), ' '.join(requested)))
+        elif command == 'JOIN':
+            for channel in rest.split(','):
+                self.join(channel.strip().lower())
+        elif command == 'PART':
+            channel = rest.strip().lower()
+            if channel in self.channels:
+                self.channels.remove(channel)
+                self.send_line(':%s!%s@%s.%s PART %s' % (self.nick, self.nick, self.nick, SERVER_NAME, channel))
+        elif command == 'PING':
+            self.send_line(':%s PONG %s %s' % (SERVER_NAME, SERVER_NAME, rest))
+        elif command == 'PONG':
+            self.server.stats.pong_received()
+        elif command == 'PRIVMSG':
+            channel, _, message = rest.partition(' :')
+            self.server.stats.bot_message(message)
+
+    def join(self, channel):
+        if channel in self.channels:
+            return
+        self.channels.append(channel)
+        if 'twitch.tv/membership' in self.caps:
+            self.send_line(':%s!%s@%s.%s JOIN %s' % (self.nick, self.nick, self.nick, SERVER_NAME, channel))
+        self.send_line(':%s.%s 353 %s = %s :%s' % (self.nick, SERVER_NAME, self.nick, channel, ' '.join([self.nick] + self.server.viewers[:20])))
+        self.send_line(':%s.%s 366 %s %s :End of /NAMES list' % (self.nick, SERVER_NAME, self.nick, channel))
+        if 'twitch.tv/commands' in self.caps:
+            badges = ('moderator/1' if self.server.bot_is_mod else '')
+            self.send_line('@badge-info=;badges=%s;color=;display-name=%s;emote-sets=0;mod=%s;subscriber=0;user-type=%s :%s USERSTATE %s' % (badges, self.nick, int(self.server.bot_is_mod), ('mod' if self.server.bot_is_mod else ''), SERVER_NAME, channel))
+            self.send_line('@emote-only=0;followers-only=-1;r9k=0;room-id=%s;slow=0;subs-only=0 :%s ROOMSTATE %s' % (abs(hash(channel)) % 100000000, SERVER_NAME, channel))
+        self.server.channel_joined(self)
+
+    def send_chat(self, line):
+        ''' Sends a chat line, stripping tags if the bot did not ask for them. '''
+        if 'twitch.tv/tags' not in self.caps and line.startswith('@'):
+            line = line.partition(' ')[2]
+        self.send_line(line)
+
+class LoadStats(object):
+    ''' What the bot did with the load: reply throughput, probe round trips, pacing and reconnects. '''
+    def __init__(self):
+        self.start = time.time()
+        self.lines_sent = 0
+        self.bot_messages = 0
+        self.bot_message_times = []
+        self.probes_sent = {}
+        self.probe_latencies = []
+        self.pings_sent = 0
+        self.pongs_received = 0
+        self.disconnects = []
+        self.rejoin_delays = []
+
+    def bot_message(self, message):
+        now = time.time()
+        self.bot_messages += 1
+        self.bot_message_times.append(now)
+        for probe in PROBE_PATTERN.findall(message):
+            sent = self.probes_sent.pop(probe, None)
+            if sent is not None:
+                self.probe_latencies.append(now - sent)
+
+    def pong_received(self):
+        self.pongs_received += 1
+
+    def max_messages_per_window(self):
+        ''' Most bot messages in any RATE_LIMIT_WINDOW seconds (to check the outbound pacing). '''
+        times = self.bot_message_times
+        most = 0
+        first = 0
+        for last in range(len(times)):
+            while times[last] - times[first] >= RATE_LIMIT_WINDOW:
+                first += 1
+            most = max(most, last - first + 1)
+        return most
+
+    def summary(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        lines = [
+            'elapsed:             %.1f s' % (elapsed),
+            'chat lines sent:     %s (%.1f/s)' % (self.lines_sent, self.lines_sent / elapsed),
+            'bot messages:        %s (%.2f/s, at most %s in any %s s)' % (self.bot_messages, self.bot_messages / elapsed, self.max_messages_per_window(), RATE_LIMIT_WINDOW),
+            'probe round trips:   %s answered, %s unanswered, p50 %.1f ms, p99 %.1f ms, max %.1f ms' % (len(self.probe_latencies), len(self.probes_sent), 1000 * percentile(self.probe_latencies, 0.5), 1000 * percentile(self.probe_latencies, 0.99), 1000 * max(self.probe_latencies or [0])),
+            'pings:               %s sent, %s answered' % (self.pings_sent, self.pongs_received),
+            'disconnects:         %s, rejoined after %s' % (len(self.disconnects), (', '.join('%.1f s' % (delay) for delay in self.rejoin_delays) or '-'))
+        ]
+        return '\n'.join(lines)
+
+class FakeTwitchServer(object):
+    '''
+        Local stand-in for irc.chat.twitch.tv that speaks the twitch IRCv3 dialect: CAP REQ/ACK for
+        membership, tags and commands, tagged PRIVMSG, JOIN/PART/NAMES, USERSTATE, USERNOTICE raids,
+        PING/PONG and RECONNECT. Point a bot at it with server.url=localhost and server.port=<port>.
+
+        Once the bot joins, chat load is sent to its channels at a fixed rate (or replayed from a
+        script), with probe commands whose replies are timed end to end. Connections can be dropped
+        or sent RECONNECT on a timer to see how quickly the bot comes back.
+    '''
+    def __init__(self, options, recorder):
+        self.options = options
+        self.recorder = recorder
+        self.stats = LoadStats()
+        self.clients = []
+        self.joined = asyncio.Event()
+        self.rng = random.Random(options.seed)
+        self.viewers = ['viewer%s' % (n) for n in range(options.users)]
+        self.viewers_joined = set()
+        self.bot_is_mod = options.bot_is_mod
+        self.probe_count = 0
+
+    def channel_joined(self, client):
+        if self.stats.disconnects and len(self.stats.rejoin_delays) < len(self.stats.disconnects):
+            self.stats.rejoin_delays.append(time.time() - self.stats.disconnects[-1])
+            self.recorder.write('event', 'rejoined %s' % (client.channels[-1]))
+        self.joined.set()
+
+    def client_closed(self, client):
+        if client in self.clients:
+            self.clients.remove(client)
+            self.recorder.write('event', 'closed %s' % (client.nick))
+        if not any(client.channels for client in self.clients):
+            self.joined.clear()
+
+    async def handle_connection(self, reader, writer):
+        client = FakeTwitchClient(self, reader, writer)
+        self.clients.append(client)
+        self.recorder.write('event', 'connected %s' % (writer.get_extra_info('peername'),))
+        await client.run()
+
+    def targets(self):
+        return [(client, channel) for client in self.clients for channel in client.channels]
+
+    def send_to_channel(self, line):
+        ''' Sends line to a random joined channel (retargeted at it); returns False if nobody is joined. '''
+        targets = self.targets()
+        if not targets:
+            return False
+        client, channel = self.rng.choice(targets)
+        client.send_chat(CHANNEL_PATTERN.sub(lambda match: ' %s %s' % (match.group(1), channel), line, 1))
+        self.stats.lines_sent += 1
+        return True
+
+    def synthetic_lines(self):
+        ''' Endless chat: mostly plain messages, some commands, first-time chatters JOIN before talking. '''
+        rng = self.rng
+        while True:
+            user = rng.choice(self.viewers)
+            if user not in self.viewers_joined:
+                self.viewers_joined.add(user)
+                yield None, ':%s!%s@%s.%s JOIN #channel' % (user, user, user, SERVER_NAME)
+            if rng.random() < self.options.commands:
+                text = rng.choice(CHAT_COMMANDS)
+            else:
+                text = ' '.join(rng.choice(CHAT_WORDS) for n in range(rng.randint(2, 12)))
+            yield None, privmsg_line(user, '#channel', text, rng.choice(BADGE_SETS))
+
+    def script_lines(self):
+        ''' Lines from --script, optionally prefixed with "timestamp<tab>" (and a direction, as recorded here). '''
+        with open(self.options.script, 'r', encoding = "utf8") as script_file:
+            for line in script_file:
+                fields = line.rstrip('\r\n').split('\t')
+                if len(fields) == 3 and fields[1] != 'send':
+                    continue
+                if not CHANNEL_PATTERN.search(fields[-1]):
+                    continue
+                yield (float(fields[0]) if len(fields) > 1 else None), fields[-1]
+
+    async def run_load(self):
+        await self.joined.wait()
+        loop = asyncio.get_event_loop()
+        interval = (1.0 / self.options.rate if self.options.rate > 0 else 0)
+        start = next_time = loop.time()
+        script_start = None
+        sent = 0
+        for timestamp, line in (self.script_lines() if self.options.script else self.synthetic_lines()):
+            if self.options.messages and sent >= self.options.messages:
+                break
+            if timestamp is not None:
+                # replay the script's own timing, scaled by --speed
+                if script_start is None:
+                    script_start = timestamp
+                next_time = start + (timestamp - script_start) / self.options.speed
+            delay = next_time - loop.time()
+            if delay > LOAD_TICK:
+                await asyncio.sleep(delay)
+            while not self.send_to_channel(line):
+                await self.joined.wait()
+            sent += 1
+            if timestamp is None:
+                next_time += interval
+        print('Chat load done (%s lines)' % (sent), file = OUTPUT_FILE)
+
+    async def run_probes(self):
+        ''' Sends a uniquely tagged command every probe interval and times the bot's reply. '''
+        while True:
+            await asyncio.sleep(self.options.probe_interval)
+            if not self.targets():
+                continue
+            self.probe_count += 1
+            probe = 'probe%s' % (self.probe_count)
+            self.stats.probes_sent[probe] = time.time()
+            self.send_to_channel(privmsg_line('probemod', '#channel', self.options.probe_command.replace('{probe}', probe), 'moderator/1'))
+
+    async def run_raids(self):
+        while True:
+            await asyncio.sleep(self.options.raid_interval)
+            self.send_to_channel(raid_line('raider%s' % (self.rng.randint(0, 999)), '#channel', self.rng.randint(10, 2000)))
+
+    async def run_pings(self):
+        while True:
+            await asyncio.sleep(self.options.ping_interval)
+            for client in list(self.clients):
+                self.stats.pings_sent += 1
+                client.send_line('PING :%s' % (SERVER_NAME))
+
+    async def run_disconnects(self):
+        while True:
+            await asyncio.sleep(self.options.disconnect_interval)
+            if not self.clients:
+                continue
+            self.stats.disconnects.append(time.time())
+            for client in list(self.clients):
+                if self.options.disconnect_mode == 'reconnect':
+                    self.recorder.write('event', 'RECONNECT %s' % (client.nick))
+                    client.send_line(':%s RECONNECT' % (SERVER_NAME))
+                else:
+                    self.recorder.write('event', 'dropped %s' % (client.nick))
+                    client.close()
+                    self.client_closed(client)
+
+    async def run(self):
+        server = await asyncio.start_server(self.handle_connection, self.options.host, self.options.port)
+        print('Fake twitch IRC server listening on %s:%s' % (self.options.host, self.options.port), file = OUTPUT_FILE)
+        tasks = [asyncio.ensure_future(self.run_load()), asyncio.ensure_future(self.run_pings())]
+        if self.options.probe_interval > 0:
+            tasks.append(asyncio.ensure_future(self.run_probes()))
+        if self.options.raid_interval > 0:
+            tasks.append(asyncio.ensure_future(self.run_raids()))
+        if self.options.disconnect_interval > 0:
+            tasks.append(asyncio.ensure_future(self.run_disconnects()))
+        try:
+            if self.options.duration > 0:
+                await asyncio.sleep(self.options.duration)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            for task in tasks:
+                task.cancel()
+            server.close()
+            for client in list(self.clients):
+                client.close()
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--host', action = 'store', dest = 'host', default = 'localhost', help = 'address to listen on')
+    parser.add_option('-p', '--port', action = 'store', dest = 'port', type = 'int', default = 6667, help = 'port to listen on')
+    parser.add_option('-r', '--rate', action = 'store', dest = 'rate', type = 'float', default = 20.0, help = 'chat lines per second sent to the bot (synthetic load)')
+    parser.add_option('-n', '--messages', action = 'store', dest = 'messages', type = 'int', default = 0, help = 'stop the load after this many chat lines (0 for no limit)')
+    parser.add_option('-d', '--duration', action = 'store', dest = 'duration', type = 'float', default = 0.0, help = 'seconds to run before printing the summary and exiting (0 runs until ctrl-c)')
+    parser.add_option('-u', '--users', action = 'store', dest = 'users', type = 'int', default = 1000, help = 'distinct chatters in the synthetic load')
+    parser.add_option('-c', '--commands', action = 'store', dest = 'commands', type = 'float', default = 0.05, help = 'fraction of synthetic chat lines that are commands')
+    parser.add_option('-s', '--script', action = 'store', dest = 'script', default = None, help = 'replay raw IRC lines from this file (i.e., a recording) instead of synthetic chat')
+    parser.add_option('--speed', action = 'store', dest = 'speed', type = 'float', default = 1.0, help = 'speed up (or slow down) the timing of a timestamped script')
+    parser.add_option('--probe-interval', action = 'store', dest = 'probe_interval', type = 'float', default = 1.0, help = 'seconds between timed probe commands (0 turns them off)')
+    parser.add_option('--probe-command', action = 'store', dest = 'probe_command', default = '!so {probe}', help = 'probe command sent by a mod; {probe} is replaced with a token the reply must contain')
+    parser.add_option('--raid-interval', action = 'store', dest = 'raid_interval', type = 'float', default = 0.0, help = 'seconds between raid USERNOTICEs (0 for none)')
+    parser.add_option('--ping-interval', action = 'store', dest = 'ping_interval', type = 'float', default = 60.0, help = 'seconds between server PINGs')
+    parser.add_option('--disconnect-interval', action = 'store', dest = 'disconnect_interval', type = 'float', default = 0.0, help = 'seconds between forced disconnects (0 for none)')
+    parser.add_option('--disconnect-mode', action = 'store', dest = 'disconnect_mode', default = 'drop', help = 'how to disconnect: drop (close the socket) or reconnect (send RECONNECT)')
+    parser.add_option('--bot-not-mod', action = 'store_false', dest = 'bot_is_mod', default = True, help = 'send the bot a USERSTATE without the moderator badge (20 messages per 30 s)')
+    parser.add_option('-o', '--record', action = 'store', dest = 'record', default = None, help = 'file to record every line (with timestamps) to')
+    parser.add_option('--seed', action = 'store', dest = 'seed', type = 'int', default = 1, help = 'random seed for the synthetic load')
+    (options, args) = parser.parse_args()
+
+    recorder = Recorder(options.record)
+    server = FakeTwitchServer(options, recorder)
+    try:
+        asyncio.run(server.run())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+        print(server.stats.summary(), file = OUTPUT_FILE)
+
+if __name__ == '__main__':
+    main()
@@ -1,20 +1,187 @@
 import sys
 import os
+import glob
+import optparse
+import signal
 import subprocess
+import time
 
 # ---------------------------------------------------------------------------------------------
 # globals
 OUTPUT_FILE = sys.stdout
 ERROR_FILE = sys.stderr
 
+DEFAULT_CHANNELS_DIRECTORY = os.path.join('resources', 'channels')
+DEFAULT_PROPERTIES_FILE = os.path.join('resources', 'bot.properties')
+PROPERTIES_FILE_PATTERN = '*.properties'
+
+POLL_INTERVAL = 1.0
+RESTART_MIN_DELAY = 1
+RESTART_MAX_DELAY = 300
+STABLE_RUNTIME = 300 # a worker that stays up this long (seconds) starts over with a clean failure count
+MAX_CONSECUTIVE_FAILURES = 5 # after this many crashes in a row a worker's channels are split up, or quarantined if it only has one
+CONFIGURATION_ERROR_STATUS = 2 # flowerbot exits with 2 on missing properties/files, restarting will not help
+SHUTDOWN_TIMEOUT = 30
+
+class Worker(object):
+    '''
+        One flowerbot process and the channel properties files it serves. Channels usually share a
+        properties template, so each worker serves metrics on metrics.port plus its index.
+    '''
+    def __init__(self, index, flowerbot_home):
+        self.index = index
+        self.name = 'worker-%s' % (index + 1)
+        self.flowerbot_home = flowerbot_home
+        self.properties_files = []
+        self.process = None
+        self.started = None
+        self.failures = 0
+        self.restart_at = None
+        self.retired = False
+
+    def start(self):
+        command = [sys.executable, os.path.join(self.flowerbot_home, 'flowerbot.py'), '--async', '--metrics-port-offset', str(self.index)]
+        for properties_file in self.properties_files:
+            command.extend(['--properties-file', properties_file])
+        # flowerbot resolves resources/ from its working directory; its own session keeps a ctrl-c
+        # in the terminal from reaching it before the supervisor asks it to stop
+        self.process = subprocess.Popen(command, cwd = self.flowerbot_home, start_new_session = True)
+        self.started = time.time()
+        self.restart_at = None
+        print('Started %s (pid %s) with %s channel(s)' % (self.name, self.process.pid, len(self.properties_files)), file = OUTPUT_FILE)
+
+    def is_running(self):
+        return (self.process is not None and self.process.poll() is None)
+
+    def stop(self):
+        ''' Interrupts the worker so it flushes its data, killing it if it does not exit in time. '''
+        if self.is_running():
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(SHUTDOWN_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                print('%s did not exit within %s seconds, killing it' % (self.name, SHUTDOWN_TIMEOUT), file = ERROR_FILE)
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+class Supervisor(object):
+    '''
+        Runs the channels over a pool of flowerbot worker processes (one per CPU by default).
+
+        Channels are sharded round-robin over the workers and each worker hosts its shard on
+        the asyncio core. A worker that exits is restarted with exponential backoff.
+
+        A worker that keeps crashing never hands its channels to healthy workers, since one bad
+        channel would then take those down too. Instead its channels are split over two workers
+        (bisecting down to the failing channel), and a single channel that keeps crashing its
+        worker is quarantined: it is logged and not restarted again.
+    '''
+    def __init__(self, flowerbot_home, properties_files, num_workers):
+        self.workers = [Worker(index, flowerbot_home) for index in range(num_workers)]
+        for index, properties_file in enumerate(properties_files):
+            self.workers[index % num_workers].properties_files.append(properties_file)
+        self.stopping = False
+
+    def live_workers(self):
+        return [worker for worker in self.workers if not worker.retired]
+
+    def run(self):
+        for worker in self.workers:
+            worker.start()
+        while not self.stopping:
+            time.sleep(POLL_INTERVAL)
+            now = time.time()
+            for worker in self.live_workers():
+                if worker.process is None:
+                    if now >= worker.restart_at:
+                        worker.start()
+                    continue
+                status = worker.process.poll()
+                if status is not None:
+                    self.handle_exit(worker, status, now)
+
+    def handle_exit(self, worker, status, now):
+        worker.process = None
+        if status == CONFIGURATION_ERROR_STATUS:
+            print('%s exited with a configuration error, not restarting channels: %s' % (worker.name, ', '.join(worker.properties_files)), file = ERROR_FILE)
+            worker.retired = True
+            worker.properties_files = []
+            self.stop_if_no_workers_left()
+            return
+        if now - worker.started >= STABLE_RUNTIME:
+            worker.failures = 0
+        worker.failures += 1
+        if worker.failures >= MAX_CONSECUTIVE_FAILURES:
+            self.isolate(worker, status)
+            return
+        restart_delay = min(RESTART_MIN_DELAY * 2 ** (worker.failures - 1), RESTART_MAX_DELAY)
+        worker.restart_at = now + restart_delay
+        print('%s exited with status %s, restarting in %s second(s)' % (worker.name, status, restart_delay), file = ERROR_FILE)
+
+    def isolate(self, worker, status):
+        '''
+            Splits the channels of a worker that keeps crashing over itself and a new worker, each
+            starting over with a clean failure count, or quarantines the channel if it only has one.
+        '''
+        if len(worker.properties_files) == 1:
+            print('%s exited with status %s %s times in a row, quarantining channel %s (it will not be restarted)' % (worker.name, status, worker.failures, worker.properties_files[0]), file = ERROR_FILE)
+            worker.retired = True
+            self.stop_if_no_workers_left()
+            return
+        split = len(worker.properties_files) // 2
+        new_worker = Worker(len(self.workers), worker.flowerbot_home)
+        new_worker.properties_files = worker.properties_files[split:]
+        worker.properties_files = worker.properties_files[:split]
+        worker.failures = 0
+        self.workers.append(new_worker)
+        print('%s exited with status %s %s times in a row, splitting its channels with %s to find the failing one' % (worker.name, status, MAX_CONSECUTIVE_FAILURES, new_worker.name), file = ERROR_FILE)
+        worker.start()
+        new_worker.start()
+
+    def stop_if_no_workers_left(self):
+        if not self.live_workers():
+            print('No workers left, shutting down', file = ERROR_FILE)
+            self.stopping = True
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            worker.stop()
+
+def find_properties_files(flowerbot_home, channels_directory):
+    ''' Returns the per-channel properties files, falling back to resources/bot.properties. '''
+    properties_files = sorted(glob.glob(os.path.join(channels_directory, PROPERTIES_FILE_PATTERN)))
+    if not properties_files:
+        default_properties_file = os.path.join(flowerbot_home, DEFAULT_PROPERTIES_FILE)
+        if os.path.isfile(default_properties_file):
+            properties_files = [default_properties_file]
+    return [os.path.abspath(properties_file) for properties_file in properties_files]
+
 def main():
     FLOWERBOT_HOME = os.getenv('FLOWERBOT_HOME')
     if not FLOWERBOT_HOME or not os.path.isdir(FLOWERBOT_HOME):
-        print >> ERROR_FILE, 'Could not resolve path for FLOWERBOT_HOME - please check that this variable exists in sys environment!'
+        print('Could not resolve path for FLOWERBOT_HOME - please check that this variable exists in sys environment!', file = ERROR_FILE)
+        sys.exit(2)
+
+    parser = optparse.OptionParser()
+    parser.add_option('-d', '--channels-directory', action = 'store', dest = 'channels_directory', default = os.path.join(FLOWERBOT_HOME, DEFAULT_CHANNELS_DIRECTORY), help = 'directory of per-channel properties files (*.properties)')
+    parser.add_option('-w', '--workers', action = 'store', dest = 'workers', type = 'int', default = os.cpu_count() or 1, help = 'number of worker processes, defaults to the CPU count')
+    (options, args) = parser.parse_args()
+
+    properties_files = find_properties_files(FLOWERBOT_HOME, options.channels_directory)
+    if not properties_files:
+        print('No channel properties files found in %s' % (options.channels_directory), file = ERROR_FILE)
         sys.exit(2)
 
-    script_call = 'python %s/scripts/flowerbot.py --properties-file %s/resources/bot.properties' % (FLOWERBOT_HOME, FLOWERBOT_HOME)
-    status = subprocess.call(script_call, shell = True)
+    supervisor = Supervisor(FLOWERBOT_HOME, properties_files, max(1, min(options.workers, len(properties_files))))
+    signal.signal(signal.SIGTERM, lambda signum, frame: setattr(supervisor, 'stopping', True))
+    try:
+        supervisor.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        supervisor.stop()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,61 @@
+import random
+
+import flowerbot
+
+SPECIES = ['bulbasaur', 'pikachu', 'mewtwo', 'mew', 'eevee']
+
+def new_state():
+    flowermons = flowerbot.FlowermonsState()
+    for pokemon in SPECIES:
+        flowermons.pokedex.add(pokemon)
+    return flowermons
+
+def assert_matches_rebuild(leaderboard, scores):
+    ''' An incrementally updated leaderboard must rank exactly like one rebuilt from the same scores. '''
+    rebuilt = flowerbot.FlowerDexLeaderboard()
+    rebuilt.rebuild(scores)
+    assert leaderboard.scores == rebuilt.scores
+    assert leaderboard.top() == rebuilt.top()
+    for user in scores:
+        assert leaderboard.rank(user) == rebuilt.rank(user)
+
+def test_users_without_shinies_are_not_in_the_shiny_leaderboard():
+    flowermons = new_state()
+    # the !catch N path: catches are added without leaderboard updates, then each catcher is updated
+    flowermons.add_pokemon_to_user_pokedex('carol', 'pikachu', False, update_leaderboards = False)
+    flowermons.add_pokemon_to_user_pokedex('eve', 'mew', False, update_leaderboards = False)
+    flowermons.update_leaderboards(['carol', 'eve'])
+    # the single !catch path
+    flowermons.add_pokemon_to_user_pokedex('dave', 'eevee', False)
+
+    assert flowermons.shiny_leaderboard.scores == {}
+    assert flowermons.shiny_leaderboard.top() == []
+    assert flowermons.shiny_leaderboard.rank('carol') is None
+    assert len(flowermons.leaderboard) == 3
+
+    flowermons.add_pokemon_to_user_pokedex('eve', 'mewtwo', True, update_leaderboards = False)
+    flowermons.update_leaderboards(['carol', 'eve'])
+    assert flowermons.shiny_leaderboard.scores == {'eve': 1}
+    assert flowermons.shiny_leaderboard.top() == [(1, ['eve'])]
+
+def test_update_to_zero_removes_the_user():
+    leaderboard = flowerbot.FlowerDexLeaderboard()
+    leaderboard.update('alice', 2)
+    leaderboard.update('bob', 2)
+    leaderboard.update('alice', 0)
+    assert leaderboard.scores == {'bob': 2}
+    assert leaderboard.rank('alice') is None
+    assert leaderboard.rank('bob') == (1, 2, 1)
+    assert_matches_rebuild(leaderboard, {'alice': 0, 'bob': 2})
+
+def test_incremental_updates_match_rebuild():
+    rng = random.Random(7)
+    leaderboard = flowerbot.FlowerDexLeaderboard()
+    scores = {}
+    for step in range(2000):
+        user = 'user%s' % (rng.randrange(50))
+        score = rng.choice([0, 0, rng.randrange(1, 200)])
+        leaderboard.update(user, score)
+        scores[user] = score
+    assert_matches_rebuild(leaderboard, scores)
+    assert all(score > 0 for score in leaderboard.scores.values())
@@ -0,0 +1,87 @@
+import collections
+import math
+import os
+import random
+
+import pytest
+
+import flowerbot
+
+MONS_DIRECTORY = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'resources', 'data', 'mons')
+TIERED_FLOWERMONS_FILE = os.path.join(MONS_DIRECTORY, 'flowermons_tiered.txt')
+UNTAGGED_FLOWERMONS_FILE = os.path.join(MONS_DIRECTORY, 'flowermons.txt')
+DRAWS = 200000
+SEED = 25
+ALPHA = 0.001
+MIN_EXPECTED_COUNT = 5.0 # species expected less often than this are pooled by tier for the chi-square test
+
+def load_pokedex(flowermons_filename, boosts = None):
+    pokedex = flowerbot.FlowermonsPokedex()
+    with open(flowermons_filename, 'r', encoding = "utf8") as flowermons_file:
+        for species in map(flowerbot.parse_flowermons_species, flowermons_file):
+            if species is not None:
+                pokedex.add(species[0], weight = species[2], rarity = species[1])
+    pokedex.set_boosts(boosts or {})
+    return pokedex
+
+def expected_shares(pokedex):
+    ''' Returns {species id: probability} from the configured weights and boosts. '''
+    weights = dict((species_id, pokedex.species_weight(species_id)) for species_id in pokedex.catchable_ids)
+    total = sum(weights.values())
+    return dict((species_id, weight / total) for species_id, weight in weights.items())
+
+def chi_square_p_value(pokedex, shares, counts, draws):
+    '''
+        Species with a small expected count are pooled with the rest of their tier, then any small
+        pools are pooled together. The p-value uses the Wilson-Hilferty normal approximation.
+    '''
+    bins = collections.OrderedDict()
+    for species_id, share in shares.items():
+        key = (species_id if share * draws >= MIN_EXPECTED_COUNT else pokedex.rarities[species_id])
+        expected, observed = bins.get(key, (0.0, 0))
+        bins[key] = (expected + share * draws, observed + counts.get(species_id, 0))
+    pooled = [(expected, observed) for expected, observed in bins.values() if expected < MIN_EXPECTED_COUNT]
+    cells = [(expected, observed) for expected, observed in bins.values() if expected >= MIN_EXPECTED_COUNT]
+    if pooled:
+        cells.append((sum(expected for expected, observed in pooled), sum(observed for expected, observed in pooled)))
+    statistic = sum((observed - expected) ** 2 / expected for expected, observed in cells)
+    degrees = max(1, len(cells) - 1)
+    scale = 2.0 / (9.0 * degrees)
+    z = ((statistic / degrees) ** (1.0 / 3.0) - (1.0 - scale)) / math.sqrt(scale)
+    return 0.5 * math.erfc(z / math.sqrt(2.0))
+
+def draw_single(pokedex, draws):
+    ''' Draws like !catch: one random_species() per catch. '''
+    return collections.Counter(pokedex.ids[pokedex.random_species()] for draw in range(draws))
+
+def draw_batch(pokedex, draws):
+    ''' Draws like !catch N: random_species_ids() for the whole batch. '''
+    return collections.Counter(int(species_id) for species_id in pokedex.random_species_ids(draws))
+
+@pytest.fixture(autouse = True)
+def seeded(monkeypatch):
+    random.seed(SEED)
+    if flowerbot.numpy is not None:
+        monkeypatch.setattr(flowerbot, 'NUMPY_RANDOM', flowerbot.numpy.random.default_rng(SEED))
+
+@pytest.mark.parametrize('draw', [draw_single, draw_batch])
+@pytest.mark.parametrize('boosts', [{}, {'legendary': 3.0, 'mewtwo': 2.0}])
+def test_catches_match_the_configured_rates(draw, boosts):
+    pokedex = load_pokedex(TIERED_FLOWERMONS_FILE, boosts)
+    counts = draw(pokedex, DRAWS)
+    assert chi_square_p_value(pokedex, expected_shares(pokedex), counts, DRAWS) >= ALPHA
+
+def test_untagged_species_are_equally_likely():
+    pokedex = load_pokedex(UNTAGGED_FLOWERMONS_FILE)
+    shares = expected_shares(pokedex)
+    assert set(pokedex.rarities) == {flowerbot.FLOWERMONS_DEFAULT_RARITY}
+    assert max(shares.values()) == pytest.approx(min(shares.values()))
+    counts = draw_single(pokedex, DRAWS)
+    assert chi_square_p_value(pokedex, shares, counts, DRAWS) >= ALPHA
+
+def test_rates_are_off_when_the_sampler_ignores_a_boost():
+    ''' Guards the test itself: a legendary boost that is configured but not applied must fail it. '''
+    pokedex = load_pokedex(TIERED_FLOWERMONS_FILE)
+    counts = draw_single(pokedex, DRAWS)
+    pokedex.set_boosts({'legendary': 3.0})
+    assert chi_square_p_value(pokedex, expected_shares(pokedex), counts, DRAWS) < ALPHA
@@ -0,0 +1,144 @@
+import io
+import sqlite3
+
+import pytest
+
+import flowerbot
+
+SPECIES = ['bulbasaur', 'pikachu', 'mewtwo']
+
+def new_state():
+    flowermons = flowerbot.FlowermonsState()
+    for pokemon in SPECIES:
+        flowermons.pokedex.add(pokemon)
+    return flowermons
+
+def open_storage(tmp_path, legacy_user_data_filename = None):
+    ''' Returns (state, storage) for a freshly loaded sqlite storage, like a channel at startup. '''
+    flowermons = new_state()
+    storage = flowerbot.SqliteFlowermonsStorage(flowermons, str(tmp_path / 'flowermons.sqlite'), legacy_user_data_filename)
+    storage.retry_delay = 0
+    storage.load()
+    flowermons.rebuild_leaderboards()
+    storage.open()
+    return (flowermons, storage)
+
+def caught(flowermons, username):
+    entry = flowermons.user_pokedex[username]
+    return (sorted(flowermons.pokedex.names_for_bits(entry.caught)), sorted(flowermons.pokedex.names_for_bits(entry.shiny)))
+
+def test_load_empty_database_creates_tables(tmp_path):
+    flowermons, storage = open_storage(tmp_path)
+    storage.close()
+    assert flowermons.user_pokedex == {}
+    assert flowermons.user_pokeballs == {}
+    connection = sqlite3.connect(str(tmp_path / 'flowermons.sqlite'))
+    tables = set(name for (name,) in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'"))
+    connection.close()
+    assert tables == set(['flowermons_catches', 'flowermons_pokeballs'])
+
+def test_catches_are_loaded_after_restart(tmp_path):
+    flowermons, storage = open_storage(tmp_path)
+    storage.record_catch('alice', 'pikachu', False)
+    storage.record_catches([('alice', 'mewtwo', True), ('bob', 'bulbasaur', False)], [('alice', 8)])
+    storage.close()
+
+    flowermons, storage = open_storage(tmp_path)
+    storage.close()
+    assert caught(flowermons, 'alice') == (['mewtwo', 'pikachu'], ['mewtwo'])
+    assert caught(flowermons, 'bob') == (['bulbasaur'], [])
+
+def test_write_batch_keeps_shiny_status_and_latest_balance(tmp_path):
+    flowermons, storage = open_storage(tmp_path)
+    assert storage.write_batch([
+        (flowerbot.JOURNAL_CATCH_RECORD, 'alice', 'pikachu', False),
+        (flowerbot.JOURNAL_CATCH_RECORD, 'alice', 'pikachu', True),
+        (flowerbot.JOURNAL_POKEBALLS_RECORD, 'alice', 5),
+        (flowerbot.JOURNAL_POKEBALLS_RECORD, 'alice', 3)
+    ])
+    # a later non-shiny catch of the same species never clears the shiny flag
+    assert storage.write_batch([(flowerbot.JOURNAL_CATCH_RECORD, 'alice', 'pikachu', False)])
+    storage.close()
+
+    flowermons, storage = open_storage(tmp_path)
+    storage.close()
+    assert caught(flowermons, 'alice') == (['pikachu'], ['pikachu'])
+    assert flowermons.user_pokeballs == {'alice': 3}
+
+def test_pokeball_balances_persist(tmp_path):
+    flowermons, storage = open_storage(tmp_path)
+    storage.record_pokeballs('alice', 10)
+    storage.record_pokeballs('bob', 2)
+    storage.record_pokeballs('alice', 9)
+    storage.close()
+
+    flowermons, storage = open_storage(tmp_path)
+    storage.record_pokeballs('bob', 0)
+    storage.close()
+
+    flowermons, storage = open_storage(tmp_path)
+    storage.close()
+    assert flowermons.user_pokeballs == {'alice': 9, 'bob': 0}
+
+def test_legacy_user_data_is_imported_into_empty_database(tmp_path):
+    user_data_filename = str(tmp_path / 'users.txt')
+    with open(user_data_filename, 'w', encoding = "utf8") as user_data_file:
+        user_data_file.write('alice\tpikachu\t\nalice\tmewtwo\tSHINY\nbob\tbulbasaur\t\n')
+    with open(user_data_filename + '.pokeballs', 'w', encoding = "utf8") as pokeballs_file:
+        pokeballs_file.write('alice\t4\nbob\t1\n')
+    with open(user_data_filename + '.journal', 'w', encoding = "utf8") as journal_file:
+        journal_file.write('CATCH\tbob\tpikachu\tSHINY\nBALLS\tbob\t0\n')
+
+    flowermons, storage = open_storage(tmp_path, user_data_filename)
+    storage.close()
+    assert caught(flowermons, 'alice') == (['mewtwo', 'pikachu'], ['mewtwo'])
+    assert caught(flowermons, 'bob') == (['bulbasaur', 'pikachu'], ['pikachu'])
+    assert flowermons.user_pokeballs == {'alice': 4, 'bob': 0}
+
+    # the database is no longer empty, so the (now stale) file is not imported again
+    with open(user_data_filename, 'a', encoding = "utf8") as user_data_file:
+        user_data_file.write('carol\tpikachu\t\n')
+    flowermons, storage = open_storage(tmp_path, user_data_filename)
+    storage.close()
+    assert sorted(flowermons.user_pokedex) == ['alice', 'bob']
+    assert flowermons.user_pokeballs == {'alice': 4, 'bob': 0}
+
+class FlakySqliteStorage(flowerbot.SqliteFlowermonsStorage):
+    ''' Fails the first failures connection attempts. '''
+    failures = 0
+
+    def acquire_connection(self):
+        if self.failures > 0:
+            self.failures -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return flowerbot.SqliteFlowermonsStorage.acquire_connection(self)
+
+def open_flaky_storage(tmp_path, failures):
+    flowermons = new_state()
+    storage = FlakySqliteStorage(flowermons, str(tmp_path / 'flowermons.sqlite'))
+    storage.retry_delay = 0
+    storage.load()
+    storage.failures = failures
+    storage.open()
+    return storage
+
+def test_failed_batch_is_retried_instead_of_dropped(tmp_path, monkeypatch):
+    monkeypatch.setattr(flowerbot, 'ERROR_FILE', io.StringIO())
+    storage = open_flaky_storage(tmp_path, flowerbot.STORAGE_WRITE_RETRIES)
+    storage.record_catch('alice', 'pikachu', True)
+    storage.record_pokeballs('alice', 2)
+    storage.close()
+    assert 'Keeping 2 Flowermons record(s)' in flowerbot.ERROR_FILE.getvalue()
+    assert 'Lost' not in flowerbot.ERROR_FILE.getvalue()
+
+    flowermons, storage = open_storage(tmp_path)
+    storage.close()
+    assert caught(flowermons, 'alice') == (['pikachu'], ['pikachu'])
+    assert flowermons.user_pokeballs == {'alice': 2}
+
+def test_records_that_cannot_be_written_are_reported(tmp_path, monkeypatch):
+    monkeypatch.setattr(flowerbot, 'ERROR_FILE', io.StringIO())
+    storage = open_flaky_storage(tmp_path, 100)
+    storage.record_catch('alice', 'pikachu', False)
+    storage.close()
+    assert 'Lost 1 Flowermons record(s)' in flowerbot.ERROR_FILE.getvalue()
@@ -0,0 +1,107 @@
+import io
+import os
+import sys
+import threading
+
+import pytest
+import requests
+
+import flowerbot
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+import fake_helix_server
+
+LOOKUP_TIMEOUT = 10
+
+@pytest.fixture
+def start_server(monkeypatch):
+    ''' Starts fake helix servers on free ports; returns a function taking FakeHelixServer's rate limit arguments. '''
+    monkeypatch.setattr(fake_helix_server, 'OUTPUT_FILE', io.StringIO())
+    servers = []
+    def start(rate_limit = 800, rate_window = 60.0, team_members = ()):
+        server = fake_helix_server.FakeHelixServer(('localhost', 0), rate_limit, rate_window, 0.0, 'spawnpoint', list(team_members))
+        thread = threading.Thread(target = server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+def new_client(server, fetch_teams = False):
+    return flowerbot.HelixClient('client', 'oauth:token', 'http://localhost:%s/helix' % (server.server_address[1]), fetch_teams = fetch_teams)
+
+def lookup_all(client, logins):
+    ''' Looks up every login at once and returns login -> HelixChannelInfo (or None) once all callbacks ran. '''
+    results = {}
+    done = threading.Event()
+    lock = threading.Lock()
+    def callback(login, channel_info):
+        with lock:
+            results[login] = channel_info
+            if len(results) == len(logins):
+                done.set()
+    for login in logins:
+        client.lookup(login, lambda channel_info, login = login: callback(login, channel_info))
+    assert done.wait(LOOKUP_TIMEOUT)
+    return results
+
+def requests_to(server, endpoint):
+    return [(path, status) for path, status in server.request_log if path.split('?')[0].endswith('/' + endpoint)]
+
+def test_lookups_are_batched_into_one_request(start_server, monkeypatch):
+    monkeypatch.setattr(flowerbot, 'HELIX_BATCH_WINDOW', 0.5)
+    server = start_server(team_members = ['bob'])
+    client = new_client(server, fetch_teams = True)
+    results = lookup_all(client, ['alice', 'bob', 'nouser1'])
+
+    users_requests = requests_to(server, 'users')
+    assert len(users_requests) == 1
+    assert all(('login=%s' % (login)) in users_requests[0][0] for login in ['alice', 'bob', 'nouser1'])
+    assert len(requests_to(server, 'channels')) == 1
+    assert results['alice'].user_id == fake_helix_server.user_id('alice')
+    assert results['alice'].game == fake_helix_server.GAMES[int(fake_helix_server.user_id('alice')) % len(fake_helix_server.GAMES)]
+    assert results['alice'].teams == ()
+    assert results['bob'].teams == ('spawnpoint',)
+    assert results['nouser1'].user_id is None
+
+def test_cached_lookup_does_not_hit_the_api(start_server):
+    server = start_server()
+    client = new_client(server)
+    first = lookup_all(client, ['alice'])['alice']
+    requests_made = len(server.request_log)
+
+    answered = []
+    client.lookup('ALICE', answered.append)
+    # a cache hit calls back right away, on the caller's thread
+    assert answered == [first]
+    assert len(server.request_log) == requests_made
+
+def test_rate_limited_request_is_retried_after_reset(start_server, monkeypatch):
+    monkeypatch.setattr(flowerbot, 'ERROR_FILE', io.StringIO())
+    server = start_server(rate_limit = 1, rate_window = 1.0)
+    client = new_client(server)
+    # someone else used up the window, so the client only finds out from the 429
+    requests.get('http://localhost:%s/helix/users' % (server.server_address[1]), params = {'login': 'carol'})
+    channel_info = lookup_all(client, ['alice'])['alice']
+
+    assert [status for path, status in requests_to(server, 'users')] == [200, 429, 200]
+    assert channel_info.game is not None
+    assert 'returned 429, retrying' in flowerbot.ERROR_FILE.getvalue()
+
+def test_unexpected_error_fails_the_batch_and_keeps_the_thread(start_server, monkeypatch):
+    monkeypatch.setattr(flowerbot, 'ERROR_FILE', io.StringIO())
+    server = start_server()
+    client = new_client(server)
+    fetch_channel_infos = client.fetch_channel_infos
+    def fail_once(logins):
+        client.fetch_channel_infos = fetch_channel_infos
+        raise TypeError('unexpected payload')
+    client.fetch_channel_infos = fail_once
+
+    assert lookup_all(client, ['alice']) == {'alice': None}
+    assert 'Helix lookup failed for alice: unexpected payload' in flowerbot.ERROR_FILE.getvalue()
+    assert client.worker.is_alive()
+    assert lookup_all(client, ['bob'])['bob'].user_id == fake_helix_server.user_id('bob')
@@ -0,0 +1,71 @@
+import io
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts'))
+import launchbot
+
+WAIT_TIMEOUT = 20
+
+# stands in for flowerbot.py: crashes right away if it hosts the bad channel, otherwise runs until interrupted
+FAKE_FLOWERBOT = '''
+import sys
+import time
+with open('started.log', 'a') as log:
+    log.write(' '.join(sys.argv[1:]) + '\\n')
+if any('bad' in argument for argument in sys.argv):
+    sys.exit(1)
+try:
+    time.sleep(60)
+except KeyboardInterrupt:
+    pass
+'''
+
+@pytest.fixture
+def flowerbot_home(tmp_path, monkeypatch):
+    monkeypatch.setattr(launchbot, 'OUTPUT_FILE', io.StringIO())
+    monkeypatch.setattr(launchbot, 'ERROR_FILE', io.StringIO())
+    monkeypatch.setattr(launchbot, 'POLL_INTERVAL', 0.05)
+    monkeypatch.setattr(launchbot, 'RESTART_MIN_DELAY', 0.05)
+    monkeypatch.setattr(launchbot, 'MAX_CONSECUTIVE_FAILURES', 2)
+    (tmp_path / 'flowerbot.py').write_text(FAKE_FLOWERBOT)
+    return str(tmp_path)
+
+def wait_for(condition):
+    deadline = time.time() + WAIT_TIMEOUT
+    while not condition():
+        assert time.time() < deadline
+        time.sleep(0.05)
+
+def test_crashing_channel_is_quarantined_without_taking_down_its_neighbours(flowerbot_home):
+    channels = ['alpha.properties', 'bad.properties', 'gamma.properties', 'delta.properties', 'omega.properties']
+    supervisor = launchbot.Supervisor(flowerbot_home, channels, 2)
+    runner = threading.Thread(target = supervisor.run)
+    runner.start()
+    try:
+        wait_for(lambda: [worker.properties_files for worker in supervisor.workers if worker.retired] == [['bad.properties']])
+        healthy = supervisor.live_workers()
+        wait_for(lambda: all(worker.is_running() for worker in healthy))
+        assert sorted(properties_file for worker in healthy for properties_file in worker.properties_files) == sorted(set(channels) - {'bad.properties'})
+        assert not supervisor.stopping
+    finally:
+        supervisor.stopping = True
+        runner.join(WAIT_TIMEOUT)
+        supervisor.stop()
+    assert 'quarantining channel bad.properties' in launchbot.ERROR_FILE.getvalue()
+
+def test_each_worker_gets_its_own_metrics_port_offset(flowerbot_home):
+    supervisor = launchbot.Supervisor(flowerbot_home, ['alpha.properties', 'gamma.properties', 'delta.properties'], 3)
+    for worker in supervisor.workers:
+        worker.start()
+    try:
+        wait_for(lambda: os.path.isfile(os.path.join(flowerbot_home, 'started.log')) and len(open(os.path.join(flowerbot_home, 'started.log')).readlines()) == 3)
+    finally:
+        supervisor.stop()
+    with open(os.path.join(flowerbot_home, 'started.log')) as log:
+        commands = sorted(log.read().splitlines())
+    assert commands == ['--async --metrics-port-offset %s --properties-file %s' % (index, properties_file) for index, properties_file in enumerate(['alpha.properties', 'gamma.properties', 'delta.properties'])]
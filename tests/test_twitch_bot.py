@@ -0,0 +1,57 @@
+import flowerbot
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sent = []
+
+    def cap(self, *args):
+        pass
+
+    def join(self, channel):
+        pass
+
+    def privmsg(self, target, message):
+        self.sent.append(message)
+
+class FakeScheduler(object):
+    def execute_after(self, delay, function):
+        pass
+
+    def execute_every(self, period, function):
+        pass
+
+class FakeReactor(object):
+    def __init__(self):
+        self.scheduler = FakeScheduler()
+
+def new_bot():
+    ''' A TwitchBot on a fake connection; __init__ is bypassed since it would connect to the server. '''
+    bot = flowerbot.TwitchBot.__new__(flowerbot.TwitchBot)
+    bot.flowerbot_channel = flowerbot.FlowerbotChannel({
+        flowerbot.CHANNEL: 'channel',
+        flowerbot.CHANNEL_ID: '1',
+        flowerbot.CLIENT_ID: 'client',
+        flowerbot.CLIENT_SECRETS: 'secret',
+        flowerbot.BOT_USERNAME: 'flowerbot',
+        flowerbot.IRC_CHAT_SERVER: 'localhost',
+        flowerbot.IRC_CHAT_SERVER_PORT: '6667',
+        flowerbot.CHANNEL_TRUSTED_USERS_LIST: ['channel'],
+        flowerbot.DATA_FILES_HOT_RELOAD: 'false',
+        flowerbot.SNAPSHOT_ENABLED: 'false'
+    })
+    bot.channel = bot.flowerbot_channel.channel
+    bot.connection = FakeConnection()
+    bot.reactor = FakeReactor()
+    bot.on_welcome(bot.connection, None)
+    return bot
+
+def test_lines_queued_during_a_reconnect_are_sent_after_welcome():
+    bot = new_bot()
+    bot.on_disconnect(bot.connection, None)
+    bot.flowerbot_channel.print_message_to_chat('sent while reconnecting')
+    assert bot.connection.sent == []
+    assert bot.flowerbot_channel.outbound_scheduler.send_failures == 0
+
+    bot.connection = FakeConnection()
+    bot.on_welcome(bot.connection, None)
+    assert bot.connection.sent == ['sent while reconnecting']
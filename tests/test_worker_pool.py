@@ -0,0 +1,47 @@
+import io
+import threading
+import time
+
+import pytest
+
+import flowerbot
+
+WAIT_TIMEOUT = 10
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(flowerbot, 'ERROR_FILE', io.StringIO())
+    pool = flowerbot.WorkerPool(threads = 2, max_pending = 10)
+    yield pool
+    pool.close()
+
+def sleep_and_record(seconds, ran, name):
+    time.sleep(seconds)
+    ran.append(name)
+    return name
+
+def test_waiting_behind_the_same_key_does_not_count_against_the_timeout(pool):
+    ran, done, failed = [], [], []
+    all_done = threading.Event()
+    def on_done(name):
+        done.append(name)
+        if len(done) == 3:
+            all_done.set()
+    # together the three writes take longer than each one's timeout
+    for name in ['first', 'second', 'third']:
+        assert pool.submit(sleep_and_record, (0.3, ran, name), on_done = on_done, on_error = failed.append, key = 'scores.txt', timeout = 0.5)
+    assert all_done.wait(WAIT_TIMEOUT)
+
+    assert ran == ['first', 'second', 'third']
+    assert done == ['first', 'second', 'third']
+    assert failed == []
+
+def test_task_still_running_after_its_timeout_is_reported_and_its_result_dropped(pool):
+    ran, done, failed = [], [], []
+    assert pool.submit(sleep_and_record, (0.5, ran, 'slow'), on_done = done.append, on_error = failed.append, timeout = 0.1)
+    pool.close(WAIT_TIMEOUT)
+
+    assert ran == ['slow']
+    assert done == []
+    assert [type(error) for error in failed] == [TimeoutError]
+    assert 'finished after its timeout, result dropped' in flowerbot.ERROR_FILE.getvalue()